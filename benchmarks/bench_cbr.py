@@ -0,0 +1,139 @@
+#!/usr/bin/env python3
+
+# Count the requests filter-carbon-black-response makes for an Event, against
+# a local CBR stand-in.  A fraction of the IPs and domains have processes and
+# a fraction of the md5s are known binaries.  The "legacy" row is the old
+# plugin, which looked up every Observable on its own, concurrently, asking
+# for the count and the first process separately for each IP and domain and
+# fetching each binary.  Every row looks up the same IPs, domains, and md5s
+# and has to find the same Sightings.  The last row runs the same
+# Observables again, so it should be answered from the cache.
+#
+#   ./benchmarks/bench_cbr.py --observables 300 --hit-rate 0.05
+
+import argparse
+import concurrent.futures
+import hashlib
+import os
+import random
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import cbapi.errors
+import cbapi.response as cb
+import urllib3
+
+import plugins
+import threatstash.event
+from stub_cbr import StubCBR
+
+def build(count, hit_rate):
+    rng = random.Random(0)
+    event = threatstash.event.Event()
+    processes = {}
+    binaries = {}
+    for i in range(count):
+        ip = "10.%d.%d.%d" % (i >> 16 & 255, i >> 8 & 255, i & 255)
+        domain = "host%d.example.com" % i
+        md5 = hashlib.md5(domain.encode()).hexdigest()
+        event.add_observation("ipv4-addr", ip, added_by="bench")
+        event.add_observation("domain-name", domain, added_by="bench")
+        event.add_observation("md5", md5, added_by="bench")
+        if rng.random() < hit_rate:
+            processes[('ipaddr', ip)] = [ "2018-10-19T16:%02d:00Z" % (i % 60) ]
+        if rng.random() < hit_rate:
+            processes[('domain', domain)] = [ "2018-10-19T17:%02d:00Z" % (i % 60) ] * 3
+        if rng.random() < hit_rate:
+            binaries[md5.upper()] = "2018-10-19T18:%02d:00Z" % (i % 60)
+    return event, processes, binaries
+
+def sightings(event):
+    return sorted(
+        (event.observation(sighting.sighting_of_ref).value, str(sighting.last_seen), sighting.count)
+        for sighting in event.sightings() if sighting.sighted_by == 'cbr'
+    )
+
+# The old plugin's lookup() for one Observable
+def legacy_lookup(cbr, observable):
+    if observable.type in ('ipv4-addr', 'domain-name'):
+        field = 'ipaddr:' if observable.type == 'ipv4-addr' else 'domain:'
+        processes = cbr.select(cb.Process).where(field + observable.value)
+        count = len(processes)
+        if count > 0:
+            return { 'last_seen' : processes.first().last_update, 'count' : count }
+        return None
+    try:
+        return { 'last_seen' : cbr.select(cb.Binary, observable.value).last_seen }
+    except cbapi.errors.ObjectNotFoundError:
+        return None
+
+# The old plugin's run(): every Observable looked up at the same concurrency
+# the plugin uses, then the results applied in order
+def legacy(plugin, event):
+    observables = event.observables_of('ipv4-addr', 'domain-name', 'md5')
+    with concurrent.futures.ThreadPoolExecutor(max_workers=plugin.config['concurrency']) as executor:
+        results = list(executor.map(lambda observable: legacy_lookup(plugin.cbr, observable), observables))
+    for observable, result in zip(observables, results):
+        if result is not None:
+            event.add_sighting(observable.id, sighted_by='cbr', **result)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--observables", help="IPs, domains, and md5s each", type=int, default=300)
+    parser.add_argument("--hit-rate", help="Fraction of Observables CBR has seen", type=float, default=0.05)
+    parser.add_argument("--group-sizes", type=int, nargs="*", default=[1, 4, 8, 16])
+    args = parser.parse_args()
+
+    # The stand-in's certificate is self-signed
+    urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
+    server = StubCBR()
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    Plugin = plugins.load('filter-carbon-black-response')
+    config = {
+        'global' : { 'debug' : False },
+        'filter-carbon-black-response' : {
+            'url'        : server.url,
+            'token'      : 'bench',
+            'ssl_verify' : False
+        }
+    }
+
+    def binary_requests():
+        return sum(count for path, count in server.requests.items() if path.startswith('/api/v1/binary'))
+
+    print("%10s %10s %10s %10s %10s" % ("group size", "processes", "binaries", "seconds", "sightings"))
+    event, server.processes, server.binaries = build(args.observables, args.hit_rate)
+    plugin = Plugin(config)
+    plugin.init()
+    server.requests.clear()
+    start = time.perf_counter()
+    legacy(plugin, event)
+    elapsed = time.perf_counter() - start
+    expected = sightings(event)
+    print("%10s %10d %10d %10.3f %10d" % (
+        "legacy", server.requests.get('/api/v1/process', 0), binary_requests(), elapsed, len(expected)))
+
+    for group_size in args.group_sizes + [ None ]:
+        event = build(args.observables, args.hit_rate)[0]
+        if group_size is None:
+            # Same Observables again, from the cache
+            label = "cached"
+        else:
+            label = str(group_size)
+            # Don't let one run answer from another's cache
+            sys.modules['filter-carbon-black-response']._results.clear()
+            plugin = Plugin(config)
+            plugin.configure({ 'group_size' : group_size })
+        plugin.init()
+        server.requests.clear()
+        start = time.perf_counter()
+        plugin.run(event)
+        elapsed = time.perf_counter() - start
+        found = sightings(event)
+        assert found == expected
+        print("%10s %10d %10d %10.3f %10d" % (
+            label, server.requests.get('/api/v1/process', 0), binary_requests(), elapsed, len(found)))
+    server.shutdown()
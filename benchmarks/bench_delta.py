@@ -0,0 +1,98 @@
+#!/usr/bin/env python3
+
+# Time re-running a pipeline on an Event that has already been enriched.
+# The first run checks every Observable.  Then a few new ones are added and
+# the pipeline runs again, which should only cost time for the new ones.
+# The pipeline checks IPs and domains against two sets of synthetic MISP
+# warning lists, and IPs against a local Redis stand-in for the OIL.
+#
+#   ./benchmarks/bench_delta.py --observables 20000 --added 100
+
+import argparse
+import json
+import os
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import threatstash.event
+import threatstash.pipeline
+from stub_redis import StubRedis
+
+def ip(i):
+    return "10.%d.%d.%d" % (i >> 16 & 255, i >> 8 & 255, i & 255)
+
+def write_list(directory, name, list_type, entries):
+    path = os.path.join(directory, "lists", name)
+    os.makedirs(path)
+    with open(os.path.join(path, "list.json"), "w") as f:
+        json.dump({ "name" : name, "type" : list_type, "list" : entries }, f)
+
+def add(event, start, count):
+    for i in range(start, start + count):
+        event.add_observation("ipv4-addr", ip(i), added_by="bench")
+        event.add_observation("domain-name", "host%d.example.com" % i, added_by="bench")
+
+def sightings(event):
+    return sorted(
+        (event.observation(sighting.sighting_of_ref).value, sighting.sighted_by)
+        for sighting in event.sightings()
+    )
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--observables", help="IPs and domains each in the first run", type=int, default=20000)
+    parser.add_argument("--added", help="IPs and domains each added before the second run", type=int, default=100)
+    args = parser.parse_args()
+
+    warning_list_dir = tempfile.mkdtemp()
+    write_list(warning_list_dir, "hosts", "hostname",
+            [ "host%d.example.com" % i for i in range(0, args.observables * 2, 7) ])
+    write_list(warning_list_dir, "nets", "cidr",
+            [ "%s/30" % ip(i) for i in range(0, args.observables * 2, 64) ])
+    redis = StubRedis()
+    for i in range(0, args.observables * 2, 3):
+        redis.data[('oil:' + ip(i)).encode()] = ("/data/nfcapd.2018101916%02d:10.0.0.1:%s:12345:53:UDP" % (i % 60, ip(i))).encode()
+    threading.Thread(target=redis.serve_forever, daemon=True).start()
+
+    config = {
+        'global'  : { 'debug' : False, 'quiet' : True },
+        'plugins' : [
+            { 'name' : 'filter-misp-warning', 'warning_list_dir' : warning_list_dir, 'warning_lists' : [ 'hosts' ] },
+            { 'name' : 'filter-misp-warning', 'warning_list_dir' : warning_list_dir, 'warning_lists' : [ 'nets' ] },
+            { 'name' : 'filter-oil-redis', 'server' : '127.0.0.1', 'port' : redis.port, 'namespace' : 'oil' }
+        ]
+    }
+    pipeline = threatstash.pipeline.Pipeline(config)
+
+    event = threatstash.event.Event()
+    add(event, 0, args.observables)
+    start = time.perf_counter()
+    pipeline.run(event)
+    first = time.perf_counter() - start
+
+    add(event, args.observables, args.added)
+    start = time.perf_counter()
+    pipeline.run(event)
+    second = time.perf_counter() - start
+    pipeline.close()
+
+    # The same Observables checked in one go
+    expected = threatstash.event.Event()
+    add(expected, 0, args.observables + args.added)
+    pipeline = threatstash.pipeline.Pipeline(config)
+    start = time.perf_counter()
+    pipeline.run(expected)
+    full = time.perf_counter() - start
+    pipeline.close()
+    assert sightings(event) == sightings(expected)
+
+    print("%-28s %10s %10s" % ("run", "observables", "seconds"))
+    print("%-28s %10d %10.3f" % ("first", args.observables * 2, first))
+    print("%-28s %10d %10.3f" % ("second, after adding", args.added * 2, second))
+    print("%-28s %10d %10.3f" % ("all at once, for comparison", (args.observables + args.added) * 2, full))
+    print("%d sightings" % len(event.sightings()))
+    redis.shutdown()
@@ -0,0 +1,102 @@
+#!/usr/bin/env python3
+
+# Compare plain requests.get() against threatstash.http.HTTPClient using a
+# local stub HTTP server.  The stub counts the TCP connections it accepts,
+# and can fail a fraction of requests with a 503 and a Retry-After header to
+# exercise the retry logic.
+#
+#   ./benchmarks/bench_http.py --requests 500 --fail-rate 0.05
+
+import argparse
+import http.server
+import os
+import random
+import sys
+import threading
+import time
+
+import requests
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import threatstash.http
+
+class StubServer(http.server.ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, fail_rate, retry_after):
+        super().__init__(('127.0.0.1', 0), StubHandler)
+        self.fail_rate = fail_rate
+        self.retry_after = retry_after
+        self.connections = 0
+        self.requests = 0
+        self.failures = 0
+        self.lock = threading.Lock()
+        self.random = random.Random(0)
+
+    @property
+    def url(self):
+        return "http://%s:%d" % self.server_address
+
+class StubHandler(http.server.BaseHTTPRequestHandler):
+    # Keep-alive needs HTTP/1.1
+    protocol_version = 'HTTP/1.1'
+    # Headers and body go out in separate writes.  Without this, Nagle's
+    # algorithm holds the body until the client's delayed ACK.
+    disable_nagle_algorithm = True
+
+    def setup(self):
+        super().setup()
+        with self.server.lock:
+            self.server.connections += 1
+
+    def do_GET(self):
+        with self.server.lock:
+            self.server.requests += 1
+            fail = self.server.random.random() < self.server.fail_rate
+            if fail:
+                self.server.failures += 1
+        if fail:
+            self.send_response(503)
+            self.send_header('Retry-After', str(self.server.retry_after))
+            body = b'try again later\n'
+        else:
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            body = b'{"rrname": "example.com.", "rdata": ["192.0.2.1"]}\n'
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+def bench(name, get, server, count):
+    server.connections = server.requests = server.failures = 0
+    errors = 0
+    start = time.perf_counter()
+    for i in range(count):
+        r = get(server.url + "/lookup/rrset/name/host%d.example.com/A" % i)
+        if r.status_code != 200:
+            errors += 1
+    elapsed = time.perf_counter() - start
+    print("%-12s %8.3f %10.0f %12d %10d %8d %8d" % (
+        name, elapsed, count / elapsed, server.connections,
+        server.requests, server.failures, errors))
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--requests", help="Requests per client", type=int, default=500)
+    parser.add_argument("--fail-rate", help="Fraction of requests to fail with a 503", type=float, default=0.0)
+    parser.add_argument("--retry-after", help="Retry-After seconds sent with each 503", type=int, default=0)
+    args = parser.parse_args()
+
+    server = StubServer(args.fail_rate, args.retry_after)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    client = threatstash.http.HTTPClient(backoff_factor=0.01)
+    print("%-12s %8s %10s %12s %10s %8s %8s" % (
+        "client", "seconds", "req/sec", "connections", "requests", "503s", "errors"))
+    bench("requests.get", requests.get, server, args.requests)
+    bench("HTTPClient", client.get, server, args.requests)
+    server.shutdown()
@@ -0,0 +1,88 @@
+#!/usr/bin/env python3
+
+# Count the Moloch queries filter-moloch makes for an Event, against a local
+# Moloch stand-in.  Each domain resolves to a few IPs that were sighted on
+# one of a few days, and a fraction of the (ip, domain) pairs have sessions.
+# A group size of 1 queries every (ip, host, day) pair on its own.
+#
+#   ./benchmarks/bench_moloch.py --domains 200 --hit-rate 0.05
+
+import argparse
+import os
+import random
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import plugins
+import threatstash.event
+from stub_moloch import StubMoloch
+
+DAY = 86400
+
+def build(domains, ips_per_domain, days, hit_rate, now):
+    rng = random.Random(0)
+    event = threatstash.event.Event()
+    sessions = {}
+    for d in range(domains):
+        domain = event.add_observation("domain-name", "host%d.example.com" % d, added_by="bench")
+        for i in range(ips_per_domain):
+            n = d * ips_per_domain + i
+            value = "10.%d.%d.%d" % (n >> 16 & 255, n >> 8 & 255, n & 255)
+            ip = event.add_observation("ipv4-addr", value, added_by="bench")
+            event.add_relationship(ip, domain, "resolved_from")
+            last_seen = now - DAY * (1 + rng.randrange(days))
+            event.add_sighting(ip, last_seen=time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime(last_seen)),
+                    sighted_by="oil-netflow")
+            if rng.random() < hit_rate:
+                sessions[(value, "host%d.example.com" % d)] = [ (last_seen - 60) * 1000 ]
+    return event, sessions
+
+def sightings(event):
+    return sorted(
+        (event.observation(sighting.sighting_of_ref).value, sighting.count)
+        for sighting in event.sightings() if sighting.sighted_by == 'moloch'
+    )
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--domains", type=int, default=200)
+    parser.add_argument("--ips-per-domain", type=int, default=3)
+    parser.add_argument("--days", type=int, default=3)
+    parser.add_argument("--hit-rate", help="Fraction of pairs with sessions", type=float, default=0.05)
+    parser.add_argument("--group-sizes", type=int, nargs="*", default=[1, 4, 16, 64])
+    args = parser.parse_args()
+
+    now = int(time.time())
+    server = StubMoloch()
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    Plugin = plugins.load('filter-moloch')
+
+    print("%10s %8s %10s %10s" % ("group size", "queries", "seconds", "sightings"))
+    expected = None
+    for group_size in args.group_sizes:
+        event, server.sessions = build(args.domains, args.ips_per_domain, args.days, args.hit_rate, now)
+        # Don't let one run answer from another's cache
+        sys.modules['filter-moloch']._results.clear()
+        plugin = Plugin({
+            'global' : { 'debug' : False },
+            'filter-moloch' : {
+                'url'        : server.url,
+                'username'   : 'bench',
+                'password'   : 'bench',
+                'group_size' : group_size
+            }
+        })
+        plugin.init()
+        server.queries = 0
+        start = time.perf_counter()
+        plugin.run(event)
+        elapsed = time.perf_counter() - start
+        found = sightings(event)
+        if expected is None:
+            expected = found
+        assert found == expected
+        print("%10d %8d %10.3f %10d" % (group_size, server.queries, elapsed, len(found)))
+    server.shutdown()
@@ -0,0 +1,107 @@
+#!/usr/bin/env python3
+
+# Time filter-oil-redis against a local Redis stand-in, comparing one GET per
+# IP on a new connection per Event (the old behavior) with the plugin's
+# pipelined MGETs over a connection kept across Events.  Half of the IPs in
+# each Event are in OIL.  The snapshot column checks the same IPs against an
+# in-memory snapshot of the OIL, which took the time shown at the top to load.
+# The last column is the whole plugin run, including adding Sightings to the
+# Event.
+#
+#   ./benchmarks/bench_oil_redis.py 1000 5000 20000
+
+import argparse
+import os
+import sys
+import threading
+import time
+
+import redis
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import plugins
+import threatstash.event
+from stub_redis import StubRedis
+
+def ip(i):
+    return "10.%d.%d.%d" % (i >> 16 & 255, i >> 8 & 255, i & 255)
+
+def build_event(count):
+    event = threatstash.event.Event()
+    for i in range(count):
+        event.add_observation("ipv4-addr", ip(i), added_by="bench")
+    return event
+
+NAMESPACE = 'oil'
+
+# The old filter-oil-redis loop
+def get_per_ip(plugin, event):
+    r = redis.StrictRedis(host='127.0.0.1', port=plugin.config['port'])
+    for observable in event.observables_of('ipv4-addr'):
+        r.get(NAMESPACE + ':' + observable.value)
+
+def ips(event):
+    return [ observable.value for observable in event.observables_of('ipv4-addr') ]
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("counts", help="IPs per Event", nargs="*", type=int,
+            default=[1000, 5000, 20000])
+    parser.add_argument("--events", help="Events per run", type=int, default=3)
+    parser.add_argument("--chunk-size", help="Keys per MGET", type=int, default=1000)
+    args = parser.parse_args()
+
+    server = StubRedis()
+    for i in range(0, max(args.counts), 2):
+        server.data[(NAMESPACE + ':' + ip(i)).encode()] = ("/data/nfcapd.2018101916%02d:10.0.0.1:%s:12345:53:UDP" % (i % 60, ip(i))).encode()
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    config = {
+        'global' : { 'debug' : False },
+        'filter-oil-redis' : {
+            'server'     : '127.0.0.1',
+            'port'       : server.port,
+            'namespace'  : NAMESPACE,
+            'chunk_size' : args.chunk_size
+        }
+    }
+    Plugin = plugins.load('filter-oil-redis')
+    plugin = Plugin(config)
+    plugin.init()
+    snapshot_plugin = Plugin(config)
+    snapshot_plugin.configure({ 'snapshot' : True })
+    snapshot_plugin.init()
+    start = time.perf_counter()
+    snapshot_plugin.refresh()
+    print("Loaded a snapshot of %d entries in %.3f seconds" % (
+        len(snapshot_plugin.snapshot), time.perf_counter() - start))
+
+    print("%8s %12s %12s %10s %12s %12s" % ("IPs", "GET (s)", "MGET (s)", "speedup", "snapshot (s)", "run (s)"))
+    for count in args.counts:
+        events = [ build_event(count) for i in range(args.events) ]
+        start = time.perf_counter()
+        for event in events:
+            get_per_ip(plugin, event)
+        get_time = (time.perf_counter() - start) / args.events
+
+        start = time.perf_counter()
+        for event in events:
+            mget_results = plugin.check_many(ips(event))
+        mget_time = (time.perf_counter() - start) / args.events
+
+        start = time.perf_counter()
+        for event in events:
+            snapshot_results = snapshot_plugin.check_many(ips(event))
+        snapshot_time = (time.perf_counter() - start) / args.events
+        assert snapshot_results == mget_results
+
+        start = time.perf_counter()
+        for event in events:
+            plugin.run(event)
+        run_time = (time.perf_counter() - start) / args.events
+        sighted = sum(1 for observable in events[0].observables if events[0].sighted(observable.id))
+        assert sighted == (count + 1) // 2, sighted
+        print("%8d %12.3f %12.3f %9.1fx %12.3f %12.3f" % (
+            count, get_time, mget_time, get_time / mget_time, snapshot_time, run_time))
+    server.shutdown()
@@ -0,0 +1,48 @@
+#!/usr/bin/env python3
+
+# Time output-stdout-csv against Events of increasing size.  Each IOC gets a
+# Sighting and a Relationship, so the output plugin exercises sighted(),
+# sightings_of(), and related_observables() once per observable.  The time
+# per IOC should stay flat as the IOC count grows.
+#
+#   ./benchmarks/bench_output.py 1000 2000 4000 8000
+
+import argparse
+import contextlib
+import io
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import plugins
+import threatstash.event
+
+CONFIG = { 'global' : { 'debug' : False } }
+
+def build_event(count):
+    event = threatstash.event.Event()
+    for i in range(count):
+        domain = event.add_observation("domain-name", "host%d.example.com" % i, added_by="bench")
+        ip = event.add_observation("ipv4-addr", "10.%d.%d.%d" % (i >> 16 & 255, i >> 8 & 255, i & 255), added_by="bench")
+        event.add_relationship(domain, ip, "resolves_to")
+        event.add_sighting(ip, last_seen="2018-10-19T16:00:00Z", sighted_by="bench", refs=["bench", str(i)])
+    return event
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("counts", help="IOC counts to benchmark", nargs="*", type=int,
+            default=[500, 1000, 2000, 4000])
+    args = parser.parse_args()
+
+    plugin = plugins.load('output-stdout-csv')(CONFIG)
+
+    print("%8s %10s %14s" % ("IOCs", "seconds", "usec per IOC"))
+    for count in args.counts:
+        event = build_event(count)
+        start = time.perf_counter()
+        with contextlib.redirect_stdout(io.StringIO()):
+            plugin.run(event)
+        elapsed = time.perf_counter() - start
+        print("%8d %10.3f %14.1f" % (count, elapsed, elapsed / count * 1000000))
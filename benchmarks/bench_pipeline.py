@@ -0,0 +1,111 @@
+#!/usr/bin/env python3
+
+# Time Pipeline.run with one worker, which runs plugins one after another,
+# against more workers, which run independent filters side by side.  The
+# report text holds IPs, domains, and md5s.  filter-oil-redis checks the IPs
+# against a local Redis stand-in while filter-carbon-black-response checks
+# everything against a local CBR stand-in, and neither reads what the other
+# writes.  Both stand-ins wait --latency seconds per request, and the OIL
+# lookups are split into --chunk-size MGETs so Redis takes about as long as
+# CBR.  Each row shows the sum of the stage times, which is what running
+# them one after another costs, and the critical path, which is the least
+# the run can take.  The CSV output has to come out the same either way.
+#
+#   ./benchmarks/bench_pipeline.py --indicators 200 --workers 1 4
+
+import argparse
+import contextlib
+import hashlib
+import io
+import os
+import sys
+import threading
+import time
+
+import urllib3
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import threatstash.metrics
+import threatstash.pipeline
+from stub_cbr import StubCBR
+from stub_redis import StubRedis
+
+def report(count):
+    lines = []
+    for i in range(count):
+        ip = "10.%d.%d.%d" % (i >> 16 & 255, i >> 8 & 255, i & 255)
+        domain = "host%d.example.com" % i
+        md5 = hashlib.md5(domain.encode()).hexdigest()
+        lines.append("Beacon to %s (%s) dropped %s" % (domain, ip, md5))
+    return "\n".join(lines) + "\n"
+
+# Return the seconds the run took, the seconds each stage took, the
+# critical path, and the output
+def run(config, text):
+    stdin = sys.stdin
+    sys.stdin = io.StringIO(text)
+    output = io.StringIO()
+    metrics = threatstash.metrics.Metrics()
+    try:
+        pipeline = threatstash.pipeline.Pipeline(config, metrics=metrics)
+        start = time.perf_counter()
+        with contextlib.redirect_stdout(output):
+            pipeline.run()
+        elapsed = time.perf_counter() - start
+        pipeline.close()
+    finally:
+        sys.stdin = stdin
+    stages = { stage.stage : stage.wall_time for stage in metrics.stages }
+    durations = [ stages[label] for label in pipeline.stage_labels(config['plugins']) ]
+    critical_path, chain = pipeline.critical_path(pipeline.dependencies(config['plugins']), durations)
+    return elapsed, durations, critical_path, output.getvalue()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--indicators", help="Lines of report text", type=int, default=200)
+    parser.add_argument("--workers", type=int, nargs="*", default=[1, 4])
+    parser.add_argument("--latency", help="Seconds the stand-ins take per request", type=float, default=0.02)
+    parser.add_argument("--chunk-size", help="IPs per OIL MGET", type=int, default=2)
+    args = parser.parse_args()
+
+    # The CBR stand-in's certificate is self-signed
+    urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
+    cbr = StubCBR(latency=args.latency)
+    redis = StubRedis(latency=args.latency)
+    for i in range(0, args.indicators, 2):
+        ip = "10.%d.%d.%d" % (i >> 16 & 255, i >> 8 & 255, i & 255)
+        redis.data[('oil:' + ip).encode()] = ("/data/nfcapd.2018101916%02d:10.0.0.1:%s:12345:53:UDP" % (i % 60, ip)).encode()
+    for i in range(0, args.indicators, 10):
+        cbr.processes[('domain', "host%d.example.com" % i)] = [ "2018-10-19T17:00:00Z" ]
+    for server in (cbr, redis):
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    text = report(args.indicators)
+    expected = None
+    print("%8s %10s %10s %10s %10s %10s %10s" % (
+        "workers", "oil", "cbr", "serial", "critical", "seconds", "rows"))
+    for workers in args.workers:
+        config = {
+            'global'   : { 'debug' : False, 'quiet' : True },
+            'pipeline' : { 'workers' : workers },
+            'plugins'  : [
+                { 'name' : 'input-stdin' },
+                { 'name' : 'filter-freeform' },
+                { 'name' : 'filter-oil-redis', 'server' : '127.0.0.1', 'port' : redis.port, 'namespace' : 'oil',
+                  'chunk_size' : args.chunk_size },
+                { 'name' : 'filter-carbon-black-response', 'url' : cbr.url, 'token' : 'bench',
+                  'ssl_verify' : False, 'cache_ttl' : 0 },
+                { 'name' : 'output-stdout-csv' }
+            ]
+        }
+        elapsed, durations, critical_path, output = run(config, text)
+        # Rows come out in the order Observables were added, which is the
+        # same either way
+        if expected is None:
+            expected = output
+        assert output == expected
+        print("%8d %10.3f %10.3f %10.3f %10.3f %10.3f %10d" % (
+            workers, durations[2], durations[3], sum(durations), critical_path, elapsed, output.count("\n")))
+    cbr.shutdown()
+    redis.shutdown()
@@ -0,0 +1,114 @@
+#!/usr/bin/env python3
+
+# Compare concurrent lookups against a rate limited API with and without a
+# threatstash.ratelimit bucket in front of them.  The local stub server
+# allows --server-rate requests per second with bursts of --server-burst,
+# and answers anything over that with a 429 and a Retry-After header, like
+# DNSDB does.  Without a limiter the lookups burst, get throttled, back off,
+# and burst again.  With one set to the server's rate they never hit a 429.
+#
+#   ./benchmarks/bench_ratelimit.py --requests 300 --server-rate 100
+
+import argparse
+import concurrent.futures
+import http.server
+import os
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import threatstash.http
+import threatstash.ratelimit
+
+class ThrottlingServer(http.server.ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, rate, burst, retry_after):
+        super().__init__(('127.0.0.1', 0), ThrottlingHandler)
+        self.rate = rate
+        self.burst = burst
+        self.retry_after = retry_after
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.requests = 0
+        self.throttled = 0
+        self.lock = threading.Lock()
+
+    @property
+    def url(self):
+        return "http://%s:%d" % self.server_address
+
+    # Take a token if there is one
+    def allow(self):
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.requests += 1
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return True
+            self.throttled += 1
+            return False
+
+class ThrottlingHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+
+    def do_GET(self):
+        if self.server.allow():
+            self.send_response(200)
+            body = b'{}\n'
+        else:
+            self.send_response(429)
+            self.send_header('Retry-After', str(self.server.retry_after))
+            body = b'rate limit exceeded\n'
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+def bench(name, server, limiter, count, concurrency):
+    client = threatstash.http.HTTPClient(pool_maxsize=concurrency)
+    def lookup(i):
+        limiter.acquire('api')
+        return client.get(server.url + "/lookup/%d" % i).status_code
+    with server.lock:
+        server.requests = server.throttled = 0
+        # Start each run with a full bucket on both sides
+        server.tokens = server.burst
+        server.updated = time.monotonic()
+    start = time.perf_counter()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=concurrency) as executor:
+        statuses = list(executor.map(lookup, range(count)))
+    elapsed = time.perf_counter() - start
+    ok = statuses.count(200)
+    stats = limiter.stats().get('api', { 'mean_wait' : 0.0, 'max_wait' : 0.0 })
+    print("%-10s %8.3f %8.1f %8d %8d %8d %10.3f %10.3f" % (
+        name, elapsed, ok / elapsed, ok, count - ok, server.throttled,
+        stats['mean_wait'], stats['max_wait']))
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--requests", type=int, default=300)
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--server-rate", help="Requests per second the server allows", type=float, default=100)
+    parser.add_argument("--server-burst", type=float, default=10)
+    parser.add_argument("--retry-after", help="Retry-After seconds sent with each 429", type=int, default=1)
+    args = parser.parse_args()
+
+    server = ThrottlingServer(args.server_rate, args.server_burst, args.retry_after)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    print("%-10s %8s %8s %8s %8s %8s %10s %10s" % (
+        "limiter", "seconds", "ok/sec", "ok", "failed", "429s", "mean wait", "max wait"))
+    bench("none", server, threatstash.ratelimit.RateLimiter(), args.requests, args.concurrency)
+    limiter = threatstash.ratelimit.RateLimiter.from_config({
+        'api' : { 'rate' : args.server_rate, 'burst' : args.server_burst }
+    })
+    bench("bucket", server, limiter, args.requests, args.concurrency)
+    server.shutdown()
@@ -0,0 +1,75 @@
+#!/usr/bin/env python3
+
+# Compare two results files from benchmarks/suite.py, e.g. from before and
+# after a change.  Cases that got slower by more than --threshold are
+# flagged, and the exit status is 1 if there are any, so this can gate CI.
+# Results are only comparable if both runs used the same arguments; a
+# warning is printed if they didn't.
+#
+#   ./benchmarks/compare.py before.json after.json --threshold 0.1
+
+import argparse
+import json
+import sys
+
+STATISTICS = ( 'min', 'median', 'mean' )
+
+def load(filename):
+    with open(filename) as f:
+        results = json.load(f)
+    if 'results' not in results or 'meta' not in results:
+        raise ValueError(filename + " is not a benchmarks/suite.py results file")
+    return results
+
+def describe(results):
+    meta = results['meta']
+    commit = (meta.get('commit') or 'unknown')[:12]
+    if meta.get('dirty'):
+        commit = commit + '+'
+    return "%s (Python %s, %s)" % (commit, meta.get('python'), meta.get('started'))
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("before", help="Results file to compare against")
+    parser.add_argument("after", help="Results file to compare")
+    parser.add_argument("--statistic", help="Statistic to compare (default: median)", choices=STATISTICS, default='median')
+    parser.add_argument("--threshold", help="Slowdown, as a fraction, that counts as a regression (default: 0.1)",
+            type=float, default=0.1)
+    args = parser.parse_args()
+
+    before = load(args.before)
+    after = load(args.after)
+    print("before: " + describe(before))
+    print("after:  " + describe(after))
+    arguments = (before['meta'].get('arguments', {}), after['meta'].get('arguments', {}))
+    for key in sorted(set(arguments[0]) | set(arguments[1])):
+        if key in ('repeat', 'warmup'):
+            continue
+        if arguments[0].get(key) != arguments[1].get(key):
+            print("warning: %s differs (%r before, %r after)" % (key, arguments[0].get(key), arguments[1].get(key)))
+    print()
+
+    regressions = []
+    print("%-30s %12s %12s %9s" % ("case", "before (s)", "after (s)", "change"))
+    for name in list(before['results']) + [ name for name in after['results'] if name not in before['results'] ]:
+        if name not in after['results']:
+            print("%-30s %12.4f %12s %9s" % (name, before['results'][name][args.statistic], "-", "not run"))
+            continue
+        if name not in before['results']:
+            print("%-30s %12s %12.4f %9s" % (name, "-", after['results'][name][args.statistic], "new"))
+            continue
+        old = before['results'][name][args.statistic]
+        new = after['results'][name][args.statistic]
+        change = (new - old) / old if old else 0.0
+        flag = ""
+        if change > args.threshold:
+            flag = "  REGRESSION"
+            regressions.append(name)
+        elif change < -args.threshold:
+            flag = "  faster"
+        print("%-30s %12.4f %12.4f %+8.1f%%%s" % (name, old, new, change * 100, flag))
+
+    if regressions:
+        print("\n%d case(s) slower by more than %.0f%%: %s" % (
+            len(regressions), args.threshold * 100, ", ".join(regressions)))
+        sys.exit(1)
@@ -0,0 +1,101 @@
+#!/usr/bin/env python3
+
+# Check threatstash.scanner against the line-by-line extractor that
+# filter-freeform used before it.  For every file in the corpus, the
+# candidate IOCs of each type must be the same and in the same order, both
+# when the file is scanned whole and when it's split into small chunks and
+# extracted by a process pool.
+#
+#   ./benchmarks/freeform_regression.py [file ...]
+
+import argparse
+import concurrent.futures
+import glob
+import os
+import re
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import threatstash.scanner
+import threatstash.util
+
+CORPUS = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'corpus')
+
+# The extraction loop from the original filter-freeform
+def legacy_extract(text):
+    ips       = {}
+    urls      = {}
+    hostnames = {}
+    hashes    = {}
+    for line in text.split("\n"):
+        line = line.strip()
+        line = threatstash.util.refang(line)
+        for ip in re.findall(r'\d{1,3}\.\d{1,3}\.\d{1,3}\.\d{1,3}', line):
+            ips[ip] = True
+        if re.search(r'https?://', line):
+            for url in re.findall(r'https?://\S+', line):
+                urls[url] = True
+        else:
+            for url in re.findall(r'[a-zA-Z0-9-\.]+\.[a-zA-Z]{2,}/\S+', line):
+                url = 'http://' + url
+                urls[url] = True
+        for hostname in re.findall(r'[a-zA-Z0-9-\.]+\.[a-zA-Z]{2,}', line):
+            hostnames[hostname] = True
+        for hash in re.findall(r'\b[a-fA-F0-9]{64}\b', line):
+            hashes[hash] = True
+        for hash in re.findall(r'\b[a-fA-F0-9]{40}\b', line):
+            hashes[hash] = True
+        for hash in re.findall(r'\b[a-fA-F0-9]{32}\b', line):
+            hashes[hash] = True
+    return {
+        'ipv4-addr'   : list(ips),
+        'url'         : list(urls),
+        'domain-name' : list(hostnames),
+        'md5'         : [ h for h in hashes if len(h) == 32 ],
+        'sha1'        : [ h for h in hashes if len(h) == 40 ],
+        'sha256'      : [ h for h in hashes if len(h) == 64 ]
+    }
+
+def scanner_extract(text):
+    found = { t : {} for t in ['ipv4-addr', 'url', 'domain-name', 'md5', 'sha1', 'sha256'] }
+    for match in threatstash.scanner.scan(text):
+        found[match.type][match.value] = True
+    return { t : list(values) for t, values in found.items() }
+
+def parallel_extract(text, executor, chunk_size):
+    found = { t : [] for t in ['ipv4-addr', 'url', 'domain-name', 'md5', 'sha1', 'sha256'] }
+    for ioc_type, value in threatstash.scanner.extract_parallel(text, executor, chunk_size):
+        found[ioc_type].append(value)
+    return found
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("files", help="Text files to compare (default: the corpus)", nargs="*")
+    parser.add_argument("--chunk-size", help="Chunk size for the parallel check", type=int, default=256)
+    args = parser.parse_args()
+
+    files = args.files or sorted(glob.glob(os.path.join(CORPUS, '*.txt')))
+    failures = 0
+    with concurrent.futures.ProcessPoolExecutor(max_workers=2) as executor:
+        for filename in files:
+            with open(filename, newline='') as f:
+                text = f.read()
+            expected = legacy_extract(text)
+            for mode, actual in [
+                    ('scanner',  scanner_extract(text)),
+                    ('parallel', parallel_extract(text, executor, args.chunk_size))
+                ]:
+                mismatched = [ t for t in expected if expected[t] != actual[t] ]
+                for ioc_type in mismatched:
+                    print("FAIL %s %s %s" % (os.path.basename(filename), mode, ioc_type))
+                    print("  legacy:  " + repr(expected[ioc_type]))
+                    print("  %-8s " % (mode + ":") + repr(actual[ioc_type]))
+                failures += len(mismatched)
+                if not mismatched:
+                    print("ok   %s %s (%d IOCs)" % (
+                        os.path.basename(filename),
+                        mode,
+                        sum(len(values) for values in actual.values())
+                    ))
+    sys.exit(1 if failures else 0)
@@ -0,0 +1,114 @@
+# A minimal Carbon Black Response stand-in for benchmarks.  It answers enough
+# of the REST API for cbapi to connect, search processes with queries that
+# OR together "ipaddr:X" and "domain:Y" terms, and fetch binary summaries.
+# Processes come from a dict of (field, value) => list of last_update times,
+# and binaries from a dict of upper case md5 => last_seen time.
+#
+# Set latency to add a delay to every response, like a busy server.
+#
+# cbapi insists on https, so the server uses a self-signed certificate made
+# with the openssl command line tool.  Turn off ssl_verify to talk to it.
+#
+#   server = StubCBR({ ('domain', 'evil.com') : ['2018-10-19T16:00:00Z'] })
+#   threading.Thread(target=server.serve_forever, daemon=True).start()
+#   cbr = cbapi.response.CbResponseAPI(url=server.url, token='x', ssl_verify=False)
+
+import http.server
+import json
+import os
+import re
+import ssl
+import subprocess
+import tempfile
+import threading
+import time
+import urllib.parse
+
+_TERM = re.compile(r'(ipaddr|domain):([^\s)]+)')
+_BINARY = re.compile(r'^/api/v1/binary/([0-9A-Fa-f]{32})/summary$')
+
+class StubCBR(http.server.ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, processes=None, binaries=None, host='127.0.0.1', port=0, latency=0):
+        super().__init__((host, port), StubCBRHandler)
+        context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+        with tempfile.TemporaryDirectory() as directory:
+            cert = os.path.join(directory, 'cert.pem')
+            key = os.path.join(directory, 'key.pem')
+            subprocess.run(
+                    [ 'openssl', 'req', '-x509', '-newkey', 'rsa:2048', '-nodes',
+                      '-subj', '/CN=' + host, '-days', '1', '-keyout', key, '-out', cert ],
+                    check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+                )
+            context.load_cert_chain(cert, key)
+        self.socket = context.wrap_socket(self.socket, server_side=True)
+        self.processes = processes if processes is not None else {}
+        self.binaries = binaries if binaries is not None else {}
+        # Seconds to wait before answering
+        self.latency = latency
+        # Path => number of requests
+        self.requests = {}
+        self.lock = threading.Lock()
+
+    @property
+    def url(self):
+        return "https://%s:%d" % self.server_address
+
+class StubCBRHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+
+    def do_GET(self):
+        url = urllib.parse.urlsplit(self.path)
+        query = urllib.parse.parse_qs(url.query)
+        with self.server.lock:
+            self.server.requests[url.path] = self.server.requests.get(url.path, 0) + 1
+        if self.server.latency:
+            time.sleep(self.server.latency)
+        if url.path == '/api/info':
+            # 5.x, so cbapi doesn't go looking for legacy partitions
+            self.reply(200, { 'version' : '5.3.0' })
+        elif url.path == '/api/v1/process':
+            self.reply(200, self.search(query))
+        elif _BINARY.match(url.path):
+            md5 = _BINARY.match(url.path).group(1).upper()
+            if md5 in self.server.binaries:
+                self.reply(200, { 'md5' : md5, 'last_seen' : self.server.binaries[md5] })
+            else:
+                self.reply(404, { 'reason' : 'not found' })
+        else:
+            self.reply(404, { 'reason' : 'not found' })
+
+    # Processes matching any term in q, most recently updated first
+    def search(self, query):
+        updates = []
+        for field, value in _TERM.findall(query.get('q', [''])[0]):
+            updates.extend(self.server.processes.get((field, value), []))
+        updates.sort(reverse=True)
+        start = int(query.get('start', ['0'])[0])
+        rows = int(query.get('rows', ['10'])[0])
+        return {
+            'total_results' : len(updates),
+            'start'         : start,
+            'results'       : [
+                {
+                    'id'          : '00000001-0000-0000-0000-%012d' % i,
+                    'unique_id'   : '00000001-0000-0000-0000-%012d-00000001' % i,
+                    'segment_id'  : 1,
+                    'last_update' : last_update
+                }
+                for i, last_update in enumerate(updates[start:start + rows], start)
+            ]
+        }
+
+    def reply(self, status, document):
+        body = json.dumps(document).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
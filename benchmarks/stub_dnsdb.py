@@ -0,0 +1,76 @@
+# A minimal DNSDB stand-in for benchmarks.  It answers rrset name lookups
+# (/lookup/rrset/name/<domain>/A) from a dict of domain => list of
+# (time_last, [ip, ...]) rrsets, one JSON rrset per line like DNSDB does.
+# Domains it doesn't know get a 404 with DNSDB's "no results" message.
+# time_last_after and limit are honored.
+#
+#   server = StubDNSDB({ 'evil.com' : [ (1539964800, ['10.0.0.1']) ] })
+#   threading.Thread(target=server.serve_forever, daemon=True).start()
+
+import http.server
+import json
+import threading
+import time
+import urllib.parse
+
+_PREFIX = '/lookup/rrset/name/'
+
+class StubDNSDB(http.server.ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, rrsets=None, host='127.0.0.1', port=0, latency=0):
+        super().__init__((host, port), StubDNSDBHandler)
+        self.rrsets = rrsets if rrsets is not None else {}
+        # Seconds to wait before answering
+        self.latency = latency
+        self.queries = 0
+        self.lock = threading.Lock()
+
+    @property
+    def url(self):
+        return "http://%s:%d" % self.server_address
+
+class StubDNSDBHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+
+    def do_GET(self):
+        url = urllib.parse.urlsplit(self.path)
+        query = urllib.parse.parse_qs(url.query)
+        with self.server.lock:
+            self.server.queries += 1
+        if self.server.latency:
+            time.sleep(self.server.latency)
+        if not url.path.startswith(_PREFIX) or not url.path.endswith('/A'):
+            return self.reply(400, b"Error: bad request\n")
+        domain = urllib.parse.unquote(url.path[len(_PREFIX):-len('/A')])
+        time_last_after = int(query.get('time_last_after', ['0'])[0])
+        limit = int(query.get('limit', ['0'])[0])
+        lines = []
+        for time_last, rdata in self.server.rrsets.get(domain, []):
+            if time_last < time_last_after:
+                continue
+            lines.append(json.dumps({
+                'count'      : 1,
+                'time_first' : time_last - 86400,
+                'time_last'  : time_last,
+                'rrname'     : domain + '.',
+                'rrtype'     : 'A',
+                'bailiwick'  : domain + '.',
+                'rdata'      : rdata
+            }).encode() + b"\n")
+            if limit and len(lines) >= limit:
+                break
+        if not lines:
+            return self.reply(404, b"Error: no results found for query.\n")
+        self.reply(200, b"".join(lines))
+
+    def reply(self, status, body):
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
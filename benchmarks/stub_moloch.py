@@ -0,0 +1,63 @@
+# A minimal Moloch stand-in for benchmarks.  It answers sessions.json queries
+# whose expression is an OR of "ip==X && host==Y" clauses, from a dict of
+# (ip, host) => list of lastPacket times in milliseconds.  A base_query
+# wrapped around the clauses is ignored.
+#
+#   server = StubMoloch({ ('10.0.0.1', 'evil.com') : [1539964800000] })
+#   threading.Thread(target=server.serve_forever, daemon=True).start()
+
+import http.server
+import json
+import re
+import threading
+import urllib.parse
+
+_CLAUSE = re.compile(r'ip==(\S+) && host==([^\s)]+)')
+
+class StubMoloch(http.server.ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, sessions=None, host='127.0.0.1', port=0):
+        super().__init__((host, port), StubMolochHandler)
+        self.sessions = sessions if sessions is not None else {}
+        self.queries = 0
+        self.lock = threading.Lock()
+
+    @property
+    def url(self):
+        return "http://%s:%d" % self.server_address
+
+class StubMolochHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+
+    def do_GET(self):
+        url = urllib.parse.urlsplit(self.path)
+        query = urllib.parse.parse_qs(url.query)
+        with self.server.lock:
+            self.server.queries += 1
+        start_time = int(query['startTime'][0]) * 1000
+        stop_time = int(query['stopTime'][0]) * 1000
+        packets = []
+        for ip, host in _CLAUSE.findall(query['expression'][0]):
+            packets.extend(
+                packet for packet in self.server.sessions.get((ip, host), [])
+                if start_time <= packet <= stop_time
+            )
+        packets.sort(reverse=True)
+        length = int(query.get('length', ['100'])[0])
+        body = json.dumps({
+            'recordsFiltered' : len(packets),
+            'data' : [
+                { 'id' : 'session%d' % i, 'lastPacket' : packet }
+                for i, packet in enumerate(packets[:length])
+            ]
+        }).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
@@ -0,0 +1,114 @@
+# A minimal Redis stand-in for benchmarks.  It speaks enough of the RESP
+# protocol over TCP for redis-py to GET, MGET, SET, MSET, and SCAN against
+# an in-memory dict, so benchmarks pay for real network round trips without
+# needing a Redis server.  latency adds that many seconds to every reply,
+# like a Redis on another host would.
+#
+#   server = StubRedis()
+#   threading.Thread(target=server.serve_forever, daemon=True).start()
+#   r = redis.StrictRedis(port=server.port)
+
+import fnmatch
+import socketserver
+import time
+
+class StubRedis(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, data=None, host='127.0.0.1', port=0, latency=0):
+        super().__init__((host, port), StubRedisHandler)
+        # Seconds to wait before replying to each command
+        self.latency = latency
+        # bytes => bytes
+        self.data = data if data is not None else {}
+        # Command name => number of times it was called
+        self.commands = {}
+
+    @property
+    def port(self):
+        return self.server_address[1]
+
+class StubRedisHandler(socketserver.StreamRequestHandler):
+    disable_nagle_algorithm = True
+
+    def handle(self):
+        # RESP version, which HELLO can change
+        self.protocol = 2
+        while True:
+            command = self.read_command()
+            if command is None:
+                return
+            name = command[0].upper().decode()
+            self.server.commands[name] = self.server.commands.get(name, 0) + 1
+            handler = getattr(self, 'cmd_' + name.lower(), None)
+            if self.server.latency:
+                time.sleep(self.server.latency)
+            if handler:
+                self.wfile.write(handler(*command[1:]))
+            else:
+                self.wfile.write(b'+OK\r\n')
+            self.wfile.flush()
+
+    # Read one command, sent as an array of bulk strings
+    def read_command(self):
+        line = self.rfile.readline()
+        if not line:
+            return None
+        if not line.startswith(b'*'):
+            return line.split()
+        args = []
+        for i in range(int(line[1:])):
+            length = int(self.rfile.readline()[1:])
+            args.append(self.rfile.read(length + 2)[:-2])
+        return args
+
+    def bulk(self, value):
+        if value is None:
+            return b'_\r\n' if self.protocol == 3 else b'$-1\r\n'
+        return b'$%d\r\n%s\r\n' % (len(value), value)
+
+    def array(self, values):
+        return b'*%d\r\n' % len(values) + b''.join(self.bulk(value) for value in values)
+
+    # redis-py negotiates the protocol version with HELLO.  Agree to
+    # whatever it asks for.  Other than nulls, the replies we send are the
+    # same in RESP2 and RESP3.
+    def cmd_hello(self, version=b'2', *args):
+        self.protocol = int(version)
+        return b'%2\r\n' + self.bulk(b'server') + self.bulk(b'redis') \
+                + self.bulk(b'proto') + b':%d\r\n' % int(version)
+
+    def cmd_ping(self, *args):
+        return b'+PONG\r\n'
+
+    def cmd_get(self, key):
+        return self.bulk(self.server.data.get(key))
+
+    def cmd_mget(self, *keys):
+        return self.array([ self.server.data.get(key) for key in keys ])
+
+    def cmd_set(self, key, value, *args):
+        self.server.data[key] = value
+        return b'+OK\r\n'
+
+    def cmd_mset(self, *args):
+        for i in range(0, len(args), 2):
+            self.server.data[args[i]] = args[i + 1]
+        return b'+OK\r\n'
+
+    def cmd_dbsize(self):
+        return b':%d\r\n' % len(self.server.data)
+
+    # SCAN cursor [MATCH pattern] [COUNT count].  The cursor is an offset into
+    # the sorted keys, which is fine as long as nothing changes mid-scan.
+    def cmd_scan(self, cursor, *args):
+        options = { args[i].upper() : args[i + 1] for i in range(0, len(args) - 1, 2) }
+        pattern = options.get(b'MATCH', b'*').decode()
+        count = int(options.get(b'COUNT', 10))
+        keys = sorted(self.server.data)
+        start = int(cursor)
+        batch = keys[start:start + count]
+        next_cursor = start + count if start + count < len(keys) else 0
+        matched = [ key for key in batch if fnmatch.fnmatchcase(key.decode(), pattern) ]
+        return b'*2\r\n' + self.bulk(str(next_cursor).encode()) + self.array(matched)
@@ -0,0 +1,446 @@
+#!/usr/bin/env python3
+
+# Run the benchmark suite and optionally save the results as JSON, so runs
+# from two commits can be compared with benchmarks/compare.py.
+#
+# Every case works on synthetic data from benchmarks/synthetic.py, so the
+# same arguments give the same inputs on every run.  The network plugins run
+# against local stand-ins for Redis, DNSDB, Moloch, and Carbon Black Response.
+# Each case is timed --repeat times after --warmup untimed runs, on fresh
+# inputs each time, and only the work itself is timed, not building its
+# inputs.
+#
+#   ./benchmarks/suite.py --iocs 2000 -o before.json
+#   git checkout my-branch
+#   ./benchmarks/suite.py --iocs 2000 -o after.json
+#   ./benchmarks/compare.py before.json after.json
+#
+# Pass case names or patterns to run only some of them, e.g. 'event.*'.
+
+import argparse
+import collections
+import contextlib
+import datetime
+import fnmatch
+import io
+import json
+import logging
+import os
+import platform
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import urllib3
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import plugins
+import threatstash.event
+import threatstash.pipeline
+import threatstash.scanner
+import threatstash.warninglist
+import synthetic
+from stub_cbr import StubCBR
+from stub_dnsdb import StubDNSDB
+from stub_moloch import StubMoloch
+from stub_redis import StubRedis
+
+# Version of the results file format
+FORMAT = 1
+
+# setup() builds fresh inputs for one run and returns them as a tuple, and
+# run(*inputs) is the part that's timed.  items is the number of things one
+# run handles, for the time per item.
+Bench = collections.namedtuple('Bench', ['setup', 'run', 'items'])
+
+CASES = []
+
+def case(name):
+    """
+    Register a function that takes a Context and returns a Bench
+    """
+    def register(function):
+        CASES.append((name, function))
+        return function
+    return register
+
+class Context():
+    """
+    The inputs shared by every case, and the stand-in servers, which are
+    started the first time a case asks for them
+    """
+    def __init__(self, args):
+        self.args = args
+        self.counts = synthetic.mix(args.iocs, args.mix)
+        self.corpus = synthetic.Corpus(self.counts, seed=args.seed)
+        self.report = self.corpus.report(defang_rate=args.defang_rate)
+        self.directory = tempfile.mkdtemp(prefix="threatstash-bench-")
+        self.warning_lists = synthetic.write_warning_lists(self.directory, self.corpus,
+                hit_rate=args.hit_rate, lists=args.warning_lists)
+        self._servers = {}
+
+    def event(self, **kwargs):
+        return self.corpus.event(fanout=self.args.fanout, sighting_rate=self.args.sighting_rate, **kwargs)
+
+    def config(self, name, **options):
+        return { 'global' : { 'debug' : False, 'quiet' : True }, name : options }
+
+    def plugin(self, name, **options):
+        plugin = plugins.load(name)(self.config(name, **options))
+        plugin.init()
+        return plugin
+
+    def server(self, name):
+        if name not in self._servers:
+            server = getattr(self, 'start_' + name)()
+            threading.Thread(target=server.serve_forever, daemon=True).start()
+            self._servers[name] = server
+        return self._servers[name]
+
+    def start_redis(self):
+        server = StubRedis()
+        for address, value in synthetic.oil(self.corpus, self.args.hit_rate).items():
+            server.data[('oil:' + address).encode()] = value.encode()
+        return server
+
+    def start_dnsdb(self):
+        return StubDNSDB(synthetic.rrsets(self.corpus, self.args.fanout), latency=self.args.latency)
+
+    def start_moloch(self):
+        # Sessions for hit_rate of the sighted (ip, domain) pairs, shortly
+        # before each Sighting
+        server = StubMoloch()
+        event = self.event()
+        for value in self.corpus.sample('ipv4-addr', self.args.hit_rate, salt=5):
+            observable = event.add_observation('ipv4-addr', value)
+            for sighting in event.sightings_of(observable):
+                last_seen = datetime.datetime.strptime(str(sighting.last_seen)[:19], '%Y-%m-%d %H:%M:%S')
+                last_packet = int(last_seen.replace(tzinfo=datetime.timezone.utc).timestamp() - 60) * 1000
+                for related in event.related_observables(observable):
+                    if related.relationship_type == 'resolved_from':
+                        server.sessions[(value, related.value)] = [ last_packet ]
+        return server
+
+    def start_cbr(self):
+        server = StubCBR(latency=self.args.latency)
+        for value in self.corpus.sample('domain-name', self.args.hit_rate, salt=6):
+            server.processes[('domain', value)] = [ "2018-10-19T17:00:00Z" ]
+        for value in self.corpus.sample('ipv4-addr', self.args.hit_rate, salt=6):
+            server.processes[('ipaddr', value)] = [ "2018-10-19T17:00:00Z" ]
+        for value in self.corpus.sample('md5', self.args.hit_rate, salt=6):
+            server.binaries[value.upper()] = "2018-10-19T17:00:00Z"
+        return server
+
+    def close(self):
+        for server in self._servers.values():
+            server.shutdown()
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+def observables_event(ctx, *types):
+    """
+    Return an Event holding only the corpus's values of types
+    """
+    event = threatstash.event.Event()
+    for ioc_type in types:
+        for value in ctx.corpus.values[ioc_type]:
+            event.add_observation(ioc_type, value, added_by="bench")
+    return event
+
+#########
+# Event #
+#########
+
+@case('event.build')
+def event_build(ctx):
+    return Bench(lambda: (), ctx.event, len(ctx.corpus))
+
+@case('event.query')
+def event_query(ctx):
+    # What a filter or output plugin typically asks of each Observable
+    def run(event):
+        for observable in event.observables:
+            event.sighted(observable.id)
+            event.sightings_of(observable.id)
+            for related in event.related_observables(observable.id):
+                related.relationship_type
+        for ioc_type in synthetic.TYPES:
+            for observable in event.observables_of(ioc_type):
+                observable.value
+    return Bench(lambda: (ctx.event(),), run, len(ctx.corpus))
+
+@case('event.fork-merge')
+def event_fork_merge(ctx):
+    # Fork, add a tenth as many Observables and Sightings as the Event
+    # has, and merge them back
+    added = synthetic.Corpus(synthetic.mix(max(1, len(ctx.corpus) // 10), ctx.args.mix), seed=ctx.args.seed + 1)
+    def run(event):
+        fork = event.fork()
+        for ioc_type in synthetic.TYPES:
+            for value in added.values[ioc_type]:
+                observed_data = fork.add_observation(ioc_type, value, added_by="bench")
+                fork.add_sighting(observed_data, sighted_by="bench")
+        event.merge(fork)
+    return Bench(lambda: (ctx.event(),), run, len(ctx.corpus))
+
+@case('event.stix')
+def event_stix(ctx):
+    # Building STIX 2 objects is slow, so this uses a smaller Event
+    corpus = synthetic.Corpus(synthetic.mix(min(len(ctx.corpus), ctx.args.stix_iocs), ctx.args.mix), seed=ctx.args.seed)
+    return Bench(
+            lambda: (corpus.event(fanout=ctx.args.fanout, sighting_rate=ctx.args.sighting_rate),),
+            lambda event: event.to_bundle(),
+            len(corpus)
+        )
+
+##############
+# Extraction #
+##############
+
+@case('scanner.extract')
+def scanner_extract(ctx):
+    return Bench(lambda: (), lambda: threatstash.scanner.extract(ctx.report), len(ctx.corpus))
+
+@case('filter-freeform')
+def filter_freeform(ctx):
+    plugin = ctx.plugin('filter-freeform')
+    module = sys.modules['filter-freeform']
+    def setup():
+        # Validation results are cached for the life of the process.  Start
+        # cold, like the first Event a process sees.
+        for validator in (module.valid_ipv4, module.valid_url, module.valid_hostname):
+            validator.cache_clear()
+        return (threatstash.event.Event(context=ctx.report),)
+    return Bench(setup, plugin.run, len(ctx.corpus))
+
+#################
+# Warning lists #
+#################
+
+@case('warninglist.compile')
+def warninglist_compile(ctx):
+    # A fresh cache directory each time, so every list is parsed again
+    def setup():
+        cache_dir = tempfile.mkdtemp(dir=ctx.directory)
+        return (threatstash.warninglist.WarningListIndex(ctx.directory, cache_dir),)
+    def run(index):
+        index.load(ctx.warning_lists)
+    return Bench(setup, run, len(ctx.warning_lists))
+
+@case('filter-misp-warning')
+def filter_misp_warning(ctx):
+    plugin = ctx.plugin('filter-misp-warning', warning_list_dir=ctx.directory, warning_lists=ctx.warning_lists)
+    return Bench(
+            lambda: (observables_event(ctx, 'ipv4-addr', 'domain-name'),),
+            plugin.run,
+            ctx.counts.get('ipv4-addr', 0) + ctx.counts.get('domain-name', 0)
+        )
+
+##########
+# Output #
+##########
+
+@case('output-stdout-csv')
+def output_stdout_csv(ctx):
+    plugin = ctx.plugin('output-stdout-csv')
+    def run(event):
+        with contextlib.redirect_stdout(io.StringIO()):
+            plugin.run(event)
+    return Bench(lambda: (ctx.event(),), run, len(ctx.corpus))
+
+#########################
+# Input and the rest    #
+#########################
+
+@case('input-stdin')
+def input_stdin(ctx):
+    plugin = ctx.plugin('input-stdin')
+    def run(event):
+        stdin = sys.stdin
+        sys.stdin = io.StringIO(ctx.report)
+        try:
+            plugin.run(event)
+        finally:
+            sys.stdin = stdin
+    return Bench(lambda: (threatstash.event.Event(),), run, ctx.report.count("\n"))
+
+@case('filter-dummy')
+def filter_dummy(ctx):
+    plugin = ctx.plugin('filter-dummy')
+    return Bench(
+            lambda: (observables_event(ctx, 'domain-name'),),
+            plugin.run,
+            ctx.counts.get('domain-name', 0)
+        )
+
+###################
+# Network plugins #
+###################
+
+@case('filter-oil-redis')
+def filter_oil_redis(ctx):
+    server = ctx.server('redis')
+    plugin = ctx.plugin('filter-oil-redis', server='127.0.0.1', port=server.port, namespace='oil')
+    return Bench(
+            lambda: (observables_event(ctx, 'ipv4-addr'),),
+            plugin.run,
+            ctx.counts.get('ipv4-addr', 0)
+        )
+
+@case('filter-pdns')
+def filter_pdns(ctx):
+    server = ctx.server('dnsdb')
+    plugin = ctx.plugin('filter-pdns', url=server.url, apikey='bench')
+    return Bench(
+            lambda: (observables_event(ctx, 'domain-name'),),
+            plugin.run,
+            ctx.counts.get('domain-name', 0)
+        )
+
+@case('filter-moloch')
+def filter_moloch(ctx):
+    server = ctx.server('moloch')
+    plugin = ctx.plugin('filter-moloch', url=server.url, username='bench', password='bench')
+    def setup():
+        # Don't answer from the previous run's results
+        sys.modules['filter-moloch']._results.clear()
+        return (ctx.event(),)
+    return Bench(setup, plugin.run, ctx.counts.get('ipv4-addr', 0))
+
+@case('filter-carbon-black-response')
+def filter_carbon_black_response(ctx):
+    # The stand-in's certificate is self-signed
+    urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
+    server = ctx.server('cbr')
+    plugin = ctx.plugin('filter-carbon-black-response', url=server.url, token='bench',
+            ssl_verify=False, cache_ttl=0)
+    def setup():
+        sys.modules['filter-carbon-black-response']._results.clear()
+        return (observables_event(ctx, 'ipv4-addr', 'domain-name', 'md5'),)
+    return Bench(setup, plugin.run,
+            sum(ctx.counts.get(ioc_type, 0) for ioc_type in ('ipv4-addr', 'domain-name', 'md5')))
+
+############
+# Pipeline #
+############
+
+@case('pipeline')
+def pipeline(ctx):
+    # Report text in, CSV out, checked against the warning lists
+    config = {
+        'global'  : { 'debug' : False, 'quiet' : True },
+        'plugins' : [
+            { 'name' : 'input-stdin' },
+            { 'name' : 'filter-freeform' },
+            { 'name' : 'filter-misp-warning', 'warning_list_dir' : ctx.directory,
+              'warning_lists' : ctx.warning_lists },
+            { 'name' : 'output-stdout-csv' }
+        ]
+    }
+    def run():
+        stdin = sys.stdin
+        sys.stdin = io.StringIO(ctx.report)
+        try:
+            with contextlib.redirect_stdout(io.StringIO()):
+                pipeline = threatstash.pipeline.Pipeline(config)
+                pipeline.run()
+                pipeline.close()
+        finally:
+            sys.stdin = stdin
+    return Bench(lambda: (), run, len(ctx.corpus))
+
+def measure(bench, repeat, warmup):
+    samples = []
+    for i in range(warmup + repeat):
+        inputs = bench.setup()
+        start = time.perf_counter()
+        bench.run(*inputs)
+        elapsed = time.perf_counter() - start
+        if i >= warmup:
+            samples.append(elapsed)
+    median = statistics.median(samples)
+    return {
+        'items'       : bench.items,
+        'repeat'      : repeat,
+        'samples'     : samples,
+        'min'         : min(samples),
+        'median'      : median,
+        'mean'        : statistics.mean(samples),
+        'stdev'       : statistics.stdev(samples) if len(samples) > 1 else 0.0,
+        'per_item_us' : median / bench.items * 1000000 if bench.items else None
+    }
+
+def git(*args):
+    try:
+        return subprocess.run([ 'git' ] + list(args), cwd=os.path.dirname(os.path.abspath(__file__)),
+                check=True, capture_output=True, text=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def metadata(args):
+    status = git('status', '--porcelain', '--untracked-files=no')
+    return {
+        'commit'    : git('rev-parse', 'HEAD'),
+        'dirty'     : bool(status) if status is not None else None,
+        'python'    : platform.python_version(),
+        'platform'  : platform.platform(),
+        'machine'   : platform.machine(),
+        'cpus'      : os.cpu_count(),
+        'started'   : datetime.datetime.now(datetime.timezone.utc).isoformat(timespec='seconds'),
+        'arguments' : { key : value for key, value in vars(args).items() if key not in ('cases', 'output', 'list') }
+    }
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("cases", help="Names or patterns of the cases to run (default: all)", nargs="*")
+    parser.add_argument("-o", "--output", help="Write the results to this JSON file")
+    parser.add_argument("-l", "--list", help="List the cases and exit", action='store_true')
+    parser.add_argument("--iocs", help="IOCs in the corpus", type=int, default=2000)
+    parser.add_argument("--mix", help="Weight of each IOC type (default: %s)" % synthetic.MIX, default=synthetic.MIX)
+    parser.add_argument("--fanout", help="IPs each domain resolves to", type=int, default=2)
+    parser.add_argument("--sighting-rate", help="Fraction of IPs and hashes with a Sighting", type=float, default=0.5)
+    parser.add_argument("--defang-rate", help="Fraction of IOCs defanged in the report text", type=float, default=0.5)
+    parser.add_argument("--hit-rate", help="Fraction of IOCs the warning lists and stand-ins know about", type=float, default=0.1)
+    parser.add_argument("--warning-lists", help="Hostname and CIDR warning lists each", type=int, default=4)
+    parser.add_argument("--stix-iocs", help="IOCs in the event.stix case", type=int, default=200)
+    parser.add_argument("--latency", help="Seconds the DNSDB and CBR stand-ins take per request", type=float, default=0)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--repeat", help="Timed runs of each case", type=int, default=5)
+    parser.add_argument("--warmup", help="Untimed runs of each case first", type=int, default=1)
+    args = parser.parse_args()
+
+    if args.list:
+        for name, function in CASES:
+            print(name)
+        sys.exit(0)
+    selected = [
+        (name, function) for name, function in CASES
+        if not args.cases or any(fnmatch.fnmatchcase(name, pattern) for pattern in args.cases)
+    ]
+    if not selected:
+        parser.error("No cases match " + " ".join(args.cases))
+
+    # Keep plugins' logging out of the results
+    logging.basicConfig(level=logging.WARNING)
+    results = { 'format' : FORMAT, 'meta' : metadata(args), 'results' : {} }
+    ctx = Context(args)
+    try:
+        print("%-30s %8s %10s %10s %8s %12s" % ("case", "items", "min (s)", "median (s)", "stdev", "us per item"))
+        for name, function in selected:
+            result = measure(function(ctx), args.repeat, args.warmup)
+            results['results'][name] = result
+            print("%-30s %8d %10.4f %10.4f %7.1f%% %12.2f" % (
+                name, result['items'], result['min'], result['median'],
+                result['stdev'] / result['mean'] * 100 if result['mean'] else 0.0,
+                result['per_item_us'] or 0.0))
+    finally:
+        ctx.close()
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+            f.write("\n")
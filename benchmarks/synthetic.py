@@ -0,0 +1,231 @@
+# Synthetic data for benchmarks.  Everything here is generated from a seed,
+# so the same arguments always give the same Events, report text, warning
+# lists, and stand-in data.
+#
+# A Corpus is a pool of IOC values of each type, e.g.
+#
+#   corpus = Corpus(mix(1000, "ipv4-addr=4,domain-name=3,url=1,md5=1,sha256=1"))
+#   event = corpus.event(fanout=3, sighting_rate=0.5)
+#   text = corpus.report(defang_rate=0.5)
+#
+# Each domain resolves to fanout IPs, and each URL is on one of the domains,
+# so the Relationships in an Event look like those filter-pdns and
+# filter-freeform add.
+
+import hashlib
+import json
+import os
+import random
+import time
+
+import threatstash.event
+import threatstash.util
+
+TYPES = ( 'ipv4-addr', 'domain-name', 'url', 'md5', 'sha1', 'sha256' )
+
+# The default type mix, as weights
+MIX = "ipv4-addr=4,domain-name=3,url=1,md5=1,sha1=0.5,sha256=0.5"
+
+_TLDS = ( 'com', 'net', 'org', 'info', 'ru', 'co.uk', 'com.au', 'io' )
+
+_WORDS = (
+    'alpha', 'bravo', 'cdn', 'cloud', 'delta', 'update', 'mail', 'secure',
+    'login', 'portal', 'static', 'files', 'support', 'office', 'payment', 'news'
+)
+
+_SENTENCES = (
+    "The implant beacons to {} every five minutes",
+    "We observed outbound connections to {} from the affected hosts",
+    "The dropper downloads its second stage from {}",
+    "Analysts recovered {} from the compromised workstation",
+    "Phishing emails linked to {} were reported by several users",
+    "The sample with hash {} was submitted to the sandbox",
+    "Traffic to {} was blocked at the proxy",
+    "The actor registered {} shortly before the campaign"
+)
+
+_FILLER = (
+    "No further activity was seen during the investigation window",
+    "The incident was escalated to the on-call responder",
+    "Remediation steps are listed in the appendix",
+    "Affected users were asked to reset their passwords"
+)
+
+# When the Sightings in an Event were last seen, relative to this
+EPOCH = 1539964800
+
+def mix(iocs, weights=MIX):
+    """
+    Split iocs between the IOC types in proportion to weights, a string of
+    type=weight pairs, and return a dict of type => count
+    """
+    parsed = {}
+    for pair in weights.split(','):
+        ioc_type, weight = pair.split('=')
+        ioc_type = ioc_type.strip()
+        if ioc_type not in TYPES:
+            raise ValueError("Unknown IOC type " + ioc_type)
+        parsed[ioc_type] = float(weight)
+    total = sum(parsed.values())
+    return { ioc_type : int(round(iocs * weight / total)) for ioc_type, weight in parsed.items() }
+
+def ip(n):
+    """
+    Return the nth IP.  Consecutive n are spread across the address space
+    rather than packed into one network.
+    """
+    n = (n * 2654435761 + 0x0b000001) & 0xffffffff
+    return "%d.%d.%d.%d" % (n >> 24, n >> 16 & 255, n >> 8 & 255, n & 255)
+
+class Corpus():
+    """
+    A reproducible pool of IOC values
+    """
+    def __init__(self, counts, seed=0):
+        """
+        Parameters
+        ----------
+        counts : dict
+            IOC type => number of values of that type
+        seed : int
+            Seed for the random number generator
+        """
+        self.counts = dict(counts)
+        self.seed = seed
+        rng = random.Random(seed)
+        # Hash the type name along with the seed so the same index gives
+        # different hashes for each type and each seed
+        def digest(name, i):
+            return hashlib.new(name, ("%s:%d:%d" % (name, seed, i)).encode()).hexdigest()
+        self.values = {
+            'ipv4-addr'   : [ ip(i + seed * 1000003) for i in range(counts.get('ipv4-addr', 0)) ],
+            'domain-name' : [
+                "%s%d.%s" % (rng.choice(_WORDS), i, rng.choice(_TLDS))
+                for i in range(counts.get('domain-name', 0))
+            ],
+            'md5'         : [ digest('md5', i) for i in range(counts.get('md5', 0)) ],
+            'sha1'        : [ digest('sha1', i) for i in range(counts.get('sha1', 0)) ],
+            'sha256'      : [ digest('sha256', i) for i in range(counts.get('sha256', 0)) ]
+        }
+        # URLs are on the corpus's domains, or on their own if there aren't
+        # any
+        domains = self.values['domain-name'] or [ "%s.example.com" % word for word in _WORDS ]
+        self.values['url'] = [
+            "%s://%s/%s/%d.php" % (rng.choice(('http', 'https')), rng.choice(domains), rng.choice(_WORDS), i)
+            for i in range(counts.get('url', 0))
+        ]
+
+    def __len__(self):
+        return sum(len(values) for values in self.values.values())
+
+    def url_domain(self, url):
+        return url.split('/')[2]
+
+    def event(self, fanout=2, sighting_rate=0.5, context=None):
+        """
+        Return an Event holding every value in the corpus.  Each domain
+        resolves to the next fanout IPs, round robin, each URL is related to
+        its domain, and sighting_rate of the IPs and hashes have a Sighting.
+        """
+        rng = random.Random(self.seed)
+        event = threatstash.event.Event(context=context)
+        observed = {}
+        for ioc_type in TYPES:
+            for value in self.values[ioc_type]:
+                observed[value] = event.add_observation(ioc_type, value, added_by="bench")
+        ips = self.values['ipv4-addr']
+        if ips and fanout:
+            n = 0
+            for domain in self.values['domain-name']:
+                for i in range(fanout):
+                    address = observed[ips[n % len(ips)]]
+                    n += 1
+                    event.add_relationship(observed[domain], address, "resolved_to")
+                    event.add_relationship(address, observed[domain], "resolved_from")
+        for url in self.values['url']:
+            domain = observed.get(self.url_domain(url))
+            if domain is not None:
+                event.add_relationship(observed[url], domain, "related_to")
+        for ioc_type in ('ipv4-addr', 'md5', 'sha1', 'sha256'):
+            for value in self.values[ioc_type]:
+                if rng.random() < sighting_rate:
+                    last_seen = EPOCH - rng.randrange(7 * 86400)
+                    event.add_sighting(observed[value],
+                            last_seen=time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime(last_seen)),
+                            sighted_by="bench", refs=["bench", value])
+        return event
+
+    def report(self, defang_rate=0.5, filler_rate=0.3):
+        """
+        Return the text of a threat report mentioning every value in the
+        corpus once, in shuffled order.  defang_rate of them are defanged,
+        and filler_rate of the lines mention no IOCs at all.
+        """
+        rng = random.Random(self.seed)
+        iocs = [ value for ioc_type in TYPES for value in self.values[ioc_type] ]
+        rng.shuffle(iocs)
+        lines = []
+        for value in iocs:
+            while rng.random() < filler_rate:
+                lines.append(rng.choice(_FILLER) + ".")
+            if rng.random() < defang_rate:
+                value = threatstash.util.defang(value)
+            lines.append(rng.choice(_SENTENCES).format(value) + ".")
+        return "\n".join(lines) + "\n"
+
+    def sample(self, ioc_type, rate, salt=0):
+        """
+        Return a reproducible sample of rate of the values of one type
+        """
+        rng = random.Random("%d:%s:%d" % (self.seed, ioc_type, salt))
+        return [ value for value in self.values[ioc_type] if rng.random() < rate ]
+
+def write_warning_lists(directory, corpus, hit_rate=0.1, lists=4, padding=1000):
+    """
+    Write MISP warning lists under directory/lists and return their names.
+    Each of the lists of hostnames and CIDRs covers hit_rate of the corpus's
+    domains and IPs, split between lists, plus padding entries that match
+    nothing in it.
+    """
+    names = []
+    rng = random.Random(corpus.seed)
+    hostnames = corpus.sample('domain-name', hit_rate, salt=1)
+    networks = [ "%s/%d" % (address, rng.choice((24, 28, 32))) for address in corpus.sample('ipv4-addr', hit_rate, salt=2) ]
+    for i in range(lists):
+        hostname_entries = hostnames[i::lists] + [ "padding%d-%d.example.net" % (i, j) for j in range(padding) ]
+        network_entries = networks[i::lists] + [ "%s/32" % ip(10 ** 9 + i * padding + j) for j in range(padding) ]
+        for name, list_type, entries in (
+                ("bench-hostnames-%d" % i, "hostname", hostname_entries),
+                ("bench-cidrs-%d" % i, "cidr", network_entries)
+            ):
+            path = os.path.join(directory, "lists", name)
+            os.makedirs(path, exist_ok=True)
+            with open(os.path.join(path, "list.json"), "w") as f:
+                json.dump({ "name" : name, "type" : list_type, "list" : entries }, f)
+            names.append(name)
+    return names
+
+def oil(corpus, hit_rate=0.5):
+    """
+    Return OIL entries for hit_rate of the corpus's IPs, as the
+    namespace-less key => value pairs the Redis stand-in serves
+    """
+    return {
+        address : "/data/nfcapd.2018101916%02d:10.0.0.1:%s:12345:53:UDP" % (i % 60, address)
+        for i, address in enumerate(corpus.sample('ipv4-addr', hit_rate, salt=3))
+    }
+
+def rrsets(corpus, fanout=2, hit_rate=0.8):
+    """
+    Return DNSDB stand-in data: hit_rate of the corpus's domains each resolve
+    to fanout IPs, some of which were last seen years ago
+    """
+    rng = random.Random(corpus.seed)
+    results = {}
+    n = 0
+    for domain in corpus.sample('domain-name', hit_rate, salt=4):
+        results[domain] = []
+        for i in range(fanout):
+            results[domain].append((EPOCH - rng.randrange(3 * 365 * 86400), [ ip(10 ** 8 + n) ]))
+            n += 1
+    return results
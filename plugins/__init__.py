@@ -1,26 +1,122 @@
-# Import everything in this directory that looks like input-*, filter-*, or
-# output-*
-__all__ = []
+# Registry of the plugins in this directory.  Anything that looks like
+# input-*, filter-*, or output-* is a plugin.
+#
+# Plugin metadata (__PLUGIN_NAME__, __PLUGIN_TYPE__, __IOC_TYPES__,
+# __REQUIRED_PARAMETERS__, __READS__, and __WRITES__) is read from the source
+# without importing the module, so we only pay for importing a plugin and its
+# dependencies when a pipeline actually uses it.
+#
+# __READS__ and __WRITES__ list the parts of an Event a plugin looks at and
+# changes: observable types, 'context', 'sightings', and 'relationships'.
+# Revoking an Observable counts as writing its type.  The Pipeline runs
+# plugins side by side when neither needs the other's changes.  A plugin
+# that doesn't declare them is assumed to read and write everything ('*').
+__all__ = [ 'available', 'load', 'import_times' ]
 
-import pkgutil
+import ast
+import importlib.util
 import inspect
+import os
+import sys
+import time
 
-for loader, name, is_pkg in pkgutil.walk_packages(__path__):
-    #print("loader", loader, "name", name, "is_pkg", is_pkg)
-    for pattern in 'input-', 'filter-', 'output-':
-        if name.startswith(pattern):
-            module = loader.find_module(name).load_module(name)
-            #print("\tmodule", module)
-
-            for name, value in inspect.getmembers(module):
-                #print("\t\tname", name, "value", value)
-                if name.startswith('__'):
-                    continue
-
-                #print("\t\t\tname does not start with __")
-                globals()[name] = value
-                #print("\t\t\tglobals()[" + str(name) + "] = " + str(value))
-                __all__.append(name)
-                #print("\t\t\t__all__.append(" + str(name) + ")")
-
-#print("__all__", str(__all__))
+_PATTERNS = ('input-', 'filter-', 'output-')
+
+# Module-level assignments we read from each plugin
+_METADATA = {
+    '__PLUGIN_NAME__'         : 'name',
+    '__PLUGIN_TYPE__'         : 'type',
+    '__IOC_TYPES__'           : 'observable_types',
+    '__REQUIRED_PARAMETERS__' : 'required_parameters',
+    '__READS__'               : 'reads',
+    '__WRITES__'              : 'writes'
+}
+
+# Plugin name => metadata dict
+_registry = None
+
+# Plugin name => plugin class, for plugins that have been imported
+_loaded = {}
+
+# Plugin name => seconds spent importing the plugin module
+import_times = {}
+
+# Read the metadata from a plugin's source
+def _read_metadata(filename):
+    with open(filename) as f:
+        tree = ast.parse(f.read(), filename)
+    metadata = {}
+    for node in tree.body:
+        if not isinstance(node, ast.Assign) or len(node.targets) != 1:
+            continue
+        target = node.targets[0]
+        if isinstance(target, ast.Name) and target.id in _METADATA:
+            try:
+                metadata[_METADATA[target.id]] = ast.literal_eval(node.value)
+            except ValueError:
+                # Not a literal, so we'll find out when the module loads
+                pass
+    return metadata
+
+def available():
+    """
+    Return a dict of plugin name => metadata for every plugin in this
+    directory.  Metadata is a dict with name, type, observable_types,
+    required_parameters, reads, writes, module, and filename keys.
+    """
+    global _registry
+    if _registry is None:
+        registry = {}
+        for filename in sorted(os.listdir(__path__[0])):
+            module, ext = os.path.splitext(filename)
+            if ext != '.py' or not module.startswith(_PATTERNS):
+                continue
+            path = os.path.join(__path__[0], filename)
+            metadata = {
+                'name'                : module,
+                'type'                : None,
+                'observable_types'    : [],
+                'required_parameters' : [],
+                'reads'               : ['*'],
+                'writes'              : ['*'],
+                **_read_metadata(path),
+                'module'              : module,
+                'filename'            : path
+            }
+            registry[metadata['name']] = metadata
+        _registry = registry
+    return _registry
+
+def load(name):
+    """
+    Import a plugin by name and return its plugin class.  Modules are only
+    imported once, and the time spent importing each one is recorded in
+    import_times.
+    """
+    if name in _loaded:
+        return _loaded[name]
+
+    registry = available()
+    if name not in registry:
+        raise KeyError("No such plugin: " + name)
+    metadata = registry[name]
+
+    # Deferred so that reading the registry doesn't import threatstash
+    import threatstash.plugin
+
+    start = time.perf_counter()
+    spec = importlib.util.spec_from_file_location(metadata['module'], metadata['filename'])
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[metadata['module']] = module
+    spec.loader.exec_module(module)
+    import_times[name] = time.perf_counter() - start
+
+    for member_name, value in inspect.getmembers(module, inspect.isclass):
+        if issubclass(value, threatstash.plugin.Plugin) \
+                and value is not threatstash.plugin.Plugin \
+                and value.__module__ == module.__name__:
+            _loaded[name] = value
+            # Keep plugin classes reachable as plugins.<ClassName>
+            globals()[member_name] = value
+            return value
+    raise ImportError("Plugin " + name + " does not define a Plugin class")
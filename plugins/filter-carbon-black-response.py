@@ -1,4 +1,9 @@
+import threading
+import time
+
+import threatstash.cache
 import threatstash.plugin
+import threatstash.ratelimit
 
 # Plugin to query the Carbon Black Response API
 #
@@ -8,68 +13,254 @@ import threatstash.plugin
 # See https://developer.carbonblack.com/reference/enterprise-response/authentication/
 # for information on generating an API key and https://cbapi.readthedocs.io/en/latest/
 # for instructions on how to format the file.
+#
+# Alternatively, set url and token in the plugin config to skip the
+# credentials file.
 
 __PLUGIN_NAME__ = 'filter-carbon-black-response'
 __PLUGIN_TYPE__ = 'filter'
 __IOC_TYPES__ = [ 'domain-name', 'ipv4-addr', 'md5', 'sha256' ]
 __REQUIRED_PARAMETERS__ = [ ]
+__READS__ = [ 'domain-name', 'ipv4-addr', 'md5', 'sha256' ]
+__WRITES__ = [ 'sightings' ]
 
 import cbapi.response as cb
 import cbapi.errors
 
-class CBRFilter(threatstash.plugin.Plugin):
+# Process search field for each Observable type.  Everything else is a
+# binary hash.
+_FIELDS = {
+    'ipv4-addr'   : 'ipaddr',
+    'domain-name' : 'domain'
+}
+
+# Results for each (type, value) we've asked CBR about, kept across Events
+# until they expire.  Keyed by (cbr url, type, value) => (expiration time,
+# result).
+_results = {}
+_results_lock = threading.Lock()
+
+# Returned by lookups that failed or were skipped once the quota ran out, so
+# they're treated as unseen in this Event but not cached as unseen for later
+# ones
+_NO_ANSWER = object()
+
+class CBRFilter(threatstash.plugin.EnrichmentPlugin):
     def __init__(self, config = {}):
         super().__init__(__PLUGIN_NAME__, __PLUGIN_TYPE__, __IOC_TYPES__, __REQUIRED_PARAMETERS__, config)
-        # If we were given a profile use it.  Otherwise use "default."
-        profile = self.config.get('profile', 'default')
+        # Most IPs and domains to OR together into one process query.  This
+        # saves queries when most of them haven't been seen, and costs a few
+        # when most have.  1 queries each one on its own.
+        if 'group_size' not in self.config:
+            self.config['group_size'] = 8
+        # Seconds to reuse a result in later Events
+        if 'cache_ttl' not in self.config:
+            self.config['cache_ttl'] = 3600
+        # Verify the server's TLS certificate when url and token are set
+        if 'ssl_verify' not in self.config:
+            self.config['ssl_verify'] = True
+        # Service in the rate_limits config to draw from
+        if 'rate_limit' not in self.config:
+            self.config['rate_limit'] = 'cbr'
+        self.queries = 0
+        self.binaries = 0
+        self.cached = 0
+        self.failed = 0
+        # Observables not looked up because the quota ran out
+        self.skipped = 0
+        self._lock = threading.Lock()
+        self.cbr = None
+
+    # Connect once the config is complete, so url and token can come from
+    # the plugin list
+    def init(self):
+        super().init()
+        if self.cbr is not None:
+            return
         try:
-            self.cbr = cb.CbResponseAPI(profile=profile)
+            if 'url' in self.config and 'token' in self.config:
+                self.cbr = cb.CbResponseAPI(
+                        url=self.config['url'],
+                        token=self.config['token'],
+                        ssl_verify=self.config['ssl_verify']
+                    )
+            else:
+                # If we were given a profile use it.  Otherwise use "default."
+                profile = self.config.get('profile', 'default')
+                self.cbr = cb.CbResponseAPI(profile=profile)
         except Exception as e:
             self.info(str(e))
 
     def run(self, event):
-        for observable in event.observables:
-            # Observable is an IP?
-            if observable.type == 'ipv4-addr' or observable.type == 'domain-name':
-                # Issue a CB process query
-                query = 'ipaddr:' if observable.type == 'ipv4-addr' else 'domain:'
-                query = query + observable.value
-                processes = self.cbr.select(cb.Process).where(query)
-                count = len(processes)
-                if count > 0:
-                    last_seen = processes.first().last_update
-                    event.add_sighting(
-                        observable.id,
-                        last_seen=last_seen,
-                        sighted_by='cbr',
-                        # The webui link defaults to 0 rows, so we have to
-                        # specify a number here in order to see results in a
-                        # browser
-                        refs=['cbr-url', processes.webui_link + '&rows=10'],
-                        count=count
-                    )
-                    self.debug("sighted", observable.value, "at",
-                            str(last_seen))
+        """
+        Check CBR for sightings of IOCs.  Each (type, value) is only looked up
+        once.  IPs and domains are checked in groups, and binary hashes one at
+        a time, concurrently.
+        """
+        observables = list(self.items(event))
+        results = {}
+        processes = []
+        groups = []
+        for observable in observables:
+            key = (observable.type, observable.value)
+            if key in results:
+                continue
+            results[key] = self.cached_result(key)
+            if results[key] is not threatstash.cache.MISS:
+                continue
+            if observable.type in _FIELDS:
+                processes.append(key)
             else:
-                # This observable is a file hash
+                groups.append([ key ])
+        group_size = max(1, int(self.config['group_size']))
+        for i in range(0, len(processes), group_size):
+            groups.append(processes[i:i + group_size])
+
+        for group_results in self.lookup_all(groups):
+            results.update(group_results)
+        for observable in observables:
+            self.apply(event, observable, results[(observable.type, observable.value)])
+        return event
+
+    def finish(self):
+        self.info("Sent %d process queries and %d binary lookups, %d answered "
+                "from the cache, %d failed, %d skipped" % (
+                self.queries, self.binaries, self.cached, self.failed, self.skipped))
+
+    def cached_result(self, key):
+        with _results_lock:
+            expires, result = _results.get(self.cache_key(key), (0, None))
+        if expires < time.time():
+            return threatstash.cache.MISS
+        with self._lock:
+            self.cached += 1
+        return result
+
+    def cache_key(self, key):
+        return (self.cbr.url,) + key
+
+    def lookup(self, group):
+        """
+        Look up a group of (type, value) keys and return a dict of key =>
+        Sighting keyword arguments, or None for the ones CBR hasn't seen or
+        couldn't be looked up.  Only answers from CBR are cached.
+        """
+        results = {}
+        if group[0][0] in _FIELDS:
+            self.check_group(group, results)
+        else:
+            results[group[0]] = self.binary(group[0][1])
+        expires = time.time() + self.config['cache_ttl']
+        with _results_lock:
+            for key, result in results.items():
+                if result is not _NO_ANSWER:
+                    _results[self.cache_key(key)] = (expires, result)
+        return {
+            key : None if result is _NO_ANSWER else result
+            for key, result in results.items()
+        }
+
+    def check_group(self, group, results):
+        """
+        Query for processes matching any of a group of IPs and domains.  Most
+        haven't been seen, so usually that's the only query we need.  If there
+        are processes, the group is split in half and each half checked the
+        same way, down to single Observables.
+        """
+        query = " OR ".join(_FIELDS[type] + ':' + value for type, value in group)
+        try:
+            processes, first, count = self.process_query(query)
+        except threatstash.ratelimit.QuotaExceeded as e:
+            self.debug(str(e) + ", skipping", query)
+            with self._lock:
+                self.skipped += len(group)
+            for key in group:
+                results[key] = _NO_ANSWER
+            return
+        except Exception as e:
+            # Skip the group rather than fail the whole run, like binary()
+            self.info("Process query failed, skipping %d observables: %s" % (len(group), repr(e)))
+            with self._lock:
+                self.failed += len(group)
+            for key in group:
+                results[key] = _NO_ANSWER
+            return
+        if count == 0:
+            for key in group:
+                results[key] = None
+            return
+        if len(group) == 1:
+            self.debug(group[0][1], "seen in", str(count), "processes")
+            results[group[0]] = {
+                'last_seen' : first.last_update,
+                # The webui link defaults to 0 rows, so we have to
+                # specify a number here in order to see results in a
+                # browser
+                'refs'      : ['cbr-url', processes.webui_link + '&rows=10'],
+                'count'     : count
+            }
+            return
+        middle = len(group) // 2
+        self.check_group(group[:middle], results)
+        self.check_group(group[middle:], results)
+
+    def process_query(self, query):
+        """
+        Return the Query, its most recently updated process, and the number
+        of processes matching query
+        """
+        self.acquire()
+        with self._lock:
+            self.queries += 1
+        processes = self.cbr.select(cb.Process).where(query)
+        # Fetching the first row also fills in the total, so len() doesn't
+        # need a query of its own
+        with self.external_call():
+            first = processes.first()
+        return processes, first, len(processes)
+
+    def binary(self, value):
+        try:
+            self.acquire()
+        except threatstash.ratelimit.QuotaExceeded as e:
+            self.debug(str(e) + ", skipping", value)
+            with self._lock:
+                self.skipped += 1
+            return _NO_ANSWER
+        with self._lock:
+            self.binaries += 1
+        try:
+            binary = self.cbr.select(cb.Binary, value)
+            # Binaries are fetched the first time an attribute is read.  Not
+            # found is an answer, not a failed call.
+            with self.external_call():
                 try:
-                    binary = self.cbr.select(cb.Binary, observable.value)
-                    event.add_sighting(
-                        observable.id,
-                        last_seen=binary.last_seen,
-                        sighted_by='cbr',
-                        refs=['cbr-url', binary.webui_link]
-                    )
-                    self.debug("sighted", observable.value, "at",
-                            binary.last_seen)
+                    last_seen = binary.last_seen
                 except cbapi.errors.ObjectNotFoundError as e:
-                    self.debug(observable.value, "not found")
-                    continue
-                except Exception as e:
-                    self.debug(
-                        "Unable to retrieve binary information from CBR"
-                    )
-                    self.debug(repr(e))
-                    continue
+                    last_seen = None
+            if last_seen is None:
+                self.debug(value, "not found")
+                return None
+            return {
+                'last_seen' : last_seen,
+                'refs'      : ['cbr-url', binary.webui_link]
+            }
+        except Exception as e:
+            self.debug(
+                "Unable to retrieve binary information from CBR"
+            )
+            self.debug(repr(e))
+            with self._lock:
+                self.failed += 1
+        return _NO_ANSWER
 
-        return event
+    def apply(self, event, observable, sighting):
+        if sighting is None:
+            return
+        event.add_sighting(
+            observable.id,
+            sighted_by='cbr',
+            **sighting
+        )
+        self.debug("sighted", observable.value, "at",
+                str(sighting['last_seen']))
@@ -6,17 +6,18 @@ __PLUGIN_NAME__ = 'filter-dummy'
 __PLUGIN_TYPE__ = 'filter'
 __IOC_TYPES__ = [ 'domain-name' ]
 __REQUIRED_PARAMETERS__ = [ ]
+__READS__ = [ 'domain-name' ]
+__WRITES__ = [ 'ipv4-addr', 'relationships' ]
 
 class Dummy(threatstash.plugin.Plugin):
     def __init__(self, config = {}):
         super().__init__(__PLUGIN_NAME__, __PLUGIN_TYPE__, __IOC_TYPES__, __REQUIRED_PARAMETERS__, config)
 
     def run(self, event):
-        for observable in event.observables:
-            if observable.type == "domain-name":
-                self.debug("Adding relationship:", observable.value, "resolves_to 1.2.3.4")
-                new_observed_data = event.add_observation("ipv4-addr",
-                        "1.2.3.4", added_by=__PLUGIN_NAME__)
-                event.add_relationship(observable.id, new_observed_data,
-                        "resolves_to")
+        for observable in event.observables_of('domain-name'):
+            self.debug("Adding relationship:", observable.value, "resolves_to 1.2.3.4")
+            new_observed_data = event.add_observation("ipv4-addr",
+                    "1.2.3.4", added_by=__PLUGIN_NAME__)
+            event.add_relationship(observable.id, new_observed_data,
+                    "resolves_to")
         return event
@@ -1,10 +1,11 @@
+import concurrent.futures
+import functools
 import re
 import validators
 
-from tld import get_tld, get_fld
-
 import threatstash.plugin
-import threatstash.util
+import threatstash.publicsuffix
+import threatstash.scanner
 
 # Extract IOCs from freeform text
 
@@ -12,12 +13,74 @@ __PLUGIN_NAME__ = 'filter-freeform'
 __PLUGIN_TYPE__ = 'filter'
 __IOC_TYPES__ = [ 'context' ]
 __REQUIRED_PARAMETERS__ = [ ]
+__READS__ = [ 'context' ]
+__WRITES__ = [ 'ipv4-addr', 'url', 'domain-name', 'md5', 'sha1', 'sha256', 'relationships' ]
+
+# Pull the hostname out of a URL
+_URL_HOSTNAME = re.compile(r'https?://([^/:]+)[/:]')
+
+# The same IOCs turn up over and over again across events, so validation
+# results are cached for the life of the process.  Each cache holds this
+# many entries, dropping the least recently used.
+_CACHE_SIZE = 65536
+
+@functools.lru_cache(maxsize=_CACHE_SIZE)
+def valid_ipv4(ip):
+    return bool(validators.ipv4(ip))
+
+@functools.lru_cache(maxsize=_CACHE_SIZE)
+def valid_url(url):
+    return bool(validators.url(url))
+
+# Hostnames must be valid and end in a public suffix
+@functools.lru_cache(maxsize=_CACHE_SIZE)
+def valid_hostname(hostname):
+    return bool(validators.domain(hostname)) \
+            and threatstash.publicsuffix.fld(hostname) is not None
+
+def cache_info():
+    """
+    Return a dict of validator name => functools cache statistics
+    """
+    return {
+        'ipv4'     : valid_ipv4.cache_info(),
+        'url'      : valid_url.cache_info(),
+        'hostname' : valid_hostname.cache_info()
+    }
 
 class IOCExtractor(threatstash.plugin.Plugin):
     def __init__(self, config = {}):
         super().__init__(__PLUGIN_NAME__, __PLUGIN_TYPE__, __IOC_TYPES__, __REQUIRED_PARAMETERS__, config)
+        # Context larger than chunk_size characters is split into chunks on
+        # line boundaries and extracted by a pool of worker processes.  Set
+        # workers to 1 to extract everything in this process.
+        if 'workers' not in self.config:
+            self.config['workers'] = 1
+        if 'chunk_size' not in self.config:
+            self.config['chunk_size'] = 1048576
+        self._pool = None
+
+    # Start the worker processes the first time we need them and keep them
+    # for later events
+    def pool(self):
+        if self._pool is None:
+            self._pool = concurrent.futures.ProcessPoolExecutor(
+                    max_workers=self.config['workers']
+                )
+        return self._pool
+
+    # Stop the worker processes before the interpreter starts tearing down
+    def finish(self):
+        if self._pool is not None:
+            self._pool.shutdown()
+            self._pool = None
 
     def run(self, event):
+        # Nothing to do if the context hasn't changed since we last saw it
+        watermark = self.watermark(event)
+        if watermark is not None and watermark >= event.context_sequence:
+            return event
+
         # Some dicts to avoid duplication of IOCs
         ips       = {}
         urls      = {}
@@ -31,59 +94,34 @@ class IOCExtractor(threatstash.plugin.Plugin):
 #            if observable.type == "text":
 #                text = text + "\n" + observable.value
 
-        for line in text.split("\n"):
-            self.debug("Line: " + line)
-            # Strip leading/trailing whitespace
-            line = line.strip()
-
-            #####################
-            # Refang indicators #
-            #####################
-            line = threatstash.util.refang(line)
-
-            ######################
-            # Extract indicators #
-            ######################
-
-            # Extract IPs
-            for ip in re.findall(r'\d{1,3}\.\d{1,3}\.\d{1,3}\.\d{1,3}', line):
-                ips[ip] = True
-                self.debug("IP: " + ip)
-
-            # Extract URLs
-            if re.search(r'https?://', line):
-                # http://blah.com/blah
-                for url in re.findall(r'https?://\S+', line):
-                    urls[url] = True
-                    self.debug("URL: " + url)
-            else:
-                # blah.com/blah
-                for url in re.findall(r'[a-zA-Z0-9-\.]+\.[a-zA-Z]{2,}/\S+', line):
-                    url = 'http://' + url
-                    urls[url] = True
-                    self.debug("URL2: " + url)
-
-            # Extract hostnames
-            for hostname in re.findall(r'[a-zA-Z0-9-\.]+\.[a-zA-Z]{2,}', line):
-                self.debug("Hostname: " + hostname)
-                hostnames[hostname] = True
-
-            # Extract hashes
-            # SHA256
-            for hash in re.findall(r'\b[a-fA-F0-9]{64}\b', line):
-                hashes[hash] = True
-            # SHA1
-            for hash in re.findall(r'\b[a-fA-F0-9]{40}\b', line):
-                hashes[hash] = True
-            # MD5
-            for hash in re.findall(r'\b[a-fA-F0-9]{32}\b', line):
-                hashes[hash] = True
+        #################################
+        # Refang and extract indicators #
+        #################################
+        found = {
+            'ipv4-addr'   : ips,
+            'url'         : urls,
+            'domain-name' : hostnames,
+            'md5'         : hashes,
+            'sha1'        : hashes,
+            'sha256'      : hashes
+        }
+        if self.config['workers'] > 1 and len(text) > self.config['chunk_size']:
+            extracted = threatstash.scanner.extract_parallel(
+                    text,
+                    self.pool(),
+                    self.config['chunk_size']
+                )
+        else:
+            extracted = threatstash.scanner.extract(text)
+        for ioc_type, value in extracted:
+            found[ioc_type][value] = True
+        self.debug("Extracted", str(len(ips)), "IPs,", str(len(urls)), "URLs,",
+                str(len(hostnames)), "hostnames, and", str(len(hashes)), "hashes")
 
         # Validate and return the data
-        iocs = []
         self.debug("IPs: " + str(ips))
         for ip in ips.keys():
-            if validators.ipv4(ip):
+            if valid_ipv4(ip):
                 self.debug("Appending IP: " + ip)
                 event.add_observation("ipv4-addr", ip, added_by=__PLUGIN_NAME__)
             else:
@@ -91,16 +129,13 @@ class IOCExtractor(threatstash.plugin.Plugin):
         
         derived_from = {}
         for url in urls.keys():
-            tld = get_tld(url, fail_silently=True)
-            fld = get_fld(url, fail_silently=True)
-            if not validators.url(url):
-            #or not tld or not fld:
+            if not valid_url(url):
                 self.debug("Invalid URL: " + url)
                 continue
             else:
                 observed_url = event.add_observation("url", url, added_by=__PLUGIN_NAME__)
                 # Extract hostname from URL
-                m = re.search(r'https?://([^/:]+)[/:]', url)
+                m = _URL_HOSTNAME.search(url)
                 if m:
                     hostname = m.group(1)
                     hostname = hostname.lower()
@@ -112,9 +147,7 @@ class IOCExtractor(threatstash.plugin.Plugin):
 
         for hostname in hostnames.keys():
             hostname = hostname.lower()
-            tld = get_tld(hostname, fail_silently=True, fix_protocol=True)
-            fld = get_fld(hostname, fail_silently=True, fix_protocol=True)
-            if not validators.domain(hostname) or not tld or not fld:
+            if not valid_hostname(hostname):
                 self.debug("Invalid Hostname: " + hostname)
                 continue
             else:
@@ -138,4 +171,7 @@ class IOCExtractor(threatstash.plugin.Plugin):
             elif len(hash) == 64:
                 event.add_observation("sha256", hash, added_by=__PLUGIN_NAME__)
 
+        for name, info in cache_info().items():
+            self.debug("Validation cache (%s): %d hits, %d misses, %d entries" % (
+                    name, info.hits, info.misses, info.currsize))
         return event
@@ -1,9 +1,6 @@
-import json
-import os
-import SubnetTree
-from tld import get_tld, get_fld
-
 import threatstash.plugin
+import threatstash.publicsuffix
+import threatstash.warninglist
 
 # git clone https://github.com/MISP/misp-warninglists
 
@@ -11,76 +8,98 @@ __PLUGIN_NAME__ = 'filter-misp-warning'
 __PLUGIN_TYPE__ = 'filter'
 __IOC_TYPES__ = [
     'ipv4-addr',
+    'ipv6-addr',
     'domain-name'
 ]
 __REQUIRED_PARAMETERS__ = [
     'warning_list_dir',
     'warning_lists'
 ]
+__READS__ = [ 'ipv4-addr', 'ipv6-addr', 'domain-name' ]
+__WRITES__ = [ 'ipv4-addr', 'ipv6-addr', 'domain-name', 'sightings' ]
 
 class MISPWarning(threatstash.plugin.Plugin):
     def __init__(self, config = {}):
         super().__init__(__PLUGIN_NAME__, __PLUGIN_TYPE__, __IOC_TYPES__, __REQUIRED_PARAMETERS__, config)
-        self.lists = []
+        self.lists = {}
         if "revoke" not in self.config:
             self.config["revoke"] = False
 
     def init(self):
         super().init()
         # Load the warning lists.  We don't do this in __init__ because we
-        # haven't received our configuration yet.
-        for warning_list in self.config["warning_lists"]:
-            filename = os.path.join(self.config["warning_list_dir"], "lists", warning_list, "list.json")
-            with open(filename) as f:
-                data = json.load(f)
-                if data["type"] == "cidr":
-                    entries = SubnetTree.SubnetTree()
-                else:
-                    entries = {}
-                for entry in data["list"]:
-                    entry = entry.lower()
-                    entries[entry] = True
-                self.lists.append({
-                        "name"    : data["name"],
-                        "type"    : data["type"],
-                        "entries" : entries
-                    })
-                self.debug("Loaded warning list", data["name"])
+        # haven't received our configuration yet.  The compiled lists are
+        # shared with every other instance of this plugin, and are only
+        # parsed again if a list.json changes.
+        self.index = threatstash.warninglist.index(
+                self.config["warning_list_dir"],
+                self.config.get("cache_dir")
+            )
+        self.lists = {}
+        for name, warning_list in zip(self.config["warning_lists"],
+                self.index.load(self.config["warning_lists"])):
+            self.lists[name] = warning_list
+            self.debug("Loaded warning list", warning_list.name)
 
     def run(self, event):
         """
         Check IOCs against MISP Warning Lists
         git clone https://github.com/MISP/misp-warninglists
         """
-        # Iterate across Observables
-        for observable in event.observables:
-            for warning_list in self.lists:
-                self.debug("Checking", observable.value, "against", warning_list["name"])
+        return self.run_many([event])[0]
+
+    def run_many(self, events):
+        """
+        Check the IOCs from a batch of Events against MISP Warning Lists.  The
+        IPs from every Event are checked against the CIDR lists in a single
+        vectorized lookup.
+        """
+        # The matcher is shared by every instance of this plugin, so it may
+        # know about lists we weren't configured to check.
+        matcher = self.index.matcher
+
+        # (event, observable) pairs for every Observable we handle and
+        # haven't already checked
+        observables = []
+        for event in events:
+            for observable in self.new_observables(event, *self.observable_types):
+                observables.append((event, observable))
+
+        # Check all the IPs against the CIDR lists at once
+        ips = [
+            observable.value for event, observable in observables
+            if observable.type == "ipv4-addr" or observable.type == "ipv6-addr"
+        ]
+        cidr_hits = iter(matcher.match_ips(ips))
+
+        for event, observable in observables:
+            # If we have a domain name, also match the parents of the
+            # hostname down to its FLD.  E.g. for a.b.evil.co.uk, check
+            # b.evil.co.uk and evil.co.uk but not co.uk.
+            min_depth = None
+            if observable.type == "domain-name":
+                fld = threatstash.publicsuffix.fld(observable.value)
+                if fld:
+                    min_depth = fld.count('.') + 1
 
-                # Only check IPs against CIDR lists.  SubnetTree throws an
-                # exception if you test a non-IP against it.
-                if warning_list["type"] == "cidr" and observable.type != "ip4-addr" and observable.type != "ip6-addr":
-                    continue
+            hits = matcher.match(observable.value, min_depth=min_depth)
+            if observable.type == "ipv4-addr" or observable.type == "ipv6-addr":
+                hits.update(next(cidr_hits))
 
-                # If we have a domain name, extract its FLD.  E.g. for
-                # foo.bar.com, also test bar.com and for foo.bar.co.uk, also
-                # check bar.co.uk.
-                fld = ""
-                if observable.type == "domain-name":
-                    # get_fld chokes if you feed it a hostname instead of a URL
-                    fld = get_fld("http://" + observable.value, fail_silently=True)
-                elif observable.type == "url":
-                    fld = get_fld(observable.value, fail_silently=True)
+            # Report hits in the order our lists were configured
+            names = [ self.lists[key].name for key in self.lists if key in hits ]
+            if not names:
+                continue
 
-                if observable.value in warning_list["entries"] or fld in warning_list["entries"]:
-                    self.debug("Sighted", observable.value, "in", warning_list["name"])
-                    event.add_sighting(
-                            observable.id,
-                            sighted_by="misp-warning",
-                            refs=["warning-list", warning_list["name"]]
-                        )
-                    if self.config["revoke"]:
-                        event.revoke(observable.id)
-                    # Stop after our first match
-                    break
-        return event
+            self.debug("Sighted", observable.value, "in", ", ".join(names))
+            refs = []
+            for name in names:
+                refs.extend(["warning-list", name])
+            event.add_sighting(
+                    observable.id,
+                    sighted_by="misp-warning",
+                    refs=refs
+                )
+            if self.config["revoke"]:
+                event.revoke(observable.id)
+        return events
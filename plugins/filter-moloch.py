@@ -1,11 +1,12 @@
 import datetime
 import dateutil.parser
-import json
-import logging
 import requests
+import threading
+import time
 import urllib
 
 import threatstash.plugin
+import threatstash.ratelimit
 
 __PLUGIN_NAME__ = 'filter-moloch'
 __PLUGIN_TYPE__ = 'filter'
@@ -17,86 +18,249 @@ __REQUIRED_PARAMETERS__ = [
     'username',
     'password'
 ]
+__READS__ = [ 'ipv4-addr', 'domain-name', 'sightings', 'relationships' ]
+__WRITES__ = [ 'sightings' ]
 
-class MolochAPI(threatstash.plugin.Plugin):
+# Results for each (ip, host, day) we've asked Moloch about, kept for the life
+# of the process.  Keyed by (moloch url, base query, ip, host, day start
+# time).  Days that haven't ended yet aren't cached, since Moloch may still
+# see sessions for them.
+_results = {}
+_results_lock = threading.Lock()
+
+# What a query with no matching sessions returns
+_NO_SESSIONS = { 'recordsFiltered' : 0, 'data' : [] }
+
+# Stands in for the results of queries that failed or were skipped once the
+# quota ran out, so they aren't cached
+_NO_ANSWER = object()
+
+class MolochAPI(threatstash.plugin.EnrichmentPlugin):
     def __init__(self, config = {}):
         super().__init__(__PLUGIN_NAME__, __PLUGIN_TYPE__, __IOC_TYPES__, __REQUIRED_PARAMETERS__, config)
         # Verify TLS certificate by default
         if 'verify' not in self.config:
             self.config['verify'] = True
+        # Most ip==X && host==Y clauses to OR together into one query.  This
+        # saves queries when most pairs have no sessions, and costs a few
+        # when most do.  1 queries every pair on its own.
+        if 'group_size' not in self.config:
+            self.config['group_size'] = 8
+        # Service in the rate_limits config to draw from
+        if 'rate_limit' not in self.config:
+            self.config['rate_limit'] = 'moloch'
+        self.queries = 0
+        self.pairs = 0
+        self.cached = 0
+        # Pairs not checked because the quota ran out, and pairs whose query
+        # failed
+        self.skipped = 0
+        self.failed = 0
+        self._lock = threading.Lock()
+
+    def items(self, event):
+        """
+        Return a (observable, related_observable, sighting) tuple for each
+        Moloch query to make.  If we've run on this Event before, only
+        Sightings and resolved_from Relationships added since then count.
+        """
+        items = []
+        new_sightings = None
+        if self.watermark(event) is not None:
+            sightings = self.new_sightings(event)
+            new_sightings = { sighting.id for sighting in sightings }
+            new_pairs = {
+                (r.source_ref, r.target_ref) for r in self.new_relationships(event)
+                if r.relationship_type == 'resolved_from'
+            }
+            # The IPs those are about
+            changed = { sighting.sighting_of_ref for sighting in sightings }
+            changed.update(source for source, target in new_pairs)
+        # Don't query Sightings that are older than our Moloch retention
+        minimum_last_seen = None
+        if 'max_age' in self.config:
+            minimum_last_seen = datetime.datetime.now(datetime.timezone.utc) \
+                    - datetime.timedelta(days=self.config['max_age'])
+        # Iterate across the ipv4-addr Observables
+        for observable in event.observables_of('ipv4-addr'):
+            if new_sightings is not None and observable.id not in changed:
+                continue
+            # Has this Observable been sighted?  If even the latest Sighting
+            # is too old, none of them are worth a query.
+            summary = event.sighting_summary(observable.id)
+            if summary is None:
+                continue
+            if minimum_last_seen is not None and summary.last_seen is not None \
+                    and summary.last_seen < minimum_last_seen:
+                self.debug(observable.value, "was last sighted at",
+                        str(summary.last_seen), "which is older than",
+                        str(self.config['max_age']), "days")
+                continue
+            for sighting in event.sightings_of(observable.id):
+                self.debug(observable.value, "was sighted at", str(sighting.last_seen), "by", sighting.sighted_by)
+                # Check the Relationships for the ObservedData and see if
+                # it was resolved from a domain-name indicator
+                for related_observable in event.related_observables(observable.id):
+                    if related_observable.relationship_type == 'resolved_from':
+                        # Skip pairs we checked last time
+                        if new_sightings is not None \
+                                and sighting.id not in new_sightings \
+                                and (observable.id, related_observable.id) not in new_pairs:
+                            continue
+                        self.debug(observable.value, 'resolved_from', related_observable.value)
+
+                        if minimum_last_seen is not None \
+                                and sighting.last_seen is not None \
+                                and sighting.last_seen < minimum_last_seen:
+                            self.debug("Sighting timestamp",
+                                    str(sighting.last_seen),
+                                    "is older than",
+                                    str(self.config['max_age']),
+                                    "days")
+                            continue
+                        items.append((observable, related_observable, sighting))
+        return items
 
     def run(self, event):
         """
-        Check the Moloch for sightings of IOCs
+        Check the Moloch for sightings of IOCs.  Each (ip, host, day) is only
+        queried once, and the pairs for each day are checked in groups.
         """
-        # Iterate across STIX ObservedData objects
-        for observable in event.observables:
-            if observable.type == 'ipv4-addr':
-                # Has this Observable been sighted?
-                for sighting in event.sightings_of(observable.id):
-                    self.debug(observable.value, "was sighted at", str(sighting.last_seen), "by", sighting.sighted_by)
-                    # Check the Relationships for the ObservedData and see if
-                    # it was resolved from a domain-name indicator
-                    for related_observable in event.related_observables(observable.id):
-                        if related_observable.relationship_type == 'resolved_from':
-                            self.debug(observable.value, 'resolved_from', related_observable.value)
-#                                self.debug(
-#                                        "checking Moloch for ip==%s && host==%s at %s" % (
-#                                            observable.value,
-#                                            related_observable.value,
-#                                            str(sighting.last_seen))
-#                                        )
-
-                            # Don't query Sightings that are older than our
-                            # Moloch retention
-                            if 'max_age' in self.config:
-                                # Find the time max_age days ago
-                                minimum_timestamp = datetime.datetime.now().timestamp() - self.config['max_age'] * 86400
-                                sighting_timestamp = dateutil.parser.parse(
-                                            str(sighting.last_seen)
-                                        ).timestamp()
-                                if sighting_timestamp < minimum_timestamp:
-                                    self.debug("Sighting timestamp",
-                                            str(sighting.last_seen),
-                                            "is older than",
-                                            str(self.config['max_age']),
-                                            "days")
-                                    continue
-
-                            # Check Moloch for both the IP and the domain
-                            # name it was resolved from
-                            expression = "ip==%s && host==%s" % (
-                                    observable.value,
-                                    related_observable.value
-                                )
-                            sessions, url = self.moloch_query(
-                                    expression,
-                                    timestamp=str(sighting.last_seen)
-                                )
-                            #self.debug("Moloch found", str(sessions['recordsFiltered']), "sessions")
-                            if sessions['recordsFiltered'] > 0:
-                                # Unix timestamp of the last packet of the first session
-                                last_seen = sessions['data'][0]['lastPacket'] / 1000
-                                # Convert to ISO8601
-                                last_seen = datetime.datetime.fromtimestamp(
-                                        last_seen,
-                                        dateutil.tz.tzutc()
-                                    ).isoformat()
-                                session_id = sessions['data'][0]['id']
-                                event.add_sighting(
-                                        related_observable.id,
-                                        last_seen=last_seen,
-                                        sighted_by='moloch',
-                                        #refs=['moloch-url', url, 'moloch-session', session_id]
-                                        refs=['moloch-url', url],
-                                        count=sessions['recordsFiltered']
-                                    )
-                                self.debug("sighted", observable.value, "+",
-                                        related_observable.value, "at",
-                                        last_seen)
+        items = list(self.items(event))
+        # (ip, host, start time, stop time) for each item
+        keys = [ self.key(item) for item in items ]
+
+        # Group the pairs we haven't already got results for by day
+        results = {}
+        days = {}
+        for key in keys:
+            if key in results:
+                continue
+            results[key] = self.cached_result(key)
+            if results[key] is None:
+                ip, host, start_time, stop_time = key
+                days.setdefault((start_time, stop_time), []).append(key)
+        groups = []
+        group_size = max(1, int(self.config['group_size']))
+        for day, day_keys in days.items():
+            for i in range(0, len(day_keys), group_size):
+                groups.append(day_keys[i:i + group_size])
+
+        for group_results in self.lookup_all(groups):
+            results.update(group_results)
+        for item, key in zip(items, keys):
+            self.apply(event, item, results[key])
         return event
 
-    def moloch_query(self, expression, timestamp):
+    def finish(self):
+        self.info("Checked %d (ip, host, day) pairs with %d queries, %d from the cache, %d skipped, %d failed" % (
+                self.pairs, self.queries, self.cached, self.skipped, self.failed))
+
+    # Return the (ip, host, start time, stop time) to query for an item
+    def key(self, item):
+        observable, related_observable, sighting = item
+        start_time, stop_time = self.day(str(sighting.last_seen))
+        return (observable.value, related_observable.value, start_time, stop_time)
+
+    def cached_result(self, key):
+        with _results_lock:
+            result = _results.get(self.cache_key(key))
+        if result is not None:
+            with self._lock:
+                self.cached += 1
+        return result
+
+    def cache_key(self, key):
+        return (self.config['url'], self.config.get('base_query')) + key[:3]
+
+    def lookup(self, group):
+        """
+        Look up a group of (ip, host, start time, stop time) keys from the
+        same day and return a dict of key => (sessions, url).
+
+        The whole group is queried at once.  Most pairs have no sessions, so
+        usually that's the only query we need.  If there are sessions, the
+        group is split in half and each half checked the same way, down to
+        single pairs.
+        """
+        with self._lock:
+            self.pairs += len(group)
+        results = {}
+        self.check_group(group, results)
+        now = time.time()
+        with _results_lock:
+            for key, result in results.items():
+                if key[3] < now and result is not _NO_ANSWER:
+                    _results[self.cache_key(key)] = result
+        return {
+            key : (_NO_SESSIONS, None) if result is _NO_ANSWER else result
+            for key, result in results.items()
+        }
+
+    def check_group(self, group, results):
+        start_time, stop_time = group[0][2:]
+        expressions = [ "ip==%s && host==%s" % (ip, host) for ip, host, start, stop in group ]
+        if len(group) == 1:
+            expression = expressions[0]
+        else:
+            expression = " || ".join("(%s)" % clause for clause in expressions)
+        try:
+            sessions, url = self.moloch_query(expression, start_time, stop_time)
+        except threatstash.ratelimit.QuotaExceeded as e:
+            self.debug(str(e) + ", skipping", expression)
+            with self._lock:
+                self.skipped += len(group)
+            for key in group:
+                results[key] = _NO_ANSWER
+            return
+        except (requests.RequestException, ValueError) as e:
+            # The HTTP client hands back the last response once it runs out
+            # of retries.  Skip the group rather than fail the whole run.
+            self.info("Moloch query failed, skipping %d pairs: %s" % (len(group), e))
+            with self._lock:
+                self.failed += len(group)
+            for key in group:
+                results[key] = _NO_ANSWER
+            return
+        if len(group) == 1:
+            results[group[0]] = (sessions, url)
+            return
+        if sessions['recordsFiltered'] == 0:
+            for key in group:
+                results[key] = (_NO_SESSIONS, None)
+            return
+        middle = len(group) // 2
+        self.check_group(group[:middle], results)
+        self.check_group(group[middle:], results)
+
+    def apply(self, event, item, result):
+        observable, related_observable, sighting = item
+        sessions, url = result
+        #self.debug("Moloch found", str(sessions['recordsFiltered']), "sessions")
+        if sessions['recordsFiltered'] > 0:
+            # Unix timestamp of the last packet of the first session
+            last_seen = sessions['data'][0]['lastPacket'] / 1000
+            # Convert to ISO8601
+            last_seen = datetime.datetime.fromtimestamp(
+                    last_seen,
+                    dateutil.tz.tzutc()
+                ).isoformat()
+            session_id = sessions['data'][0]['id']
+            event.add_sighting(
+                    related_observable.id,
+                    last_seen=last_seen,
+                    sighted_by='moloch',
+                    #refs=['moloch-url', url, 'moloch-session', session_id]
+                    refs=['moloch-url', url],
+                    count=sessions['recordsFiltered']
+                )
+            self.debug("sighted", observable.value, "+",
+                    related_observable.value, "at",
+                    last_seen)
+
+    # Return the unix timestamps of the start and end of the local day
+    # containing timestamp
+    def day(self, timestamp):
         # Convert the timestamp to the local timezone.
         timestamp = dateutil.parser.parse(timestamp).astimezone(dateutil.tz.tzlocal())
         # Start time is 00:00:00 of the day of the sighting
@@ -107,6 +271,12 @@ class MolochAPI(threatstash.plugin.Plugin):
         # for the timestamp() method.
         start_time = int(dateutil.parser.parse(start_time).timestamp())
         stop_time  = int(dateutil.parser.parse(stop_time).timestamp())
+        return start_time, stop_time
+
+    def moloch_query(self, expression, start_time, stop_time):
+        self.acquire()
+        with self._lock:
+            self.queries += 1
 
         # Do we have a default expression?
         if 'base_query' in self.config:
@@ -119,14 +289,16 @@ class MolochAPI(threatstash.plugin.Plugin):
                 'stopTime'   : stop_time,
                 'expression' : expression
             })
-        api_url   = "%s/sessions.json?%s&length=1" % (self.config['url'], query_string)
+        # We only need the count and the first session's lastPacket and id
+        api_url   = "%s/sessions.json?%s&length=1&fields=lastPacket,id" % (self.config['url'], query_string)
         human_url = "%s/sessions?%s" % (self.config['url'], query_string)
         # Fetch sessions from Moloch
-        r = requests.get(
-                api_url,
-                auth=(self.config['username'], self.config['password']),
-                verify=self.config['verify']
-            )
+        with self.external_call():
+            r = self.http.get(
+                    api_url,
+                    auth=(self.config['username'], self.config['password']),
+                    verify=self.config['verify']
+                )
         if r.status_code != 200:
             raise requests.RequestException("Bad status: " + str(r.status_code) + "\n" + r.text)
         if r.text[:5] == "ERROR":
@@ -1,3 +1,8 @@
+import array
+import bisect
+import datetime
+import functools
+import socket
 import time
 import re
 import redis
@@ -12,6 +17,107 @@ __IOC_TYPES__ = [
 __REQUIRED_PARAMETERS__ = [
     'server'
 ]
+__READS__ = [ 'ipv4-addr' ]
+__WRITES__ = [ 'sightings' ]
+
+_CAPFILE_TIME = re.compile(r'(?P<year>\d{4})(?P<month>\d{2})(?P<day>\d{2})(?P<hour>\d{2})(?P<minute>\d{2})')
+
+# Thousands of OIL entries share each capfile, so parse each name only once.
+# Capfiles are named for the local time they start at.
+@functools.lru_cache(maxsize=4096)
+def capfile_time(capfile, tz):
+    m = _CAPFILE_TIME.search(capfile)
+    return datetime.datetime(
+        int(m.group('year')),
+        int(m.group('month')),
+        int(m.group('day')),
+        int(m.group('hour')),
+        int(m.group('minute')),
+        tzinfo=tz
+    )
+
+class OILSnapshot():
+    """
+    An in-memory copy of the OIL.  IPs are kept as a sorted array of 32 bit
+    integers.  The value for the IP at position i in the array is
+    values[offsets[i]:offsets[i + 1]].
+    """
+    def __init__(self, entries):
+        """
+        Parameters
+        ----------
+        entries : list of (int, bytes)
+            IPv4 address as an integer, and its OIL value
+        """
+        entries.sort()
+        self._ips = array.array('I', [ ip for ip, value in entries ])
+        self._offsets = array.array('Q', [0])
+        values = []
+        offset = 0
+        for ip, value in entries:
+            values.append(value)
+            offset += len(value)
+            self._offsets.append(offset)
+        self._values = b''.join(values)
+        self._created = time.time()
+
+    @classmethod
+    def load(cls, r, namespace="", scan_count=1000):
+        """
+        Read every OIL entry from Redis with SCAN and MGET
+        """
+        prefix = namespace + ':' if namespace else ''
+        entries = []
+        keys = []
+        for key in r.scan_iter(match=prefix + '*', count=scan_count):
+            keys.append(key)
+            if len(keys) >= scan_count:
+                entries.extend(cls._fetch(r, keys, len(prefix)))
+                keys = []
+        if keys:
+            entries.extend(cls._fetch(r, keys, len(prefix)))
+        return cls(entries)
+
+    # MGET a batch of keys and return (int, bytes) for each IPv4 address
+    @staticmethod
+    def _fetch(r, keys, prefix_length):
+        entries = []
+        for key, value in zip(keys, r.mget(keys)):
+            if value is None:
+                continue
+            ip = key[prefix_length:].decode('utf8', 'replace')
+            # Skip anything that isn't a dotted quad, e.g. keys belonging to
+            # something else sharing the namespace
+            if ip.count('.') != 3:
+                continue
+            try:
+                entries.append((int.from_bytes(socket.inet_aton(ip), 'big'), value))
+            except OSError:
+                continue
+        return entries
+
+    def get(self, ip):
+        """
+        Return the OIL value for ip, or None
+        """
+        try:
+            n = int.from_bytes(socket.inet_aton(ip), 'big')
+        except OSError:
+            return None
+        i = bisect.bisect_left(self._ips, n)
+        if i < len(self._ips) and self._ips[i] == n:
+            return self._values[self._offsets[i]:self._offsets[i + 1]]
+        return None
+
+    @property
+    def age(self):
+        """
+        Seconds since the snapshot was taken
+        """
+        return time.time() - self._created
+
+    def __len__(self):
+        return len(self._ips)
 
 class RedisOILFilter(threatstash.plugin.Plugin):
     def __init__(self, config = {}):
@@ -23,63 +129,138 @@ class RedisOILFilter(threatstash.plugin.Plugin):
             self.config['password'] = None
         if 'namespace' not in self.config:
             self.config['namespace'] = ""
+        # Number of keys to fetch with each MGET
+        if 'chunk_size' not in self.config:
+            self.config['chunk_size'] = 1000
+        # In snapshot mode, copy the whole OIL into memory and answer lookups
+        # from the copy, refreshing it every refresh_interval seconds
+        if 'snapshot' not in self.config:
+            self.config['snapshot'] = False
+        if 'refresh_interval' not in self.config:
+            self.config['refresh_interval'] = 300
+        self.redis = None
+        self.snapshot = None
+        self.snapshots_taken = 0
+
+    def init(self):
+        super().init()
+        # Connect to Redis.  The client keeps a pool of connections that we
+        # reuse for every Event.
+        if self.redis is None:
+            self.redis = redis.StrictRedis(
+                    host=self.config['server'],
+                    port=self.config['port'],
+                    password=self.config['password']
+                )
 
     def run(self, event):
         """
         Check the Observed Indicator List (OIL) for sightings of IOCs
         """
-        # Connect to Redis
-        r = redis.StrictRedis(
-                host=self.config['server'],
-                port=self.config['port'],
-                password=self.config['password']
-            )
-        # Iterate across STIX ObservedData objects
-        for observable in event.observables:
-            if observable.type == 'ipv4-addr':
-                # Check OIL
-                sighting = self.check(r, observable.value)
-                # Add a sighting if we got a result
-                if sighting:
-                    self.debug("sighted " + observable.value
-                            + " in netflow at " + sighting['timestamp'])
-                    event.add_sighting(observable.id,
-                            last_seen=sighting['timestamp'],
-                            sighted_by='oil-netflow')
+        observables = list(self.new_observables(event, 'ipv4-addr'))
+        # Check OIL for all the IPs at once
+        sightings = self.check_many([ observable.value for observable in observables ])
+        for observable, sighting in zip(observables, sightings):
+            # Add a sighting if we got a result
+            if sighting:
+                self.debug("sighted " + observable.value
+                        + " in netflow at " + sighting['timestamp'])
+                event.add_sighting(observable.id,
+                        last_seen=sighting['time'],
+                        sighted_by='oil-netflow')
         return event
 
-    def check(self, r, ip):
+    def finish(self):
+        if self.snapshot is not None:
+            self.info("Snapshot of %d OIL entries is %.0f seconds old (%d taken)" % (
+                    len(self.snapshot),
+                    self.snapshot.age,
+                    self.snapshots_taken
+                ))
+
+    @property
+    def snapshot_age(self):
+        """
+        Seconds since the OIL snapshot was taken, or None if there isn't one
+        """
+        if self.snapshot is None:
+            return None
+        return self.snapshot.age
+
+    # Take a new snapshot if we don't have one or ours is too old
+    def refresh(self):
+        if self.snapshot is not None and self.snapshot.age < self.config['refresh_interval']:
+            return
+        start = time.time()
+        with self.external_call('redis'):
+            self.snapshot = OILSnapshot.load(
+                    self.redis,
+                    self.config['namespace'],
+                    self.config['chunk_size']
+                )
+        self.snapshots_taken += 1
+        self.debug("Took a snapshot of %d OIL entries in %.2f seconds" % (
+                len(self.snapshot), time.time() - start))
+
+    def check(self, ip):
+        return self.check_many([ip])[0]
+
+    def check_many(self, ips):
+        """
+        Look up a list of IPs in OIL with one MGET per chunk_size IPs.  The
+        MGETs are pipelined, so the whole list costs one round trip.  In
+        snapshot mode, look them up in the snapshot instead.  Return a list
+        holding a dict of flow information for each IP that was found, or
+        None for each IP that wasn't.
+        """
+        # Get our UTC offset, accounting for daylight savings time
+        is_dst = time.localtime().tm_isdst > 0
+        tz = datetime.timezone(datetime.timedelta(
+                seconds=-(time.altzone if is_dst else time.timezone)
+            ))
+
+        results = []
+        if self.config['snapshot']:
+            self.refresh()
+            self.debug("Checking the snapshot, which is %.0f seconds old" % self.snapshot.age)
+            for ip in ips:
+                results.append(self.parse(self.snapshot.get(ip), tz))
+            return results
+
         if self.config['namespace']:
-            key = ':'.join([self.config['namespace'], ip])
+            keys = [ ':'.join([self.config['namespace'], ip]) for ip in ips ]
         else:
-            key = ip
-        value = r.get(key)
+            keys = list(ips)
+
+        if not keys:
+            return results
+        chunk_size = self.config['chunk_size']
+        pipeline = self.redis.pipeline(transaction=False)
+        for i in range(0, len(keys), chunk_size):
+            pipeline.mget(keys[i:i + chunk_size])
+        with self.external_call('redis'):
+            responses = pipeline.execute()
+        for values in responses:
+            for value in values:
+                results.append(self.parse(value, tz))
+        return results
+
+    def parse(self, value, tz):
         if value:
             # value looks like this:
             #
             # /path/to/nfcapd.201810191600:10.0.0.1:8.8.8.8:12345:53:UDP
             value = value.decode('utf8')
             capfile, srcip, dstip, srcport, dstport, proto = value.split(':')
-            m = re.search(r'(?P<year>\d{4})(?P<month>\d{2})(?P<day>\d{2})(?P<hour>\d{2})(?P<minute>\d{2})', capfile)
-            # Get our UTC offset, accounting for daylight savings time
-            is_dst = time.localtime().tm_isdst > 0
-            utc_offset = "-%02d:00" % ((time.altzone if is_dst else time.timezone) / 3600)
-
-            timestamp = "%s-%s-%sT%s:%s:00%s" % (
-                m.group('year'),
-                m.group('month'),
-                m.group('day'),
-                m.group('hour'),
-                m.group('minute'),
-                utc_offset
-            )
+            timestamp = capfile_time(capfile, tz)
             return {
                 'srcip'     : srcip,
                 'dstip'     : dstip,
                 'srcport'   : srcport,
                 'dstport'   : dstport,
                 'proto'     : proto,
-                'timestamp' : timestamp
+                'time'      : timestamp,
+                'timestamp' : timestamp.isoformat()
             }
         else:
             return None
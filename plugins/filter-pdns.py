@@ -1,8 +1,13 @@
 import json
+import re
 import requests
+import threading
 import time
+import urllib.parse
 
+import threatstash.cache
 import threatstash.plugin
+import threatstash.ratelimit
 
 # Enrich IOCs by looking up passive DNS records
 
@@ -10,60 +15,203 @@ __PLUGIN_NAME__ = 'filter-pdns'
 __PLUGIN_TYPE__ = 'filter'
 __IOC_TYPES__ = [ 'domain-name' ]
 __REQUIRED_PARAMETERS__ = [ ]
+__READS__ = [ 'domain-name' ]
+__WRITES__ = [ 'ipv4-addr', 'relationships' ]
 
-class PDNSEnricher(threatstash.plugin.Plugin):
+# DNSDB sends one JSON rrset per line.  We pull time_last out of the raw line
+# so rrsets that are too old can be dropped without decoding them.
+_TIME_LAST = re.compile(rb'"time_last":\s*(\d+)')
+
+_NO_RESULTS = b"Error: no results found for query."
+
+class PDNSEnricher(threatstash.plugin.EnrichmentPlugin):
     def __init__(self, config = {}):
         super().__init__(__PLUGIN_NAME__, __PLUGIN_TYPE__, __IOC_TYPES__, __REQUIRED_PARAMETERS__, config)
+        if 'url' not in self.config:
+            self.config['url'] = 'https://api.dnsdb.info'
+        # Maximum number of rrsets to keep per query
+        if 'limit' not in self.config:
+            self.config['limit'] = None
+        # With max_age set, ask DNSDB for only the rrsets seen since then
+        if 'time_fence' not in self.config:
+            self.config['time_fence'] = True
+        # Results are cached in this SQLite database if it's set
+        if 'cache' not in self.config:
+            self.config['cache'] = None
+        # Seconds to keep results, and "no results" answers
+        if 'cache_ttl' not in self.config:
+            self.config['cache_ttl'] = 7 * 86400
+        if 'cache_negative_ttl' not in self.config:
+            self.config['cache_negative_ttl'] = 86400
+        if 'cache_max_entries' not in self.config:
+            self.config['cache_max_entries'] = 100000
+        # Only answer from the cache.  Never query DNSDB.
+        if 'cache_only' not in self.config:
+            self.config['cache_only'] = False
+        # Service in the rate_limits config to draw from
+        if 'rate_limit' not in self.config:
+            self.config['rate_limit'] = 'dnsdb'
+        self.cache = None
+        # Queries sent to DNSDB, queries skipped in cache_only mode or once
+        # the quota ran out, and queries DNSDB answered with an error
+        self.queries = 0
+        self.skipped = 0
+        self.failed = 0
+        self._lock = threading.Lock()
+
+    def init(self):
+        super().init()
+        if self.cache is None and self.config['cache']:
+            self.cache = threatstash.cache.Cache(
+                    self.config['cache'],
+                    ttl=self.config['cache_ttl'],
+                    negative_ttl=self.config['cache_negative_ttl'],
+                    max_entries=self.config['cache_max_entries']
+                )
+        if self.config['cache_only'] and self.cache is None:
+            raise KeyError("cache_only requires a cache for " + self.name)
 
-    def run(self, event):
+    # Perform a passive dns query for each domain-name Observable.  These run
+    # concurrently; apply() adds the results to the Event.
+    def lookup(self, observable):
+        self.debug("Looking up " + observable.value)
+        return self.rrset(observable.value)
+
+    def apply(self, event, observable, rrsets):
         max_age = self.config.get('max_age')
-        # Iterate across all the ObservedData objects
-        for observable in event.observables:
-            # Look for domain-name observables
-            if observable.type == "domain-name":
-                self.debug("Looking up " + observable.value)
-                # Perform a passive dns query
-                for rrset in self.rrset(observable.value):
-                    # Iterate across the IPs returned
-                    uniq = {}
-                    rrset_age = (time.time() - rrset['time_last']) / 86400
-                    if max_age and rrset_age > max_age:
-                            # This rrset was last seen more than max_age days ago,
-                            # so skip it
-                            continue
-                    for rdata in rrset['rdata']:
-                        # Skip duplicates
-                        if rdata in uniq:
-                            continue
-                        self.debug(observable.value, "resolved_to", rdata, str(int(rrset_age)), "day(s) ago")
-                        # Create a new ObservedData.  If one already exists
-                        # with this value, it will be returned instead.
-                        new_observed_data = event.add_observation(
-                                "ipv4-addr", rdata, added_by=__PLUGIN_NAME__
-                            )
-                        # Add the relationships.
-                        event.add_relationship(observable.id, new_observed_data, "resolved_to")
-                        event.add_relationship(new_observed_data, observable.id, "resolved_from")
-                        uniq[rdata] = True
-        return event
+        for rrset in rrsets:
+            # Iterate across the IPs returned
+            uniq = {}
+            rrset_age = (time.time() - rrset['time_last']) / 86400
+            if max_age and rrset_age > max_age:
+                    # This rrset was last seen more than max_age days ago,
+                    # so skip it
+                    continue
+            for rdata in rrset['rdata']:
+                # Skip duplicates
+                if rdata in uniq:
+                    continue
+                self.debug(observable.value, "resolved_to", rdata, str(int(rrset_age)), "day(s) ago")
+                # Create a new ObservedData.  If one already exists
+                # with this value, it will be returned instead.
+                new_observed_data = event.add_observation(
+                        "ipv4-addr", rdata, added_by=__PLUGIN_NAME__
+                    )
+                # Add the relationships.
+                event.add_relationship(observable.id, new_observed_data, "resolved_to")
+                event.add_relationship(new_observed_data, observable.id, "resolved_from")
+                uniq[rdata] = True
+
+    def finish(self):
+        if self.failed:
+            self.info("%d queries failed" % self.failed)
+        if self.cache is None:
+            return
+        stats = self.cache.stats()
+        self.info("Cache: %d hits (%d negative), %d misses, %.1f%% hit rate" % (
+                stats['hits'],
+                stats['negative_hits'],
+                stats['misses'],
+                stats['hit_rate'] * 100
+            ))
+        self.info("Quota: %d queries sent, %d saved by the cache, %d skipped" % (
+                self.queries,
+                stats['hits'],
+                self.skipped
+            ))
 
     # DNSDB rrset name lookup
     def rrset(self, domain):
-        return self.dnsdb_query("lookup/rrset/name/" + domain + "/A")
+        return self.dnsdb_query("lookup/rrset/name", domain + "/A")
 
     # DNSDB rdata ip lookup
     def rdata(self, ip):
         # Replace '/' with '-' in case this is a CIDR block
         ip = ip.replace('/', '-')
-        return self.dnsdb_query("lookup/rdata/ip/" + ip)
-
-    def dnsdb_query(self, endpoint):
-        url = '/'.join(['https://api.dnsdb.info', endpoint])
-        r = requests.get(url, headers = {
-                'X-API-Key' : self.config['apikey'],
-                'Accept' : 'application/json'
-            })
-        if r.text.rstrip() == "Error: no results found for query.":
+        return self.dnsdb_query("lookup/rdata/ip", ip)
+
+    def dnsdb_query(self, endpoint, query):
+        """
+        Query DNSDB and return a list of rrsets.  The response is read a line
+        at a time, and rrsets last seen more than max_age days ago are
+        skipped before they're decoded.
+        """
+        params = {}
+        max_age = self.config.get('max_age')
+        limit = self.config['limit']
+        minimum_time_last = 0
+        if max_age:
+            minimum_time_last = int(time.time() - max_age * 86400)
+            if self.config['time_fence']:
+                params['time_last_after'] = minimum_time_last
+        if limit:
+            params['limit'] = limit
+        # The results depend on max_age and limit, so they're part of the
+        # cache key
+        cache_query = query
+        if limit or max_age:
+            cache_query = query + '?' + urllib.parse.urlencode({
+                    'limit'   : limit or '',
+                    'max_age' : max_age or ''
+                })
+
+        if self.cache is not None:
+            results = self.cache.get(endpoint, cache_query)
+            if results is not threatstash.cache.MISS:
+                return results
+            if self.config['cache_only']:
+                self.debug("Not in cache:", endpoint, query)
+                with self._lock:
+                    self.skipped += 1
+                return []
+
+        try:
+            self.acquire()
+        except threatstash.ratelimit.QuotaExceeded as e:
+            self.debug(str(e) + ", skipping", endpoint, query)
+            with self._lock:
+                self.skipped += 1
             return []
-        else:
-            return [ json.loads(line) for line in r.text.rstrip().split('\n') ]
+
+        url = '/'.join([self.config['url'], endpoint, query])
+        results = []
+        # A response that can't be read, such as an error page sent with a
+        # 200 or a connection dropped after the retries ran out, is skipped
+        # rather than failing the whole run.
+        try:
+            with self.external_call(), self.http.get(url, params=params, stream=True, headers = {
+                        'X-API-Key' : self.config['apikey'],
+                        'Accept' : 'application/json'
+                    }) as r:
+                with self._lock:
+                    self.queries += 1
+                # DNSDB answers a 404 with this message when there are no
+                # results.  Any other status is an error, such as a bad key or
+                # a spent quota, and says nothing about the query, so it
+                # mustn't be cached as an empty result.
+                if r.status_code != 200 and not (r.status_code == 404
+                        and r.content.strip() == _NO_RESULTS):
+                    self.info("DNSDB returned status %d for %s %s, skipping" % (r.status_code, endpoint, query))
+                    with self._lock:
+                        self.failed += 1
+                    return []
+                for line in r.iter_lines():
+                    line = line.strip()
+                    if not line or line == _NO_RESULTS:
+                        continue
+                    m = _TIME_LAST.search(line)
+                    if m and int(m.group(1)) < minimum_time_last:
+                        continue
+                    results.append(json.loads(line))
+                    if limit and len(results) >= limit:
+                        # Stop reading.  The rest of the response is discarded.
+                        break
+        except (requests.RequestException, ValueError) as e:
+            self.info("DNSDB query for %s %s failed, skipping: %s" % (endpoint, query, e))
+            with self._lock:
+                self.failed += 1
+            return []
+
+        if self.cache is not None:
+            self.cache.put(endpoint, cache_query, results, negative=not results)
+        return results
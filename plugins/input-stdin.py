@@ -1,3 +1,4 @@
+import threatstash.event
 import threatstash.plugin
 import threatstash.observable
 import sys
@@ -6,10 +7,17 @@ __PLUGIN_NAME__ = 'input-stdin'
 __PLUGIN_TYPE__ = 'input'
 __IOC_TYPES__ = [ ]
 __REQUIRED_PARAMETERS__ = [ ]
+__READS__ = [ ]
+__WRITES__ = [ 'context' ]
 
 class StdinInput(threatstash.plugin.Plugin):
     def __init__(self, config = {}):
         super().__init__(__PLUGIN_NAME__, __PLUGIN_TYPE__, __IOC_TYPES__, __REQUIRED_PARAMETERS__, config)
+        # In streaming mode, a line containing only the separator ends one
+        # Event and starts the next.  The default is the ASCII record
+        # separator character.
+        if 'separator' not in self.config:
+            self.config['separator'] = '\x1e'
 
     def run(self, event):
         """
@@ -20,3 +28,19 @@ class StdinInput(threatstash.plugin.Plugin):
         """
         event.context = "\n".join(sys.stdin.readlines())
         return event
+
+    def events(self):
+        """
+        Read stdin until EOF and yield an Event for each block of text
+        between separator lines.
+        """
+        lines = []
+        for line in sys.stdin:
+            if line.rstrip("\r\n") == self.config['separator']:
+                if lines:
+                    yield threatstash.event.Event(context="".join(lines))
+                lines = []
+            else:
+                lines.append(line)
+        if lines:
+            yield threatstash.event.Event(context="".join(lines))
@@ -1,10 +1,11 @@
-import time
 import threatstash.plugin
 
 __PLUGIN_NAME__ = 'output-stdout-csv'
 __PLUGIN_TYPE__ = 'output'
 __IOC_TYPES__ = [ ]
 __REQUIRED_PARAMETERS__ = [ ]
+__READS__ = [ '*' ]
+__WRITES__ = [ ]
 
 class StdoutOutputCSV(threatstash.plugin.Plugin):
     def __init__(self, config = {}):
@@ -22,49 +23,40 @@ class StdoutOutputCSV(threatstash.plugin.Plugin):
             )
         # Iterate across STIX ObservedData objects
         for observable in event.observables:
-            #start = time.time()
             sighted = event.sighted(observable.id)
-            #elapsed = time.time() - start
-            #self.debug("event.sighted(observable.id) took", str(elapsed), "seconds for", observable.value)
-            # Create a unique list of tools that sighted the ObservableData
-            sighters = {}
+            # Event keeps a running summary of each ObservedData's Sightings:
+            # the unique list of tools that sighted it, the total count, and
+            # the most recent last_seen date.
+            sighted_by = []
             sighting_count = 0
             last_seen = ""
             external_reference = ""
-            #start = time.time()
-            for sighting in event.sightings_of(observable.id):
-                # Record the name of our sighted_by
-                sighters[sighting.sighted_by] = True
-                sighting_count += sighting.count
-                # Record the most recent last_seen date from all sightings
-                if str(sighting.last_seen) > last_seen:
-                    last_seen = str(sighting.last_seen)
-                # If this Sighting has external references, record the last
+            summary = event.sighting_summary(observable.id)
+            if summary is not None:
+                sighted_by = summary.sighted_by
+                sighting_count = summary.count
+                if summary.last_seen is not None:
+                    last_seen = str(summary.last_seen)
+                # If the Sightings have external references, record the last
                 # one.
                 #
                 # TODO: figure out how to represent an observable with multiple
                 #       Sightings, each of which has external references. 
                 # TODO: figure out how to represent a Sighting with multiple
                 #       external references 
-                if hasattr(sighting, 'external_references'):
-                    for ref in sighting.external_references:
-                        external_reference = ','.join([
-                                ref.source_name,
-                                ref.external_id
-                            ])
+                if summary.external_references:
+                    ref = summary.external_references[-1]
+                    external_reference = ','.join([
+                            ref.source_name,
+                            ref.external_id
+                        ])
 
-            sighted_by = sighters.keys()
-            #elapsed = time.time() - start
-            #self.debug("Processing sightings took", str(elapsed), "seconds for", observable.value)
             # Get Observable data from related ObservedData objects.
             # related_observables will be an array of threatstash.Observable
             # objects containing each STIX Observable's type and value as well
             # as the id from the parent ObservableData boject and the
             # relationship_type from the Relationship object.
-            #start = time.time()
             related_observables = event.related_observables(observable.id)
-            #elapsed = time.time() - start
-            #self.debug("Retrieving", str(len(related_observables)), "relations took", str(elapsed), "seconds for", observable.value)
             if related_observables:
                 # Iterate across the related ObservedData objects
                 for related_observable in related_observables:
@@ -4,11 +4,15 @@ import argparse
 import yaml
 
 from threatstash import Pipeline
+from threatstash.metrics import Metrics
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument("-q", "--quiet", help="Run with no logging output", action='store_true')
     parser.add_argument("-d", "--debug", help="Run with extra logging output", action='store_true')
+    parser.add_argument("-s", "--stream", help="Run as a long-lived process that streams events from the input plugin through the pipeline", action='store_true')
+    parser.add_argument("--queue-size", help="Maximum number of events waiting between pipeline stages in streaming mode (default: 16)", type=int, default=16)
+    parser.add_argument("-m", "--metrics", help="Record performance metrics for each plugin and write them to METRICS.json and METRICS.prom (a Prometheus textfile)", metavar="METRICS")
     parser.add_argument("config_file", help="YAML configuration file", nargs=1)
     parser.add_argument("plugin_args", help="Additional arguments to pass to plugins", nargs="*")
     args = parser.parse_args()
@@ -22,5 +26,15 @@ if __name__ == "__main__":
     config['global']['quiet'] = args.quiet
     config['global']['debug'] = args.debug
 
-    p = Pipeline(config)
-    p.run()
+    metrics = Metrics() if args.metrics else None
+    p = Pipeline(config, metrics=metrics)
+    try:
+        if args.stream:
+            p.stream(queue_size=args.queue_size)
+        else:
+            p.run()
+    finally:
+        p.close()
+        if metrics is not None:
+            metrics.write_json(args.metrics + '.json')
+            metrics.write_prometheus(args.metrics + '.prom')
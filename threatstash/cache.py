@@ -0,0 +1,159 @@
+# Persistent cache for enrichment lookups
+#
+# Results from external services are stored in a SQLite database keyed by
+# (endpoint, query) so they can be reused across runs.  Entries expire after
+# a TTL, "no results" answers are cached too with a TTL of their own, and the
+# least recently used entries are evicted once the cache holds more than
+# max_entries.
+
+import json
+import sqlite3
+import threading
+import time
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS entries (
+    endpoint TEXT NOT NULL,
+    query    TEXT NOT NULL,
+    value    TEXT NOT NULL,
+    negative INTEGER NOT NULL,
+    expires  REAL NOT NULL,
+    accessed REAL NOT NULL,
+    PRIMARY KEY (endpoint, query)
+);
+CREATE INDEX IF NOT EXISTS entries_accessed ON entries (accessed);
+"""
+
+# Returned by get() on a miss, since None is a cacheable value
+MISS = object()
+
+class Cache():
+    """
+    A TTL cache of JSON-serializable lookup results backed by SQLite.  Safe to
+    share between threads.
+    """
+    def __init__(self, filename, ttl=86400, negative_ttl=None, max_entries=100000):
+        """
+        Parameters
+        ----------
+        filename : string
+            SQLite database to keep the cache in
+        ttl : float
+            Seconds to keep a result
+        negative_ttl : float
+            Seconds to keep a "no results" answer.  Defaults to ttl.
+        max_entries : int
+            Evict the least recently used entries beyond this many
+        """
+        self._filename = filename
+        self._ttl = ttl
+        self._negative_ttl = ttl if negative_ttl is None else negative_ttl
+        self._max_entries = max_entries
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(filename, check_same_thread=False, isolation_level=None)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.executescript(_SCHEMA)
+        self._count = self._db.execute("SELECT COUNT(*) FROM entries").fetchone()[0]
+
+        self.hits = 0
+        self.negative_hits = 0
+        self.misses = 0
+        self.expired = 0
+        self.evicted = 0
+
+    @property
+    def filename(self):
+        return self._filename
+
+    def get(self, endpoint, query):
+        """
+        Return the cached value for (endpoint, query), or MISS if there isn't
+        one or it has expired
+        """
+        now = time.time()
+        with self._lock:
+            row = self._db.execute(
+                    "SELECT value, negative, expires FROM entries WHERE endpoint = ? AND query = ?",
+                    (endpoint, query)
+                ).fetchone()
+            if row is None:
+                self.misses += 1
+                return MISS
+            value, negative, expires = row
+            if expires < now:
+                self._db.execute(
+                        "DELETE FROM entries WHERE endpoint = ? AND query = ?",
+                        (endpoint, query)
+                    )
+                self._count -= 1
+                self.expired += 1
+                self.misses += 1
+                return MISS
+            self._db.execute(
+                    "UPDATE entries SET accessed = ? WHERE endpoint = ? AND query = ?",
+                    (now, endpoint, query)
+                )
+            self.hits += 1
+            if negative:
+                self.negative_hits += 1
+        return json.loads(value)
+
+    def put(self, endpoint, query, value, negative=False):
+        """
+        Cache value for (endpoint, query).  Set negative for answers saying
+        there were no results, so they expire after negative_ttl.
+        """
+        now = time.time()
+        ttl = self._negative_ttl if negative else self._ttl
+        with self._lock:
+            exists = self._db.execute(
+                    "SELECT 1 FROM entries WHERE endpoint = ? AND query = ?",
+                    (endpoint, query)
+                ).fetchone()
+            self._db.execute(
+                    "INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?, ?, ?)",
+                    (endpoint, query, json.dumps(value), int(negative), now + ttl, now)
+                )
+            if not exists:
+                self._count += 1
+            if self._count > self._max_entries:
+                self._evict(now)
+
+    # Drop expired entries, then the least recently used ones until we're
+    # back under max_entries
+    def _evict(self, now):
+        cursor = self._db.execute("DELETE FROM entries WHERE expires < ?", (now,))
+        self._count -= cursor.rowcount
+        self.evicted += cursor.rowcount
+        excess = self._count - self._max_entries
+        if excess > 0:
+            cursor = self._db.execute(
+                    "DELETE FROM entries WHERE rowid IN "
+                    "(SELECT rowid FROM entries ORDER BY accessed LIMIT ?)",
+                    (excess,)
+                )
+            self._count -= cursor.rowcount
+            self.evicted += cursor.rowcount
+
+    def __len__(self):
+        return self._count
+
+    def stats(self):
+        """
+        Return a dict of hit, miss, and eviction counts since the cache was
+        opened
+        """
+        lookups = self.hits + self.misses
+        return {
+            'hits'          : self.hits,
+            'negative_hits' : self.negative_hits,
+            'misses'        : self.misses,
+            'expired'       : self.expired,
+            'evicted'       : self.evicted,
+            'entries'       : self._count,
+            'hit_rate'      : self.hits / lookups if lookups else 0.0
+        }
+
+    def close(self):
+        with self._lock:
+            self._db.close()
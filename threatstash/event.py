@@ -1,45 +1,184 @@
+import bisect
 import dateutil.parser
 
 from datetime import datetime, timezone
 
-# STIX 2 SDO
-from stix2 import ObservedData
-# STIX 2 SRO
-from stix2 import Relationship, Sighting
-# STIX 2 Environment
-from stix2 import Environment, MemoryStore, Filter
-# STIX 2 Observables
-from stix2 import AutonomousSystem, DomainName, EmailAddress, File, IPv4Address, IPv6Address, URL
-
 import threatstash.observable
+import threatstash.record
+
+class SightingSummary():
+    """
+    Running totals of the Sightings of one ObservedData.  Event updates these
+    as Sightings are added, so nothing has to go through the Sightings again
+    to find out how often, when, and by whom an ObservedData was sighted.
+    """
+    __slots__ = ('sightings', 'count', 'first_seen', 'last_seen', '_sighted_by',
+            'external_references')
+
+    def __init__(self):
+        # Number of Sightings, and the sum of their counts
+        self.sightings = 0
+        self.count = 0
+        # Earliest first_seen and latest last_seen, as datetimes in UTC
+        self.first_seen = None
+        self.last_seen = None
+        # sighted_by values, as a dict so they stay in the order they were
+        # first seen
+        self._sighted_by = {}
+        # External references of every Sighting, in order
+        self.external_references = []
+
+    @property
+    def sighted_by(self):
+        """
+        The set of tools or plugins that sighted the ObservedData, in the
+        order they first did
+        """
+        return self._sighted_by.keys()
+
+    def add(self, sighting):
+        self.sightings += 1
+        self.count += sighting.count
+        if sighting.first_seen is not None \
+                and (self.first_seen is None or sighting.first_seen < self.first_seen):
+            self.first_seen = sighting.first_seen
+        if sighting.last_seen is not None \
+                and (self.last_seen is None or sighting.last_seen > self.last_seen):
+            self.last_seen = sighting.last_seen
+        self._sighted_by[sighting.sighted_by] = True
+        self.external_references.extend(sighting.external_references)
+
+    def copy(self):
+        summary = SightingSummary()
+        summary.sightings = self.sightings
+        summary.count = self.count
+        summary.first_seen = self.first_seen
+        summary.last_seen = self.last_seen
+        summary._sighted_by = dict(self._sighted_by)
+        summary.external_references = list(self.external_references)
+        return summary
 
 class Event():
     def __init__(self, observables=[], relationships=[], context=None):
-        # STIX Environment to store STIX Objects
-        self._env = Environment(store=MemoryStore())
-        
+        # Changes made to a fork, in order, so they can be merged back into
+        # the Event it was forked from.  None unless this is a fork.
+        self._journal = None
+
+        # Every record added to the Event gets the next number in a sequence
+        # that only goes up, and so does every change to the context.  _log
+        # holds the records in the order they were added, and
+        # _log_sequences their sequence numbers, so we can find everything
+        # added since a given point without looking at the rest.
+        self._sequence = 0
+        self._log = []
+        self._log_sequences = []
+        self._context_sequence = 0
+        # Key => the sequence number a plugin had seen up to the last time it
+        # ran on this Event.  See threatstash.plugin.Plugin.delta_key.
+        self._watermarks = {}
+
         # Dict we can use to ensure observables are unique
         self._uniq = {}
 
-        # STIX 2 objects are immutable once created, so we have to maintain our
-        # own revocation list.
+        # Objects keep their ids when they are exported to STIX 2, and STIX 2
+        # objects are immutable once created, so we maintain our own
+        # revocation list rather than remove anything.
         self._revocation_list = {}
 
+        # ObservedData, Relationships, and Sightings are stored as
+        # threatstash.record objects.  STIX 2 objects are only built from them
+        # when someone asks for the STIX view of the Event.
+        #
+        # Objects are indexed by id and by STIX type, and Sightings and
+        # Relationships are keyed by the ids they point to.  Each list
+        # preserves insertion order.
+        self._objects = {}
+        self._objects_by_type = {}
+        self._sightings_by_ref = {}
+        self._relationships_by_source = {}
+        self._relationships_by_target = {}
+        # ObservedData id => SightingSummary of its Sightings
+        self._sighting_summaries = {}
+
+        # threatstash.Observable views of the unrevoked ObservedData objects.
+        # These are updated as ObservedData objects are added and revoked.
+        # _observables_by_id preserves insertion order, and
+        # _observables_by_type holds one bucket per observable type.
+        self._observables = None
+        self._observables_by_id = {}
+        self._observables_by_type = {}
+
         # Observables are STIX 2 ObservedData objects
         for observed_data in observables:
-            self._env.add(observed_data)
-            for observable in observed_data.objects:
-                # Store the ObservedData id in a dict keyed by the Observable
-                # value. This will help prevent duplicates.
-                self._uniq[observable.value] = observed_data.id
+            record = threatstash.record.ObservedDataRecord.from_stix(observed_data)
+            self._add(record)
+            # Store the ObservedData id in a dict keyed by the Observable
+            # value. This will help prevent duplicates.
+            self._uniq[record.value] = record.id
 
         # Relationships are STIX 2 Relationship objects
         for obj in relationships:
-            self._env.add(obj)
+            record = threatstash.record.RelationshipRecord.from_stix(obj)
+            self._add(record)
+            self._uniq[record.source_ref + record.target_ref + record.relationship_type] = record
 
         # Blob of text with additional context
         self._context = context
 
+    # Add a record to our indexes
+    def _add(self, obj):
+        if self._journal is not None:
+            self._journal.append(('add', obj))
+        self._sequence += 1
+        self._log.append(obj)
+        self._log_sequences.append(self._sequence)
+        self._objects[obj.id] = obj
+        self._objects_by_type.setdefault(obj.type, {})[obj.id] = obj
+        if obj.type == 'observed-data':
+            self._add_view(obj)
+        elif obj.type == 'sighting':
+            self._sightings_by_ref.setdefault(obj.sighting_of_ref, []).append(obj)
+            summary = self._sighting_summaries.get(obj.sighting_of_ref)
+            if summary is None:
+                summary = self._sighting_summaries[obj.sighting_of_ref] = SightingSummary()
+            summary.add(obj)
+        elif obj.type == 'relationship':
+            self._relationships_by_source.setdefault(obj.source_ref, []).append(obj)
+            self._relationships_by_target.setdefault(obj.target_ref, []).append(obj)
+
+    # Return an object by id from our indexes
+    def _get(self, _id):
+        return self._objects.get(_id)
+
+    # Create threatstash.Observable objects from an ObservedData record
+    def _wrap(self, observed_data, **kwargs):
+        return [
+            threatstash.observable.Observable(
+                observed_data.observable_type,
+                observed_data.value,
+                _id = observed_data.id,
+                added_by = observed_data.added_by,
+                refs = observed_data.refs,
+                **kwargs
+            )
+        ]
+
+    # Add the Observables in an ObservedData to the cached views
+    def _add_view(self, observed_data):
+        wrappers = self._wrap(observed_data)
+        self._observables_by_id[observed_data.id] = wrappers
+        for wrapper in wrappers:
+            bucket = self._observables_by_type.setdefault(wrapper.type.lower(), {})
+            bucket.setdefault(observed_data.id, []).append(wrapper)
+        self._observables = None
+
+    # Remove the Observables in an ObservedData from the cached views
+    def _remove_view(self, _id):
+        for wrapper in self._observables_by_id.pop(_id, []):
+            bucket = self._observables_by_type.get(wrapper.type.lower(), {})
+            bucket.pop(_id, None)
+        self._observables = None
+
     def revoke(self, observed_data):
         """
         Revoke an ObservedData
@@ -52,7 +191,13 @@ class Event():
             _id = observed_data
         else:
             _id = observed_data.id
+        if self._journal is not None:
+            self._journal.append(('revoke', _id))
         self._revocation_list[_id] = True
+        # Revoked ObservedData objects stay in the id index, but we drop them
+        # from the type index so observations() never has to skip them.
+        self._objects_by_type.get('observed-data', {}).pop(_id, None)
+        self._remove_view(_id)
 
     def revoked(self, observed_data):
         """
@@ -116,42 +261,20 @@ class Event():
         # Do we already have an ObservedData containing an Observable with this
         # value?  If so, return it rather than create a new one.
         if value in self._uniq:
-            return self._env.get(self._uniq[value])
-        else:
-            if otype == "autonomous-system":
-                observable = AutonomousSystem(value=value)
-            elif otype == "domain-name":
-                observable = DomainName(value=value)
-            elif otype == "email-addr":
-                observable = EmailAddress(value=value)
-            elif otype in ["md5", "sha1", "sha256", "sha512", "ssdeep"]:
-                observable = File(hashes={ otype : value })
-            elif otype == "ipv4-addr":
-                observable = IPv4Address(value=value)
-            elif otype == "ipv6-addr":
-                observable = IPv6Address(value=value)
-            elif otype == "url":
-                observable = URL(value=value)
-            else:
-                raise ValueError("Invalid Observable type: " + otype)
-
-            external_references = self._create_references(refs)
-
-            observed_data = ObservedData(
-                    first_observed=datetime.utcnow(),
-                    last_observed=datetime.utcnow(),
-                    number_observed=1,
-                    objects = { 0 : observable },
-                    custom_properties = { 
-                        'added_by' : added_by,
-                        'refs' : external_references
-                    }
-            )
-            #print("Added a new observed_data") # DEBUG
-            #print(observed_data)               # DEBUG
-            self._env.add(observed_data)
-            self._uniq[value] = observed_data.id
-            return(observed_data)
+            return self._get(self._uniq[value])
+
+        if otype not in threatstash.record.OBSERVABLE_TYPES:
+            raise ValueError("Invalid Observable type: " + otype)
+
+        observed_data = threatstash.record.ObservedDataRecord(
+                otype,
+                value,
+                added_by = added_by,
+                refs = self._create_references(refs)
+        )
+        self._add(observed_data)
+        self._uniq[value] = observed_data.id
+        return(observed_data)
     
     # Add a STIX Relationship to an Event
     def add_relationship(self, source, target, relationship_type):
@@ -169,16 +292,14 @@ class Event():
         if type(target) != str:
             target = target.id
 
-        r = Relationship(
-            source_ref=source,
-            target_ref=target,
-            relationship_type=relationship_type
-        )
+        # Don't add duplicate relationships.  Return the existing one instead.
+        key = source + target + relationship_type
+        if key in self._uniq:
+            return self._uniq[key]
 
-        # Don't add duplicate relationships
-        if not self._uniq.get(source + target + relationship_type):
-            self._env.add(r)
-            self._uniq[source + target + relationship_type] = True
+        r = threatstash.record.RelationshipRecord(source, target, relationship_type)
+        self._add(r)
+        self._uniq[key] = r
         return(r)
     
     # Return all the relationships for a given source ObservedData
@@ -202,68 +323,45 @@ class Event():
         ObservedData, and the relationship_type field from the Relationship
         object.
         """
-        if direction == 'related_to':
-            source_only = True
-            target_only = False
-        elif direction == 'related_from':
-            source_only = False
-            target_only = True
-        elif direction == 'both':
-            source_only = False
-            target_only = False
-
         if type(observed_data) == str:
             _id = observed_data
         else:
             _id = observed_data.id
 
+        if direction == 'related_to':
+            found = self._relationships_by_source.get(_id, [])
+        elif direction == 'related_from':
+            found = self._relationships_by_target.get(_id, [])
+        elif direction == 'both':
+            found = self._relationships_by_source.get(_id, []) \
+                    + self._relationships_by_target.get(_id, [])
+        else:
+            raise ValueError("Invalid direction: " + direction)
+
         relationships = []
-        # Find all the Relationships in our Environment
-        for r in self._env.relationships(_id, source_only=source_only, target_only=target_only):
+        # Run through the Relationships that point to or from this object
+        for r in found:
             if self.revoked(r.source_ref) or self.revoked(r.target_ref):
                 continue
-            # Get the ObservedData object that is the target of each Relationship
-            target_obj = self._env.get(r.target_ref)
-            try:
-                refs = target_obj.refs
-            except:
-                refs = []
-            # Get the Observable objects in the ObservedData object
-            for observable in target_obj.objects.values():
-                # Create threatstash.Observable objects from the ObservedData,
-                # Observable, and Relationship
-                if observable.type == "file":
-                    for hash_type, value in file.hashes.items():
-                        relationships.append(
-                                threatstash.observable.Observable(
-                                    hash_type,
-                                    value,
-                                    _id = target_obj.id,
-                                    added_by = target_obj.added_by,
-                                    relationship_type = r.relationship_type,
-                                    refs = refs
-                                )
-                            )
-                else:
-                    relationships.append(
-                            threatstash.observable.Observable(
-                                observable.type,
-                                observable.value,
-                                _id = target_obj.id,
-                                added_by = target_obj.added_by,
-                                relationship_type = r.relationship_type,
-                                refs = refs
-                            )
-                        )
+            # Get the ObservedData object on the other end of each Relationship
+            if r.source_ref == _id:
+                target_obj = self._get(r.target_ref)
+            else:
+                target_obj = self._get(r.source_ref)
+            # Create threatstash.Observable objects from the ObservedData and
+            # Relationship
+            relationships.extend(
+                    self._wrap(target_obj, relationship_type = r.relationship_type)
+                )
         return relationships
     
     # Return Sightings
     def sightings(self):
         """
-        Return all Sighting objects in the Environment
+        Return all Sighting objects in the Event
         """
         sightings = []
-        for sighting in self._env.query(Filter('type', '=', 'sighting')):
+        for sighting in self._objects_by_type.get('sighting', {}).values():
             if not self.revoked(sighting.sighting_of_ref):
                 sightings.append(sighting)
         return sightings
@@ -292,29 +390,30 @@ class Event():
         else:
             _id = observed_data.id
 
-        external_references = self._create_references(refs)
+        external_references = [
+            threatstash.record.ExternalReference(**ref)
+            for ref in self._create_references(refs)
+        ]
 
         # Default to now if no timestamp was given
         if not first_seen and not last_seen:
             first_seen = last_seen = datetime.now(timezone.utc)
 
-        if first_seen:
+        if first_seen and type(first_seen) == str:
             first_seen = dateutil.parser.parse(first_seen)
 
-        if last_seen:
+        if last_seen and type(last_seen) == str:
             last_seen = dateutil.parser.parse(last_seen)
 
-        s = Sighting(
+        s = threatstash.record.SightingRecord(
                 _id,
                 first_seen=first_seen,
                 last_seen=last_seen,
-                custom_properties = { 
-                    'sighted_by' : sighted_by
-                },
+                sighted_by=sighted_by,
                 external_references=external_references,
                 count=count
         )
-        self._env.add(s)
+        self._add(s)
         return(s)
 
     # Return all the obsersables for sighted ObservedData objects
@@ -328,20 +427,15 @@ class Event():
         Sighting.
         """
         sightings = []
-        # Find all the Sightings in our Environment
-        for s in self._env.sightings():
+        # Find all the Sightings in our Event
+        for s in self.sightings():
             # Get the ObservedData object that is the target of each Sighting
-            sighted_obj = self._env.get(s.sighting_of_ref)
-            # Get the Observable objects in the ObservedData object
-            for observable in sighted_obj.objects.values():
-                # Create threatstash.Observable objects from the ObservedData,
-                # Observable, and Sighting
-                sightings.append(
-                    threatstash.observable.Observable(
-                        observable.type,
-                        observable.value,
-                        _id        = sighted_obj.id,
-                        added_by   = sighted_obj.added_by,
+            sighted_obj = self._get(s.sighting_of_ref)
+            # Create threatstash.Observable objects from the ObservedData and
+            # Sighting
+            sightings.extend(
+                    self._wrap(
+                        sighted_obj,
                         first_seen = s.first_seen,
                         last_seen  = s.last_seen,
                         sighted_by = s.sighted_by
@@ -366,14 +460,15 @@ class Event():
         else:
             _id = observed_data.id
 
-        if self._env.query(Filter('sighting_of_ref', '=', _id)):
+        if self._sightings_by_ref.get(_id):
             return True
         else:
             return False
     
     def sightings_of(self, observed_data):
         """
-        Return the Sightings for a particular ObservedData
+        Return a list of the Sightings for a particular ObservedData.  The
+        list is a copy, so changing it doesn't change the Event.
 
         Parameters
         ----------
@@ -388,82 +483,99 @@ class Event():
         else:
             _id = observed_data.id
 
-        return self._env.query(Filter('sighting_of_ref', '=', _id))
+        return list(self._sightings_by_ref.get(_id, []))
+
+    def sighting_summary(self, observed_data):
+        """
+        Return a SightingSummary of the Sightings of an ObservedData, or None
+        if it hasn't been sighted or has been revoked
+
+        Parameters
+        ----------
+        observed_data : string or ObservedData object
+            The object or id to check
+        """
+        if self.revoked(observed_data):
+            return None
+
+        if type(observed_data) == str:
+            _id = observed_data
+        else:
+            _id = observed_data.id
+
+        return self._sighting_summaries.get(_id)
     
     # Getters and setters
     @property
     def observables(self):
         """
         Return all the Observables in all the ObservedData objects in our
-        Environment
+        Event
         """
+        # The flattened list is cached until an ObservedData is added or
+        # revoked.  Callers may add observations while iterating, so we
+        # replace the cached list rather than modify it.
+        if self._observables is None:
+            observables = []
+            for wrappers in self._observables_by_id.values():
+                observables.extend(wrappers)
+            self._observables = observables
+        return self._observables
+
+    def observables_of(self, *types):
+        """
+        Return the Observables of the given types, e.g.
+        event.observables_of('ipv4-addr', 'domain-name')
+
+        Observables are returned grouped by type in the order the types were
+        given.  With no types, this is the same as event.observables.
+        """
+        if not types:
+            return self.observables
         observables = []
-        for observed_data in self.observations:
-            #print("event.observables()") # DEBUG
-            #print(observed_data)         # DEBUG
-            try:
-                # Adding custom property to a STIX2 ObservedData with a value
-                # of [] results in the custom property not being added, so we
-                # need a try/except here.
-                refs = observed_data.refs
-            except:
-                refs = []
-            for observable in observed_data.objects.values():
-                # Create threatstash.Observable objects from the ObservedData,
-                # and Observable
-                if observable.type == "file":
-                    for hash_type, value in observable.hashes.items():
-                        observables.append(
-                                threatstash.observable.Observable(
-                                    hash_type,
-                                    value,
-                                    _id = observed_data.id,
-                                    added_by = observed_data.added_by,
-                                    refs = refs
-                                )
-                            )
-                else:
-                    observables.append(
-                            threatstash.observable.Observable(
-                                observable.type,
-                                observable.value,
-                                _id = observed_data.id,
-                                added_by = observed_data.added_by,
-                                refs = refs
-                            )
-                        )
+        for observable_type in types:
+            for wrappers in self._observables_by_type.get(observable_type.lower(), {}).values():
+                observables.extend(wrappers)
         return observables
-    
+
     @property
+    def observable_types(self):
+        """
+        Return a dict of observable type => count for the unrevoked
+        Observables in this Event
+        """
+        return {
+            observable_type : len(bucket)
+            for observable_type, bucket in self._observables_by_type.items()
+            if bucket
+        }
+
     def observation(self, _id):
         """
-        Return a specifc ObservedData object from our Environment
+        Return a specifc ObservedData object from our Event
         """
         if self.revoked(_id):
             return None
-        return self._env.get(_id)
+        return self._get(_id)
 
     @property
     def observations(self):
         """
-        Return all the ObservedData objects in our Environment
+        Return all the ObservedData objects in our Event
         """
-        observations = []
-        for observed_data in self._env.query(Filter('type', '=', 'observed-data')):
-            if not self.revoked(observed_data):
-                observations.append(observed_data)
-        return observations
+        # Revoked objects are dropped from the index by revoke()
+        return list(self._objects_by_type.get('observed-data', {}).values())
     
     @property
     def relationships(self):
         """
-        Return all the Relationships from our Environment
+        Return all the Relationships from our Event
         """
         relationships = []
-        for relationship in self._env.query(Filter('type', '=', 'relationship')):
+        for r in self._objects_by_type.get('relationship', {}).values():
             if self.revoked(r.source_ref) or self.revoked(r.target_ref):
                 continue
-            relationships.append(relationship)
+            relationships.append(r)
         return relationships
 
     @property
@@ -472,8 +584,232 @@ class Event():
 
     @context.setter
     def context(self, context):
+        if self._journal is not None:
+            self._journal.append(('context', context))
+        self._sequence += 1
+        self._context_sequence = self._sequence
         self._context = context
 
+    # Change tracking.  Plugins use these to work on only what has changed
+    # since they last ran on the Event.
+    @property
+    def sequence(self):
+        """
+        Return the sequence number of the latest change to the Event
+        """
+        return self._sequence
+
+    @property
+    def context_sequence(self):
+        """
+        Return the sequence number of the latest change to the context
+        """
+        return self._context_sequence
+
+    def watermark(self, key):
+        """
+        Return the sequence number recorded by set_watermark() for key, or
+        None if there isn't one
+        """
+        return self._watermarks.get(key)
+
+    def set_watermark(self, key, sequence):
+        """
+        Record that whatever key stands for has seen the changes up to
+        sequence.  Watermarks never go backwards.
+        """
+        if self._journal is not None:
+            self._journal.append(('watermark', (key, sequence)))
+        if sequence > self._watermarks.get(key, -1):
+            self._watermarks[key] = sequence
+
+    def changes_since(self, sequence, stix_type=None):
+        """
+        Yield the records added after sequence, oldest first, optionally only
+        those of one STIX type, e.g. 'sighting'.  Records added while
+        iterating aren't included.
+        """
+        start = bisect.bisect_right(self._log_sequences, sequence or 0)
+        end = len(self._log)
+        for i in range(start, end):
+            record = self._log[i]
+            if stix_type is None or record.type == stix_type:
+                yield record
+
+    def observables_since(self, sequence, *types):
+        """
+        Return the unrevoked Observables of the given types added after
+        sequence, grouped by type like observables_of().  A sequence of None
+        returns them all.
+        """
+        if sequence is None:
+            return self.observables_of(*types)
+        wanted = [ observable_type.lower() for observable_type in types ]
+        by_type = {}
+        for record in self.changes_since(sequence, 'observed-data'):
+            for wrapper in self._observables_by_id.get(record.id, []):
+                observable_type = wrapper.type.lower()
+                if not wanted or observable_type in wanted:
+                    by_type.setdefault(observable_type, []).append(wrapper)
+        if not wanted:
+            return [ wrapper for bucket in by_type.values() for wrapper in bucket ]
+        return [ wrapper for observable_type in wanted for wrapper in by_type.get(observable_type, []) ]
+
+    def sightings_since(self, sequence):
+        """
+        Return the Sightings of unrevoked ObservedData added after sequence.
+        A sequence of None returns them all.
+        """
+        if sequence is None:
+            return self.sightings()
+        return [
+            sighting for sighting in self.changes_since(sequence, 'sighting')
+            if not self.revoked(sighting.sighting_of_ref)
+        ]
+
+    def relationships_since(self, sequence):
+        """
+        Return the Relationships between unrevoked ObservedData added after
+        sequence.  A sequence of None returns them all.
+        """
+        if sequence is None:
+            return self.relationships
+        return [
+            r for r in self.changes_since(sequence, 'relationship')
+            if not self.revoked(r.source_ref) and not self.revoked(r.target_ref)
+        ]
+
+    def fork(self):
+        """
+        Return a copy of this Event for a plugin to work on alongside other
+        plugins.  The copy shares records with this Event but has indexes of
+        its own, and it keeps a journal of the changes made to it so they can
+        be applied back with merge().
+        """
+        fork = Event.__new__(Event)
+        fork._journal = []
+        fork._uniq = dict(self._uniq)
+        fork._revocation_list = dict(self._revocation_list)
+        fork._objects = dict(self._objects)
+        fork._objects_by_type = {
+            stix_type : dict(bucket) for stix_type, bucket in self._objects_by_type.items()
+        }
+        # These lists are appended to, so each fork needs its own
+        fork._sightings_by_ref = {
+            _id : list(found) for _id, found in self._sightings_by_ref.items()
+        }
+        fork._relationships_by_source = {
+            _id : list(found) for _id, found in self._relationships_by_source.items()
+        }
+        fork._relationships_by_target = {
+            _id : list(found) for _id, found in self._relationships_by_target.items()
+        }
+        fork._sighting_summaries = {
+            _id : summary.copy() for _id, summary in self._sighting_summaries.items()
+        }
+        fork._observables = None
+        fork._observables_by_id = dict(self._observables_by_id)
+        fork._observables_by_type = {
+            observable_type : dict(bucket)
+            for observable_type, bucket in self._observables_by_type.items()
+        }
+        fork._context = self._context
+        fork._sequence = self._sequence
+        fork._log = list(self._log)
+        fork._log_sequences = list(self._log_sequences)
+        fork._context_sequence = self._context_sequence
+        fork._watermarks = dict(self._watermarks)
+        return fork
+
+    def merge(self, fork):
+        """
+        Apply the changes made to a fork of this Event, in the order they
+        were made.
+
+        Other forks may have been merged in the meantime.  If one of them
+        added an ObservedData with the same value as this fork did, the
+        existing ObservedData wins, just as add_observation() would have
+        returned it, and the fork's Relationships and Sightings are pointed
+        at it instead.  Merging the same forks in the same order always
+        gives the same Event.
+        """
+        # Fork ObservedData id => id of the ObservedData it was merged into
+        ids = {}
+        for action, value in fork._journal:
+            if action == 'add':
+                self._merge_record(value, ids)
+            elif action == 'revoke':
+                self.revoke(ids.get(value, value))
+            elif action == 'context':
+                self.context = value
+            elif action == 'watermark':
+                # Sequence numbers up to the fork point are the same in
+                # both Events
+                self.set_watermark(*value)
+
+    def _merge_record(self, record, ids):
+        if record.type == 'observed-data':
+            if record.value in self._uniq:
+                ids[record.id] = self._uniq[record.value]
+                return
+            self._add(record)
+            self._uniq[record.value] = record.id
+        elif record.type == 'relationship':
+            source = ids.get(record.source_ref, record.source_ref)
+            target = ids.get(record.target_ref, record.target_ref)
+            key = source + target + record.relationship_type
+            if key in self._uniq:
+                return
+            if source != record.source_ref or target != record.target_ref:
+                record = threatstash.record.RelationshipRecord(
+                        source, target, record.relationship_type,
+                        _id = record.id,
+                        created = record.created
+                    )
+            self._add(record)
+            self._uniq[key] = record
+        elif record.type == 'sighting':
+            sighting_of_ref = ids.get(record.sighting_of_ref, record.sighting_of_ref)
+            if sighting_of_ref != record.sighting_of_ref:
+                record = threatstash.record.SightingRecord(
+                        sighting_of_ref,
+                        first_seen = record.first_seen,
+                        last_seen = record.last_seen,
+                        sighted_by = record.sighted_by,
+                        external_references = record.external_references,
+                        count = record.count,
+                        _id = record.id,
+                        created = record.created
+                    )
+            self._add(record)
+
+    # STIX 2 views of the Event.  These build STIX 2 objects from our records,
+    # so they're expensive and should only be used for export.
+    def stix_objects(self):
+        """
+        Return STIX 2 objects for all the unrevoked ObservedData objects and
+        the Relationships and Sightings that refer to them
+        """
+        objects = [ observed_data.stix() for observed_data in self.observations ]
+        objects.extend([ r.stix() for r in self.relationships ])
+        objects.extend([ s.stix() for s in self.sightings() ])
+        return objects
+
+    def to_bundle(self):
+        """
+        Return a STIX 2 Bundle containing the Event
+        """
+        import stix2
+        return stix2.Bundle(objects=self.stix_objects(), allow_custom=True)
+
+    @property
+    def environment(self):
+        """
+        Return a STIX 2 Environment populated with the Event's STIX 2 objects
+        """
+        import stix2
+        return stix2.Environment(store=stix2.MemoryStore(self.stix_objects(), allow_custom=True))
+
     def to_dict(self):
         return {
             'observables' : self.observables,
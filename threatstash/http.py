@@ -0,0 +1,124 @@
+# Shared HTTP client for plugins
+#
+# Plugins that talk to web APIs should make their requests through an
+# HTTPClient rather than calling requests.get() directly.  The client keeps a
+# pool of keep-alive connections to each host, so repeated lookups against
+# the same API don't pay for a new TCP and TLS handshake every time, and it
+# retries connection errors and transient 5xx and 429 responses with
+# exponential backoff, honoring any Retry-After header the server sends.
+#
+# The Pipeline creates one client from the 'http' section of the config and
+# hands it to every plugin as plugin.http.
+
+import threading
+
+import requests
+import requests.adapters
+import urllib3.util.retry
+
+# Statuses worth retrying
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+_default = None
+_default_lock = threading.Lock()
+
+class HTTPClient():
+    """
+    A requests.Session with pooled connections and retries
+    """
+    def __init__(self, retries=3, backoff_factor=0.5, backoff_max=60,
+            pool_connections=10, pool_maxsize=10, timeout=None):
+        """
+        Parameters
+        ----------
+        retries : int
+            Number of times to retry a failed request
+        backoff_factor : float
+            Seconds to sleep before the second retry.  The sleep doubles
+            after each retry after that.  A Retry-After header from the
+            server takes precedence.
+        backoff_max : float
+            Longest time to sleep between retries
+        pool_connections : int
+            Number of hosts to keep a connection pool for
+        pool_maxsize : int
+            Number of connections to keep open to each host.  Set this to at
+            least the concurrency of the plugins sharing the client.
+        timeout : float
+            Default timeout in seconds for each request.  None waits forever.
+        """
+        self._timeout = timeout
+        options = {
+            'total'                      : retries,
+            'backoff_factor'             : backoff_factor,
+            'status_forcelist'           : RETRY_STATUSES,
+            'respect_retry_after_header' : True,
+            # Hand back the last response rather than raising once we've run
+            # out of retries, so plugins can report what went wrong
+            'raise_on_status'            : False
+        }
+        try:
+            retry = urllib3.util.retry.Retry(backoff_max=backoff_max, **options)
+        except TypeError:
+            # urllib3 1.x has no backoff_max argument, just a class
+            # attribute.  Set it on a subclass so other users of Retry
+            # aren't affected.  Retry.new() keeps the subclass.
+            retry_class = type('Retry', (urllib3.util.retry.Retry,), {
+                'DEFAULT_BACKOFF_MAX' : backoff_max,
+                'BACKOFF_MAX'         : backoff_max
+            })
+            retry = retry_class(**options)
+        adapter = requests.adapters.HTTPAdapter(
+                pool_connections=pool_connections,
+                pool_maxsize=pool_maxsize,
+                max_retries=retry
+            )
+        self._session = requests.Session()
+        self._session.mount('http://', adapter)
+        self._session.mount('https://', adapter)
+
+    @classmethod
+    def from_config(cls, config):
+        """
+        Create a client from a dict of options, e.g. the 'http' section of
+        the config file
+        """
+        options = {}
+        for option in ['retries', 'backoff_factor', 'backoff_max',
+                'pool_connections', 'pool_maxsize', 'timeout']:
+            if option in config:
+                options[option] = config[option]
+        return cls(**options)
+
+    @property
+    def session(self):
+        return self._session
+
+    def request(self, method, url, **kwargs):
+        """
+        Make a request and return the requests.Response.  Takes the same
+        arguments as requests.request().
+        """
+        if 'timeout' not in kwargs:
+            kwargs['timeout'] = self._timeout
+        return self._session.request(method, url, **kwargs)
+
+    def get(self, url, **kwargs):
+        return self.request('GET', url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.request('POST', url, **kwargs)
+
+    def close(self):
+        self._session.close()
+
+def default():
+    """
+    Return a process-wide HTTPClient with the default options, for plugins
+    running outside a Pipeline
+    """
+    global _default
+    with _default_lock:
+        if _default is None:
+            _default = HTTPClient()
+        return _default
@@ -0,0 +1,242 @@
+# Performance metrics for pipeline runs
+#
+# When metrics are enabled, the Pipeline records for each plugin stage the
+# wall and CPU time it took, how many Observables it was given and left
+# behind, how many Sightings and Relationships it added, and how many calls
+# it made to each external service and how long they took.  Plugins report
+# their external calls with Plugin.external_call().
+#
+# The results can be written as a JSON summary or as a Prometheus textfile
+# for the node_exporter textfile collector.
+
+import json
+import os
+import tempfile
+import threading
+
+# Latency histogram bucket upper bounds, in seconds.  These are the
+# Prometheus client defaults.
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+class Histogram():
+    """
+    Counts of observed values by bucket, with their sum
+    """
+    def __init__(self, buckets=BUCKETS):
+        self._buckets = tuple(buckets)
+        # One count per bucket, plus one for values above the last bound
+        self.counts = [ 0 ] * (len(self._buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    @property
+    def buckets(self):
+        return self._buckets
+
+    def observe(self, value):
+        for i, bound in enumerate(self._buckets):
+            if value <= bound:
+                break
+        else:
+            i = len(self._buckets)
+        self.counts[i] += 1
+        self.count += 1
+        self.sum += value
+
+    def cumulative(self):
+        """
+        Return (upper bound, count of values <= bound) pairs, ending with
+        ('+Inf', count)
+        """
+        pairs = []
+        total = 0
+        for bound, count in zip(self._buckets + ('+Inf',), self.counts):
+            total += count
+            pairs.append((bound, total))
+        return pairs
+
+    def to_dict(self):
+        return {
+            'count'   : self.count,
+            'sum'     : self.sum,
+            'mean'    : self.sum / self.count if self.count else 0.0,
+            'buckets' : { str(bound) : count for bound, count in self.cumulative() }
+        }
+
+class StageMetrics():
+    """
+    Metrics for one plugin stage.  Safe to share between threads.
+    """
+    def __init__(self, stage, plugin):
+        """
+        Parameters
+        ----------
+        stage : string
+            Name of the stage.  Usually the plugin name, with #2, #3, ...
+            added when a plugin appears more than once.
+        plugin : string
+            Name of the plugin
+        """
+        self.stage = stage
+        self.plugin = plugin
+        self.runs = 0
+        self.wall_time = 0.0
+        self.cpu_time = 0.0
+        self.observables_in = 0
+        self.observables_out = 0
+        self.sightings_added = 0
+        self.relationships_added = 0
+        # Service name => Histogram of call latencies, and count of calls
+        # that raised an exception
+        self.calls = {}
+        self.errors = {}
+        self._lock = threading.Lock()
+
+    def record_run(self, wall_time, cpu_time, observables_in, observables_out,
+            sightings_added, relationships_added):
+        with self._lock:
+            self.runs += 1
+            self.wall_time += wall_time
+            self.cpu_time += cpu_time
+            self.observables_in += observables_in
+            self.observables_out += observables_out
+            self.sightings_added += sightings_added
+            self.relationships_added += relationships_added
+
+    def record_call(self, service, seconds, error=False):
+        with self._lock:
+            if service not in self.calls:
+                self.calls[service] = Histogram()
+                self.errors[service] = 0
+            self.calls[service].observe(seconds)
+            if error:
+                self.errors[service] += 1
+
+    def to_dict(self):
+        with self._lock:
+            return {
+                'stage'               : self.stage,
+                'plugin'              : self.plugin,
+                'runs'                : self.runs,
+                'wall_time'           : self.wall_time,
+                'cpu_time'            : self.cpu_time,
+                'observables_in'      : self.observables_in,
+                'observables_out'     : self.observables_out,
+                'sightings_added'     : self.sightings_added,
+                'relationships_added' : self.relationships_added,
+                'calls'               : {
+                    service : { **histogram.to_dict(), 'errors' : self.errors[service] }
+                    for service, histogram in sorted(self.calls.items())
+                }
+            }
+
+class Metrics():
+    """
+    The StageMetrics for every stage of a pipeline, in pipeline order
+    """
+    def __init__(self):
+        self._stages = {}
+        self._lock = threading.Lock()
+
+    def stage(self, stage, plugin=None):
+        """
+        Return the StageMetrics for a stage, creating it if need be
+        """
+        with self._lock:
+            if stage not in self._stages:
+                self._stages[stage] = StageMetrics(stage, plugin or stage)
+            return self._stages[stage]
+
+    @property
+    def stages(self):
+        with self._lock:
+            return list(self._stages.values())
+
+    def to_dict(self):
+        return { 'stages' : [ stage.to_dict() for stage in self.stages ] }
+
+    def to_json(self):
+        return json.dumps(self.to_dict(), indent=2)
+
+    def to_prometheus(self):
+        """
+        Return the metrics in the Prometheus text exposition format
+        """
+        lines = []
+        def metric(name, kind, help_text, samples):
+            lines.append("# HELP threatstash_%s %s" % (name, help_text))
+            lines.append("# TYPE threatstash_%s %s" % (name, kind))
+            for labels, value in samples:
+                lines.append("threatstash_%s{%s} %s" % (name, _labels(labels), _number(value)))
+
+        stages = [ stage.to_dict() for stage in self.stages ]
+        for field, kind, help_text in [
+                ('runs', 'counter', "Number of times the stage ran"),
+                ('wall_time', 'counter', "Seconds the stage spent running"),
+                ('cpu_time', 'counter', "CPU seconds used by the thread running the stage"),
+                ('observables_in', 'counter', "Observables in the Events given to the stage"),
+                ('observables_out', 'counter', "Observables in the Events the stage passed on"),
+                ('sightings_added', 'counter', "Sightings the stage added"),
+                ('relationships_added', 'counter', "Relationships the stage added")
+            ]:
+            name = 'stage_' + field
+            if field.endswith('_time'):
+                name = name + '_seconds'
+            metric(name + '_total', kind, help_text, [
+                ({ 'stage' : stage['stage'], 'plugin' : stage['plugin'] }, stage[field])
+                for stage in stages
+            ])
+
+        # Call latency histograms
+        name = 'external_call_duration_seconds'
+        lines.append("# HELP threatstash_%s Latency of calls to external services" % name)
+        lines.append("# TYPE threatstash_%s histogram" % name)
+        errors = []
+        for stage in self.stages:
+            with stage._lock:
+                calls = sorted(stage.calls.items())
+                for service, histogram in calls:
+                    labels = { 'stage' : stage.stage, 'plugin' : stage.plugin, 'service' : service }
+                    for bound, count in histogram.cumulative():
+                        lines.append("threatstash_%s_bucket{%s} %d" % (
+                            name, _labels({ **labels, 'le' : _number(bound) }), count))
+                    lines.append("threatstash_%s_sum{%s} %s" % (name, _labels(labels), _number(histogram.sum)))
+                    lines.append("threatstash_%s_count{%s} %d" % (name, _labels(labels), histogram.count))
+                    errors.append((labels, stage.errors[service]))
+        metric('external_call_errors_total', 'counter',
+                "Calls to external services that raised an exception", errors)
+        return "\n".join(lines) + "\n"
+
+    def write_json(self, filename):
+        _write_atomically(filename, self.to_json() + "\n")
+
+    def write_prometheus(self, filename):
+        """
+        Write a Prometheus textfile.  The file is replaced atomically so the
+        textfile collector never reads half of it.
+        """
+        _write_atomically(filename, self.to_prometheus())
+
+def _labels(labels):
+    return ",".join(
+        '%s="%s"' % (key, str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+        for key, value in labels.items()
+    )
+
+def _number(value):
+    if isinstance(value, str):
+        return value
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+def _write_atomically(filename, text):
+    directory = os.path.dirname(os.path.abspath(filename))
+    fd, temporary = tempfile.mkstemp(dir=directory, prefix='.' + os.path.basename(filename))
+    try:
+        with os.fdopen(fd, 'w') as f:
+            f.write(text)
+        # mkstemp makes the file private
+        os.chmod(temporary, 0o644)
+        os.replace(temporary, filename)
+    except BaseException:
+        os.unlink(temporary)
+        raise
@@ -3,7 +3,8 @@
 
 class Observable():
     def __init__(self, _type, value, _id=None, added_by=None,
-            relationship_type=None, first_seen=None, last_seen=None):
+            relationship_type=None, first_seen=None, last_seen=None,
+            sighted_by=None, refs=[]):
         self._id    = _id
         self._type  = _type
         self._value = value
@@ -11,6 +12,8 @@ class Observable():
         self._first_seen = first_seen
         self._last_seen  = last_seen
         self._relationship_type = relationship_type
+        self._sighted_by = sighted_by
+        self._refs = refs
 
     # Getters
     @property
@@ -41,6 +44,14 @@ class Observable():
     def relationship_type(self):
         return self._relationship_type
 
+    @property
+    def sighted_by(self):
+        return self._sighted_by
+
+    @property
+    def refs(self):
+        return self._refs
+
     # String representaiton of the observable
     def __repr__(self):
         return self.value
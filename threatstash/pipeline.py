@@ -1,15 +1,33 @@
-import inspect
+import concurrent.futures
 import logging
+import queue
+import threading
+import time
 import plugins
 import threatstash.event
+import threatstash.http
+import threatstash.ratelimit
 
 class Pipeline():
     """
     The Pipeline class loads Plugin modules and runs Events through them.
     """
-    def __init__(self, config):
+    def __init__(self, config, metrics=None):
+        """
+        Parameters
+        ----------
+        config : dict
+            The parsed configuration file
+        metrics : threatstash.metrics.Metrics
+            Optionally record performance metrics for each plugin stage here
+        """
         self._plugins = {}
         self._config  = config
+        self._metrics = metrics
+        # id => Plugin instance for the instances that have been
+        # initialized, which close() lets know we're done with.  Plugins are
+        # dicts, so they're told apart by id rather than compared.
+        self._started = {}
         # Enable of disable debugging output based on the config
         if 'global' in self.config:
             if 'quiet' in self.config['global'] and self.config['global']['quiet']:
@@ -19,66 +37,399 @@ class Pipeline():
             else:
                 logging.basicConfig(level=logging.INFO, format='%(levelname)s %(message)s')
 
-        # Build the list of plugins we want to load
-        to_load = {}
-        for plugin_config in config['plugins']:
-            to_load[plugin_config['name']] = True
-
-        # Iterate through the modules in our plugins directory
-        for name, obj in inspect.getmembers(plugins):
-            if inspect.isclass(obj) and name != "value":
-                self.debug("Found available plugin: " + name)
-                # Instantiate the plugin and find out its name
-                Plugin = getattr(plugins, name)
-                plugin = Plugin(config)
-                # Load the module if it's in our list of things to load
-                if plugin.name in to_load:
-                    self._plugins[plugin.name] = plugin
-                    self.info("Loaded plugin " + plugin.name + " from module " + name)
-                    self.debug(" |-> Type:    " + plugin.type)
-                    if plugin.observable_types:
-                        self.debug(" `-> Handles: " + ", ".join(plugin.observable_types))
-                    else:
-                        self.debug(" `-> Handles: any")
         # Validate config
         if 'plugins' not in self.config:
             raise RuntimeError("No plugins are configured")
         for plugin_config in self.config['plugins']:
             if 'name' not in plugin_config:
                 raise RuntimeError("Configured plugin missing name:" + str(plugin_config))
+
+        # Every plugin shares one HTTP client, so connections to a service
+        # are reused across plugins, observables, and Events
+        self._http = threatstash.http.HTTPClient.from_config(self.config.get('http') or {})
+        # Likewise the rate limits, so they hold no matter how many plugins,
+        # stages, and Events are calling a service
+        self._rate_limiter = threatstash.ratelimit.RateLimiter.from_config(
+                self.config.get('rate_limits') or {})
+
+        # Plugin metadata is read without importing anything
+        available = plugins.available()
+        for name, metadata in available.items():
+            self.debug("Found available plugin: " + name)
+
+        # Import and instantiate only the plugins in our config
+        for plugin_config in self.config['plugins']:
             plugin_name = plugin_config['name']
-            if plugin_name not in self.plugins:
+            if plugin_name in self.plugins:
+                continue
+            if plugin_name not in available:
                 raise RuntimeError("Configured plugin " + plugin_name + " does not exist")
+            Plugin = plugins.load(plugin_name)
+            plugin = Plugin(config)
+            plugin.http = self.http
+            plugin.rate_limiter = self.rate_limiter
+            self._plugins[plugin.name] = plugin
+            self.info("Loaded plugin %s from module %s in %.1f ms" % (
+                plugin.name,
+                Plugin.__name__,
+                plugins.import_times[plugin_name] * 1000
+            ))
+            self.debug(" |-> Type:    " + plugin.type)
+            if plugin.observable_types:
+                self.debug(" `-> Handles: " + ", ".join(plugin.observable_types))
+            else:
+                self.debug(" `-> Handles: any")
 
-    def run(self):
+    def run(self, event=None):
         """
-        Create a new Event and run all applicable Plugins against it.
+        Create a new Event, or take an existing one, and run all applicable
+        Plugins against it.  Returns the Event.  Plugins that have run on an
+        Event before only look at what has changed since.
+
+        Plugins run in config order, except that a filter which doesn't read
+        anything an earlier plugin writes doesn't have to wait for it.  Up to
+        pipeline.workers such filters run at once, each on a fork of the
+        Event, and their changes are merged back in config order, so the
+        Event comes out the same as if they had run one after another.
+
+        Call close() after the last Event.
         """
-        event = threatstash.event.Event()
-        for plugin_config in self.config['plugins']:
-            plugin_name = plugin_config['name']
-            self.info("Running " + plugin_name)
-            p = self.plugins[plugin_name]
+        if event is None:
+            event = threatstash.event.Event()
+        plugin_configs = self.config['plugins']
+        count = len(plugin_configs)
+        dependencies = self.dependencies(plugin_configs)
+        labels = self.stage_labels(plugin_configs)
+        workers = max(1, int((self.config.get('pipeline') or {}).get('workers', 4)))
+
+        # A plugin that waits for everything before it, and that everything
+        # after it waits for, can't overlap with anything, so it runs on the
+        # Event itself rather than a fork.  With one worker, that's every
+        # plugin.
+        ancestors = []
+        for i in range(count):
+            ancestors.append(set(dependencies[i]))
+            for j in dependencies[i]:
+                ancestors[i] |= ancestors[j]
+        in_place = [
+            workers == 1 or (len(ancestors[i]) == i and all(i in ancestors[k] for k in range(i + 1, count)))
+            for i in range(count)
+        ]
+
+        durations = [ None ] * count
+        start = time.perf_counter()
+        # Plugins that haven't started, plugin index => Future for the ones
+        # running on forks, and plugin index => fork for the ones that are
+        # done but can't be merged until the plugins before them are
+        waiting = list(range(count))
+        running = {}
+        finished = {}
+        # Every plugin before this index has been merged into the Event
+        merged = 0
+        with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+            while merged < count:
+                for i in list(waiting):
+                    if len(running) >= workers:
+                        break
+                    if any(j >= merged for j in dependencies[i]):
+                        continue
+                    if in_place[i]:
+                        if running or i != merged:
+                            continue
+                        waiting.remove(i)
+                        event, durations[i] = self.run_stage(plugin_configs[i], labels[i], event)
+                        merged += 1
+                        break
+                    waiting.remove(i)
+                    running[i] = executor.submit(self.run_stage, plugin_configs[i], labels[i], event.fork())
+                if not running:
+                    continue
+                done, pending = concurrent.futures.wait(
+                        running.values(), return_when=concurrent.futures.FIRST_COMPLETED)
+                for i, future in list(running.items()):
+                    if future in done:
+                        finished[i], durations[i] = future.result()
+                        del running[i]
+                while merged in finished:
+                    event.merge(finished.pop(merged))
+                    merged += 1
+        elapsed = time.perf_counter() - start
+        self.log_critical_path(plugin_configs, dependencies, durations, elapsed)
+        return event
+
+    def run_stage(self, plugin_config, label, event):
+        """
+        Configure, initialize, and run a Plugin.  Return the Event and the
+        seconds it took.
+        """
+        start = time.perf_counter()
+        plugin_name = plugin_config['name']
+        self.info("Running " + plugin_name)
+        p = self.plugins[plugin_name]
+        p.configure(plugin_config)
+        p.init()
+        self._started[id(p)] = p
+        if self.metrics is not None:
+            p.metrics = self.metrics.stage(label, plugin_name)
+        event = self.run_plugin(p, event)
+        elapsed = time.perf_counter() - start
+        self.info("Finished %s in %.1f ms" % (plugin_name, elapsed * 1000))
+        return event, elapsed
+
+    @staticmethod
+    def stage_labels(plugin_configs):
+        """
+        Return a name for each stage: the plugin name, with #2, #3, ...
+        added to the second and later stages running the same plugin
+        """
+        labels = []
+        seen = {}
+        for plugin_config in plugin_configs:
+            name = plugin_config['name']
+            seen[name] = seen.get(name, 0) + 1
+            labels.append(name if seen[name] == 1 else "%s#%d" % (name, seen[name]))
+        return labels
+
+    def dependencies(self, plugin_configs):
+        """
+        Return a list with the indexes of the earlier plugins each plugin in
+        plugin_configs has to wait for.  A plugin waits for the ones that
+        write something it reads, according to their __READS__ and
+        __WRITES__, and for earlier runs of the same plugin, which share its
+        instance.
+        """
+        available = plugins.available()
+        dependencies = []
+        for i, plugin_config in enumerate(plugin_configs):
+            reads = set(available[plugin_config['name']]['reads'])
+            waits_for = []
+            for j in range(i):
+                earlier = plugin_configs[j]['name']
+                writes = set(available[earlier]['writes'])
+                if earlier == plugin_config['name'] or self._overlaps(writes, reads):
+                    waits_for.append(j)
+            dependencies.append(waits_for)
+        return dependencies
+
+    @staticmethod
+    def _overlaps(a, b):
+        if not a or not b:
+            return False
+        return '*' in a or '*' in b or not a.isdisjoint(b)
+
+    @staticmethod
+    def critical_path(dependencies, durations):
+        """
+        Return the seconds taken by the chain of dependent plugins that took
+        the longest, which is the least time the run could have taken, and
+        the indexes of the plugins in the chain
+        """
+        # Plugin index => (seconds to the end of the plugin along its
+        # slowest chain, previous plugin in the chain)
+        paths = []
+        for i, duration in enumerate(durations):
+            previous = max(dependencies[i], key=lambda j: paths[j][0], default=None)
+            before = paths[previous][0] if previous is not None else 0.0
+            paths.append((before + duration, previous))
+        if not paths:
+            return 0.0, []
+        i = max(range(len(paths)), key=lambda i: paths[i][0])
+        total = paths[i][0]
+        chain = []
+        while i is not None:
+            chain.append(i)
+            i = paths[i][1]
+        return total, list(reversed(chain))
+
+    def log_critical_path(self, plugin_configs, dependencies, durations, elapsed):
+        """
+        Log the critical path of a run
+        """
+        total, chain = self.critical_path(dependencies, durations)
+        if not chain:
+            return
+        self.info("Critical path: %s, %.1f ms of %.1f ms" % (
+            " -> ".join("%s (%.1f ms)" % (plugin_configs[i]['name'], durations[i] * 1000) for i in chain),
+            total * 1000, elapsed * 1000))
+
+    def close(self):
+        """
+        Let each Plugin that has run know we're done with it, and log the
+        rate limit stats.  Call this once, after the last Event.
+        """
+        self.finish(self._started.values())
+        self._started = {}
+
+    def finish(self, instances):
+        """
+        Let each Plugin know we're done with it
+        """
+        for p in instances:
+            try:
+                p.finish()
+            except Exception:
+                logging.exception('[pipeline] ' + p.name + ' failed to finish')
+        for service, stats in self.rate_limiter.stats().items():
+            self.info("Rate limit for %s: %d calls, %d delayed, %.3f s waiting (%.3f s max), %d over quota" % (
+                    service,
+                    stats['acquired'],
+                    stats['delayed'],
+                    stats['wait_time'],
+                    stats['max_wait'],
+                    stats['rejected']
+                ))
+
+    def run_plugin(self, p, event):
+        """
+        Run a configured Plugin against an Event if it applies, and return the
+        Event.  Afterwards the Plugin's watermark records that it has seen
+        every change made before it started.
+        """
+        plugin_name = p.name
+        sequence = event.sequence
+        metrics = p.metrics
+        if metrics is not None:
+            start = time.perf_counter()
+            cpu_start = time.thread_time()
+            observables_in = len(event.observables)
+        # Input plugins gather IOCs rather than operating on them
+        if p.type == "input":
+            p.run(event)
+        # Some plugins operate on the context field rather than
+        # observables
+        elif p.handles("context"):
+            p.run(event)
+        else:
+            # If this isn't an input plugin, check the types of the
+            # Event's IOCs against those handled by the plugin before
+            # running it.
+            for observable_type, count in event.observable_types.items():
+                self.debug(" |-> Testing " + plugin_name + " against " + observable_type)
+                if p.handles(observable_type):
+                    self.debug(" `-> Success! (" + str(count) + " observables)")
+                    event = p.run(event)
+                    break
+                else:
+                    self.debug(" `-> Failure")
+        event.set_watermark(p.delta_key, sequence)
+        if metrics is not None:
+            added = {}
+            for record in event.changes_since(sequence):
+                added[record.type] = added.get(record.type, 0) + 1
+            metrics.record_run(
+                    time.perf_counter() - start,
+                    time.thread_time() - cpu_start,
+                    observables_in,
+                    len(event.observables),
+                    added.get('sighting', 0),
+                    added.get('relationship', 0)
+                )
+        return event
+
+    def stream(self, queue_size=16):
+        """
+        Run a stream of Events through the pipeline.
+
+        The first configured plugin must be an input plugin.  Its events()
+        generator supplies the Events, and every other plugin runs as a stage
+        in its own thread.  Stages are connected by queues holding at most
+        queue_size Events, so a slow stage makes the stages in front of it
+        wait rather than let Events pile up in memory.
+
+        Each stage gets its own instance of its plugin, which is configured
+        and initialized once and then stays loaded for every Event.  The
+        first stage running a plugin uses the instance loaded for it, and
+        any later stages running the same plugin get a new one.  Returns the
+        number of Events processed.  Call close() afterwards.
+        """
+        plugin_configs = self.config['plugins']
+        if self.plugins[plugin_configs[0]['name']].type != "input":
+            raise RuntimeError("Streaming requires an input plugin at the start of the pipeline")
+
+        # Configure and initialize a plugin instance for each stage
+        stages = []
+        for plugin_config, label in zip(plugin_configs, self.stage_labels(plugin_configs)):
+            p = self.plugins[plugin_config['name']]
+            if any(stage is p for stage in stages):
+                p = p.__class__(self.config)
+                p.http = self.http
+                p.rate_limiter = self.rate_limiter
+            if self.metrics is not None:
+                p.metrics = self.metrics.stage(label, p.name)
             p.configure(plugin_config)
             p.init()
-            # Input plugins gather IOCs rather than operating on them
-            if p.type == "input":
-                p.run(event)
-            # Some plugins operate on the context field rather than
-            # observables
-            elif p.handles("context"):
-                p.run(event)
-            else:
-                # If this isn't an input plugin, check the Event's IOCs against
-                # those handled by the plugin before running it.
-                for observable in event.observables:
-                    self.debug(" |-> Testing " + plugin_name + " against " + observable.type)
-                    if p.handles(observable.type):
-                        self.debug(" `-> Success!")
-                        event = p.run(event)
+            stages.append(p)
+            self._started[id(p)] = p
+
+        # One queue feeds each stage after the input.  None marks the end of
+        # the stream.
+        queues = [ queue.Queue(maxsize=queue_size) for stage in stages[1:] ]
+        queues.append(None)
+        processed = [0]
+
+        def source(p, outbox):
+            try:
+                events = p.events()
+                while True:
+                    # The time spent producing each Event counts as a run
+                    start = time.perf_counter()
+                    cpu_start = time.thread_time()
+                    event = next(events, None)
+                    if event is None:
                         break
+                    if p.metrics is not None:
+                        p.metrics.record_run(
+                                time.perf_counter() - start,
+                                time.thread_time() - cpu_start,
+                                0,
+                                len(event.observables),
+                                len(event.sightings()),
+                                len(event.relationships)
+                            )
+                    if outbox:
+                        outbox.put(event)
                     else:
-                        self.debug(" `-> Failure")
+                        processed[0] += 1
+            except Exception:
+                logging.exception('[pipeline] ' + p.name + ' failed')
+            finally:
+                if outbox:
+                    outbox.put(None)
+
+        def stage(p, inbox, outbox):
+            while True:
+                event = inbox.get()
+                if event is None:
+                    break
+                try:
+                    event = self.run_plugin(p, event)
+                except Exception:
+                    # Don't let one bad Event stop the stream.  Pass it
+                    # along as it is.  Plugins change the Event in place, so
+                    # it keeps whatever this plugin did before it failed.
+                    logging.exception('[pipeline] ' + p.name + ' failed')
+                if outbox:
+                    outbox.put(event)
+                else:
+                    processed[0] += 1
+            if outbox:
+                outbox.put(None)
+
+        threads = [ threading.Thread(
+                target=source, args=(stages[0], queues[0]),
+                name=stages[0].name, daemon=True) ]
+        for i in range(1, len(stages)):
+            threads.append(threading.Thread(
+                target=stage, args=(stages[i], queues[i - 1], queues[i]),
+                name=stages[i].name, daemon=True))
+
+        self.info("Streaming through " + str(len(stages)) + " stages")
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.info("Processed " + str(processed[0]) + " events")
+        return processed[0]
 
     @property
     def plugins(self):
@@ -87,6 +438,18 @@ class Pipeline():
     @property
     def config(self):
         return self._config
+
+    @property
+    def http(self):
+        return self._http
+
+    @property
+    def rate_limiter(self):
+        return self._rate_limiter
+
+    @property
+    def metrics(self):
+        return self._metrics
     
     def debug(self, message):
         if type(message) == list:
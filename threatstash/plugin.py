@@ -1,4 +1,11 @@
+import asyncio
+import concurrent.futures
+import contextlib
+import json
 import logging
+import time
+
+import threatstash.event
 
 class Plugin(dict):
     """
@@ -43,6 +50,15 @@ class Plugin(dict):
         if self.name in config:
             self._config = { **self._config, **config[self.name] }
 
+        # Shared HTTP client and rate limiter, normally supplied by the
+        # Pipeline
+        self._http = None
+        self._rate_limiter = None
+
+        # threatstash.metrics.StageMetrics for the stage this plugin is
+        # running as, set by the Pipeline when metrics are enabled
+        self.metrics = None
+
         # Enable of disable debugging output based on the config
         if self.config['debug']:
             logging.basicConfig(level=logging.DEBUG)
@@ -76,6 +92,76 @@ class Plugin(dict):
     def config(self):
         return self._config
 
+    @property
+    def http(self):
+        """
+        The threatstash.http.HTTPClient to make web requests with.  Plugins
+        run outside a Pipeline get a shared client with the default options.
+        """
+        if self._http is None:
+            # Deferred so plugins that don't use HTTP don't import requests
+            import threatstash.http
+            self._http = threatstash.http.default()
+        return self._http
+
+    @http.setter
+    def http(self, client):
+        self._http = client
+
+    @property
+    def rate_limiter(self):
+        """
+        The threatstash.ratelimit.RateLimiter shared by every plugin.  Plugins
+        run outside a Pipeline get one with no limits.
+        """
+        if self._rate_limiter is None:
+            import threatstash.ratelimit
+            self._rate_limiter = threatstash.ratelimit.default()
+        return self._rate_limiter
+
+    @rate_limiter.setter
+    def rate_limiter(self, limiter):
+        self._rate_limiter = limiter
+
+    def acquire(self, tokens=1):
+        """
+        Wait until the rate limit for this plugin's service allows another
+        call, and return the number of seconds waited.  The service is named
+        by config['rate_limit'] and configured in the 'rate_limits' section
+        of the config.  Raises threatstash.ratelimit.QuotaExceeded once the
+        service's daily quota is used up.
+        """
+        service = self.config.get('rate_limit')
+        if not service:
+            return 0.0
+        return self.rate_limiter.acquire(service, tokens)
+
+    @contextlib.contextmanager
+    def external_call(self, service=None):
+        """
+        Time a call to an external service for the metrics, e.g.
+
+            with self.external_call():
+                r = self.http.get(url)
+
+        The service defaults to the one named by config['rate_limit'], or
+        else the plugin name.  Calls that raise an exception are counted as
+        errors.
+        """
+        if self.metrics is None:
+            yield
+            return
+        service = service or self.config.get('rate_limit') or self.name
+        start = time.perf_counter()
+        error = False
+        try:
+            yield
+        except BaseException:
+            error = True
+            raise
+        finally:
+            self.metrics.record_call(service, time.perf_counter() - start, error)
+
     # Return true if this plugin handles the provided IOC type.  If the IOC
     # type list for the plugin is empty, it is assumed to handle all types.
     def handles(self, observable_type):
@@ -98,6 +184,58 @@ class Plugin(dict):
     def run(self, event):
         return event
 
+    # Delta processing.  The Pipeline records how far through an Event's
+    # changes each plugin had got when it last ran on the Event, so a plugin
+    # that runs on the same Event again can skip what it has already seen.
+    # A plugin with the same name and config would do the same work twice,
+    # so it shares a watermark, but a second instance with, say, different
+    # warning lists doesn't.
+    @property
+    def delta_key(self):
+        """
+        Key for this plugin's watermarks in an Event
+        """
+        return self.name + ' ' + json.dumps(self.config, sort_keys=True, default=str)
+
+    def watermark(self, event):
+        """
+        Return the Event sequence number this plugin had seen up to when it
+        last ran on event, or None if it hasn't
+        """
+        return event.watermark(self.delta_key)
+
+    def new_observables(self, event, *types):
+        """
+        Return the Observables of the given types added to event since this
+        plugin last ran on it.  The first time, that's all of them.
+        """
+        return event.observables_since(self.watermark(event), *types)
+
+    def new_sightings(self, event):
+        """
+        Return the Sightings added to event since this plugin last ran on it
+        """
+        return event.sightings_since(self.watermark(event))
+
+    def new_relationships(self, event):
+        """
+        Return the Relationships added to event since this plugin last ran
+        on it
+        """
+        return event.relationships_since(self.watermark(event))
+
+    # Called once after the last Event has gone through the plugin, at the
+    # end of a run or a stream.  Report statistics or release resources here.
+    def finish(self):
+        pass
+
+    # Generate Events for the streaming pipeline.  Input plugins that can
+    # produce more than one Event should override this and yield each Event
+    # as soon as it's ready.  By default we yield a single Event populated by
+    # run().
+    def events(self):
+        yield self.run(threatstash.event.Event())
+
     def debug(self, *message, exc_info=False):
         message = " ".join(message)
         logging.debug('[' + self.name + '] ' + message, exc_info=exc_info)
@@ -117,3 +255,77 @@ class Plugin(dict):
             'type' : self.type,
             'observable_types' : self.observable_types
         }
+
+class EnrichmentPlugin(Plugin):
+    """
+    Superclass for plugins that look things up in an external service.
+
+    Subclasses implement lookup(), which is called once per item and may
+    block, and apply(), which adds the result of a lookup to the Event.
+    Up to config['concurrency'] lookups run at once, each in a thread of its
+    own, or as a coroutine on an event loop if lookup() is a coroutine
+    function.  apply() is always called from the thread running the plugin,
+    once per item, in the order items() returned them, so the Event ends up
+    the same no matter what order the lookups finish in.
+    """
+    def __init__(self, name, ptype, observable_types, required_parameters=[], config={}):
+        super().__init__(name, ptype, observable_types, required_parameters, config)
+        # Maximum number of lookups in flight at once
+        if 'concurrency' not in self.config:
+            self.config['concurrency'] = 8
+
+    # Return the things to look up.  By default that's every Observable of
+    # the types we handle that we haven't already looked up.
+    def items(self, event):
+        return self.new_observables(event, *self.observable_types)
+
+    # Look up one item and return the result.  May be a coroutine function.
+    def lookup(self, item):
+        return None
+
+    # Add the result of looking up an item to the Event
+    def apply(self, event, item, result):
+        pass
+
+    def run(self, event):
+        items = list(self.items(event))
+        for item, result in zip(items, self.lookup_all(items)):
+            self.apply(event, item, result)
+        return event
+
+    def lookup_all(self, items):
+        """
+        Look up every item concurrently and return an iterator of the
+        results in the same order as items.  If a lookup raises an
+        exception, it's raised again when its result is reached.
+        """
+        if not items:
+            return iter([])
+        concurrency = max(1, int(self.config['concurrency']))
+        if asyncio.iscoroutinefunction(self.lookup):
+            return self._results(asyncio.run(self._lookup_async(items, concurrency)))
+        if concurrency == 1 or len(items) == 1:
+            return map(self.lookup, items)
+        return self._lookup_threaded(items, concurrency)
+
+    def _lookup_threaded(self, items, concurrency):
+        with concurrent.futures.ThreadPoolExecutor(max_workers=min(concurrency, len(items))) as executor:
+            futures = [ executor.submit(self.lookup, item) for item in items ]
+            for future in futures:
+                yield future.result()
+
+    async def _lookup_async(self, items, concurrency):
+        semaphore = asyncio.Semaphore(concurrency)
+        async def bounded(item):
+            async with semaphore:
+                return await self.lookup(item)
+        return await asyncio.gather(
+                *[ bounded(item) for item in items ],
+                return_exceptions=True
+            )
+
+    def _results(self, results):
+        for result in results:
+            if isinstance(result, BaseException):
+                raise result
+            yield result
@@ -0,0 +1,98 @@
+# Public suffix lookups
+#
+# The Mozilla public suffix list that ships with the tld package, loaded once
+# per process into a trie keyed by reversed labels.  Lookups give the same
+# answers as tld.get_tld() and tld.get_fld() for a bare hostname, without
+# parsing a URL each time.
+#
+# See https://publicsuffix.org
+
+import os
+import threading
+
+import tld
+
+# The copy of the list that ships with the tld package
+_PUBLIC_SUFFIX_LIST = os.path.join(os.path.dirname(tld.__file__), 'res', 'effective_tld_names.dat.txt')
+
+# Trie nodes are dicts of label => child node.  The None key is set on nodes
+# that end a rule, and the _EXCEPTION key holds the label excluded by a "!"
+# rule under that node.
+_EXCEPTION = ('!',)
+
+_trie = None
+_lock = threading.Lock()
+
+def load(filename=None):
+    """
+    Load the public suffix list.  This happens automatically the first time
+    a lookup is made.  By default the list is read from the tld package.
+    """
+    global _trie
+    if filename is None:
+        filename = _PUBLIC_SUFFIX_LIST
+    trie = {}
+    with open(filename, encoding='utf8') as f:
+        for line in f:
+            # Punycode versions of IDN rules are in the comments
+            if '// xn--' in line:
+                line = line.split()[1]
+            if line[0] in ('/', '\n'):
+                continue
+            node = trie
+            for label in reversed(line.strip().split('.')):
+                if label.startswith('!'):
+                    node[_EXCEPTION] = label[1:]
+                    break
+                node = node.setdefault(label, {})
+            node[None] = True
+    with _lock:
+        _trie = trie
+
+# Return the labels of hostname and the number of them that make up its
+# public suffix, or 0 if it doesn't have one
+def _split(hostname):
+    if _trie is None:
+        load()
+    labels = hostname.lower().rstrip('.').split('.')
+    node = _trie
+    depth = 0
+    suffix_length = 0
+    for label in reversed(labels):
+        if label == node.get(_EXCEPTION):
+            break
+        child = node.get(label)
+        if child is None:
+            child = node.get('*')
+        if child is None:
+            break
+        depth += 1
+        node = child
+        if None in node:
+            suffix_length = depth
+    return labels, suffix_length
+
+def tld(hostname):
+    """
+    Return the public suffix of hostname, e.g. "co.uk" for
+    "www.evil.co.uk", or None if it doesn't end in one
+    """
+    labels, suffix_length = _split(hostname)
+    if not suffix_length:
+        return None
+    if suffix_length == len(labels):
+        return hostname.lower()
+    return '.'.join(labels[-suffix_length:])
+
+def fld(hostname):
+    """
+    Return the first level domain of hostname, e.g. "evil.co.uk" for
+    "www.evil.co.uk", or None if it doesn't end in a public suffix.  A
+    hostname that is itself a public suffix is its own first level domain.
+    """
+    labels, suffix_length = _split(hostname)
+    if not suffix_length:
+        return None
+    if suffix_length == len(labels):
+        return hostname.lower()
+    return '.'.join(labels[-suffix_length - 1:])
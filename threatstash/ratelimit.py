@@ -0,0 +1,202 @@
+# Rate limits and quotas for external services
+#
+# Each service (dnsdb, moloch, cbr, ...) gets a token bucket that refills at
+# rate tokens per second and holds up to burst of them, plus an optional
+# number of calls allowed per UTC day.  Plugins acquire a token before every
+# call to the service.  When the bucket is empty, acquire() sleeps until the
+# caller's turn comes round.  Each caller reserves its slot before sleeping,
+# so concurrent lookups are spaced evenly at the configured rate instead of
+# all waking up at once.
+#
+# The Pipeline creates one RateLimiter from the 'rate_limits' section of the
+# config and hands it to every plugin, so the limits hold across plugins,
+# stream stages, and Events.
+
+import threading
+import time
+
+_default = None
+_default_lock = threading.Lock()
+
+class QuotaExceeded(Exception):
+    """
+    Raised by acquire() once a service's daily quota has been used up
+    """
+    pass
+
+class TokenBucket():
+    """
+    Rate limit and daily quota for one service.  Safe to share between
+    threads.
+    """
+    def __init__(self, rate, burst=None, daily_quota=None):
+        """
+        Parameters
+        ----------
+        rate : float
+            Calls per second allowed on average
+        burst : float
+            Calls allowed back to back after a quiet spell.  Defaults to
+            rate, or 1 if rate is less than 1.
+        daily_quota : int
+            Calls allowed per UTC day.  None for no quota.
+        """
+        if rate <= 0:
+            raise ValueError("rate must be positive")
+        self._rate = float(rate)
+        self._burst = float(burst) if burst else max(1.0, self._rate)
+        self._daily_quota = daily_quota
+        self._lock = threading.Lock()
+        self._tokens = self._burst
+        self._updated = time.monotonic()
+        self._day = None
+        self._used_today = 0
+
+        # Calls let through, how many of them had to wait, and for how long
+        self.acquired = 0
+        self.delayed = 0
+        self.wait_time = 0.0
+        self.max_wait = 0.0
+        # Calls refused because the quota was used up
+        self.rejected = 0
+
+    @property
+    def rate(self):
+        return self._rate
+
+    @property
+    def burst(self):
+        return self._burst
+
+    @property
+    def daily_quota(self):
+        return self._daily_quota
+
+    def acquire(self, tokens=1):
+        """
+        Wait until tokens calls are allowed and return the number of seconds
+        waited.  Raises QuotaExceeded if they would go over the daily quota.
+        """
+        with self._lock:
+            if self._daily_quota is not None:
+                day = int(time.time() // 86400)
+                if day != self._day:
+                    self._day = day
+                    self._used_today = 0
+                if self._used_today + tokens > self._daily_quota:
+                    self.rejected += 1
+                    raise QuotaExceeded("Daily quota of %d calls used up" % self._daily_quota)
+                self._used_today += tokens
+            now = time.monotonic()
+            self._tokens = min(self._burst, self._tokens + (now - self._updated) * self._rate)
+            self._updated = now
+            # Going negative reserves tokens that haven't been added yet.
+            # Whoever comes next waits for those too.
+            self._tokens -= tokens
+            wait = -self._tokens / self._rate if self._tokens < 0 else 0.0
+            self.acquired += tokens
+            if wait > 0:
+                self.delayed += 1
+                self.wait_time += wait
+                self.max_wait = max(self.max_wait, wait)
+        if wait > 0:
+            time.sleep(wait)
+        return wait
+
+    def remaining_today(self):
+        """
+        Return the number of calls left in today's quota, or None if there
+        isn't one
+        """
+        if self._daily_quota is None:
+            return None
+        with self._lock:
+            if self._day != int(time.time() // 86400):
+                return self._daily_quota
+            return self._daily_quota - self._used_today
+
+    def stats(self):
+        """
+        Return a dict of call counts and wait times since the bucket was
+        created
+        """
+        with self._lock:
+            return {
+                'acquired'        : self.acquired,
+                'delayed'         : self.delayed,
+                'rejected'        : self.rejected,
+                'wait_time'       : self.wait_time,
+                'max_wait'        : self.max_wait,
+                'mean_wait'       : self.wait_time / self.acquired if self.acquired else 0.0,
+                'remaining_today' : None if self._daily_quota is None
+                        else self._daily_quota - self._used_today
+            }
+
+class RateLimiter():
+    """
+    A TokenBucket for each rate limited service.  Calls to services without
+    a configured limit go straight through.
+    """
+    def __init__(self, buckets=None):
+        """
+        Parameters
+        ----------
+        buckets : dict
+            Service name => TokenBucket
+        """
+        self._buckets = dict(buckets or {})
+
+    @classmethod
+    def from_config(cls, config):
+        """
+        Create a limiter from a dict of service name => dict of rate, burst,
+        and daily_quota, e.g. the 'rate_limits' section of the config file
+        """
+        buckets = {}
+        for service, options in config.items():
+            if 'rate' not in options:
+                raise KeyError("Missing rate for rate limited service " + service)
+            buckets[service] = TokenBucket(
+                    options['rate'],
+                    burst=options.get('burst'),
+                    daily_quota=options.get('daily_quota')
+                )
+        return cls(buckets)
+
+    @property
+    def services(self):
+        return sorted(self._buckets)
+
+    def bucket(self, service):
+        """
+        Return the TokenBucket for service, or None if it isn't limited
+        """
+        return self._buckets.get(service)
+
+    def acquire(self, service, tokens=1):
+        """
+        Wait until service can take tokens more calls and return the number
+        of seconds waited.  Raises QuotaExceeded once its daily quota is
+        used up.
+        """
+        bucket = self._buckets.get(service)
+        if bucket is None:
+            return 0.0
+        return bucket.acquire(tokens)
+
+    def stats(self):
+        """
+        Return a dict of service name => TokenBucket.stats()
+        """
+        return { service : bucket.stats() for service, bucket in sorted(self._buckets.items()) }
+
+def default():
+    """
+    Return a process-wide RateLimiter with no limits, for plugins running
+    outside a Pipeline
+    """
+    global _default
+    with _default_lock:
+        if _default is None:
+            _default = RateLimiter()
+        return _default
@@ -0,0 +1,249 @@
+# Compact native records for the objects stored in a threatstash.Event.
+#
+# Building and validating STIX 2 objects is expensive, so Event stores plain
+# records and only builds the STIX 2 ObservedData, Observable, Relationship,
+# and Sighting objects when someone asks for them, e.g. for a bundle export.
+# Any attribute that a record doesn't store natively is looked up on its STIX 2
+# object, so code written against the STIX objects keeps working.
+
+import uuid
+
+from datetime import datetime, timezone
+
+# Map observable types to the STIX 2 Observable class that holds them
+_OBSERVABLE_CLASSES = {
+    'autonomous-system' : 'AutonomousSystem',
+    'domain-name'       : 'DomainName',
+    'email-addr'        : 'EmailAddress',
+    'ipv4-addr'         : 'IPv4Address',
+    'ipv6-addr'         : 'IPv6Address',
+    'url'               : 'URL'
+}
+
+# File hashes are stored as a File Observable with a hashes dict
+HASH_TYPES = ['md5', 'sha1', 'sha256', 'sha512', 'ssdeep']
+
+OBSERVABLE_TYPES = list(_OBSERVABLE_CLASSES.keys()) + HASH_TYPES
+
+def new_id(stix_type):
+    """
+    Return a new STIX 2 identifier, e.g. observed-data--<uuid4>
+    """
+    return stix_type + '--' + str(uuid.uuid4())
+
+def utc(timestamp):
+    """
+    Return a datetime in UTC.  Naive datetimes are assumed to be UTC, which is
+    what the STIX 2 library does with them.
+    """
+    if timestamp is None:
+        return None
+    if timestamp.tzinfo is None:
+        return timestamp.replace(tzinfo=timezone.utc)
+    return timestamp.astimezone(timezone.utc)
+
+class Record():
+    """
+    Superclass for the records stored in an Event.
+    """
+    __slots__ = ('id', 'created', '_stix')
+
+    def __init__(self, _id, created=None):
+        self.id = _id
+        self.created = created or datetime.now(timezone.utc)
+        self._stix = None
+
+    def stix(self):
+        """
+        Return the STIX 2 object for this record, building it on first use
+        """
+        if self._stix is None:
+            self._stix = self.to_stix()
+        return self._stix
+
+    def to_stix(self):
+        raise NotImplementedError
+
+    # Anything we don't store natively comes from the STIX 2 object
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        return getattr(self.stix(), name)
+
+    def __repr__(self):
+        return "%s(%s)" % (self.__class__.__name__, self.id)
+
+class ExternalReference():
+    """
+    A STIX 2 external reference
+    """
+    __slots__ = ('source_name', 'external_id', 'url')
+
+    def __init__(self, source_name, external_id, url=None):
+        self.source_name = source_name
+        self.external_id = external_id
+        self.url = url
+
+    # Code written against the STIX 2 objects reads references like dicts,
+    # e.g. ref['source_name']
+    def __getitem__(self, key):
+        if key not in self.__slots__:
+            raise KeyError(key)
+        return getattr(self, key)
+
+    def to_dict(self):
+        return {
+            'source_name' : self.source_name,
+            'external_id' : self.external_id,
+            'url'         : self.url
+        }
+
+class ObservedDataRecord(Record):
+    """
+    An ObservedData containing a single Observable
+    """
+    __slots__ = ('observable_type', 'value', 'added_by', 'refs',
+            'first_observed', 'last_observed', 'number_observed')
+
+    type = 'observed-data'
+
+    def __init__(self, observable_type, value, added_by=None, refs=[],
+            _id=None, created=None, first_observed=None, last_observed=None,
+            number_observed=1):
+        super().__init__(_id or new_id(self.type), created)
+        self.observable_type = observable_type
+        self.value = value
+        self.added_by = added_by
+        self.refs = refs
+        self.first_observed = first_observed or self.created
+        self.last_observed = last_observed or self.created
+        self.number_observed = number_observed
+
+    @classmethod
+    def from_stix(cls, observed_data):
+        """
+        Create a record from a STIX 2 ObservedData.  Only the first Observable
+        in the ObservedData is kept.
+        """
+        observable = list(observed_data.objects.values())[0]
+        if observable.type == 'file':
+            # The STIX 2 library normalizes hash names, e.g. SHA-256
+            observable_type, value = list(observable.hashes.items())[0]
+            observable_type = observable_type.lower().replace('-', '')
+        else:
+            observable_type = observable.type
+            value = observable.value
+        record = cls(
+                observable_type,
+                value,
+                added_by = observed_data.get('added_by'),
+                refs = observed_data.get('refs', []),
+                _id = observed_data.id,
+                created = utc(observed_data.created),
+                first_observed = utc(observed_data.first_observed),
+                last_observed = utc(observed_data.last_observed),
+                number_observed = observed_data.number_observed
+            )
+        record._stix = observed_data
+        return record
+
+    def to_stix(self):
+        import stix2
+
+        if self.observable_type in HASH_TYPES:
+            observable = stix2.File(hashes={ self.observable_type : self.value })
+        else:
+            Observable = getattr(stix2, _OBSERVABLE_CLASSES[self.observable_type])
+            observable = Observable(value=self.value)
+
+        return stix2.ObservedData(
+                id = self.id,
+                created = self.created,
+                modified = self.created,
+                first_observed = self.first_observed,
+                last_observed = self.last_observed,
+                number_observed = self.number_observed,
+                objects = { 0 : observable },
+                custom_properties = {
+                    'added_by' : self.added_by,
+                    'refs' : self.refs
+                }
+        )
+
+class RelationshipRecord(Record):
+    """
+    A Relationship between two ObservedData objects
+    """
+    __slots__ = ('source_ref', 'target_ref', 'relationship_type')
+
+    type = 'relationship'
+
+    def __init__(self, source_ref, target_ref, relationship_type, _id=None,
+            created=None):
+        super().__init__(_id or new_id(self.type), created)
+        self.source_ref = source_ref
+        self.target_ref = target_ref
+        self.relationship_type = relationship_type
+
+    @classmethod
+    def from_stix(cls, relationship):
+        record = cls(
+                relationship.source_ref,
+                relationship.target_ref,
+                relationship.relationship_type,
+                _id = relationship.id,
+                created = utc(relationship.created)
+            )
+        record._stix = relationship
+        return record
+
+    def to_stix(self):
+        import stix2
+
+        return stix2.Relationship(
+                id = self.id,
+                created = self.created,
+                modified = self.created,
+                source_ref = self.source_ref,
+                target_ref = self.target_ref,
+                relationship_type = self.relationship_type
+        )
+
+class SightingRecord(Record):
+    """
+    A Sighting of an ObservedData
+    """
+    __slots__ = ('sighting_of_ref', 'first_seen', 'last_seen', 'sighted_by',
+            'external_references', 'count')
+
+    type = 'sighting'
+
+    def __init__(self, sighting_of_ref, first_seen=None, last_seen=None,
+            sighted_by=None, external_references=[], count=1, _id=None,
+            created=None):
+        super().__init__(_id or new_id(self.type), created)
+        self.sighting_of_ref = sighting_of_ref
+        self.first_seen = utc(first_seen)
+        self.last_seen = utc(last_seen)
+        self.sighted_by = sighted_by
+        self.external_references = external_references
+        self.count = count
+
+    def to_stix(self):
+        import stix2
+
+        return stix2.Sighting(
+                self.sighting_of_ref,
+                id = self.id,
+                created = self.created,
+                modified = self.created,
+                first_seen = self.first_seen,
+                last_seen = self.last_seen,
+                custom_properties = {
+                    'sighted_by' : self.sighted_by
+                },
+                external_references = [
+                    ref.to_dict() for ref in self.external_references
+                ],
+                count = self.count
+        )
@@ -0,0 +1,126 @@
+#####################################
+# Extract IOCs from freeform text   #
+#####################################
+#
+# scan() refangs a whole buffer and extracts every candidate IOC from it in a
+# single pass.  Candidates aren't validated here; see filter-freeform for
+# that.
+#
+# The results match what filter-freeform used to get by running a set of
+# regular expressions over each line:
+#   - IPs are dotted quads
+#   - On a line containing http:// or https://, URLs are anything from the
+#     scheme up to the next whitespace.  On other lines, URLs are hostnames
+#     followed by a path, and get an http:// prefix.
+#   - Hostnames are runs of letters, digits, dashes, and dots ending in a dot
+#     and at least two letters
+#   - Hashes are runs of exactly 32, 40, or 64 hex digits
+
+import collections
+import re
+
+import threatstash.util
+
+# A candidate IOC.  start and end are offsets into the refanged text.
+Match = collections.namedtuple('Match', ['type', 'value', 'start', 'end'])
+
+# Everything we care about is a whitespace-delimited token containing a dot or
+# a ://, or a hash.
+_CANDIDATE = re.compile(r'''
+      (?P<token>(?<!\S)(?=\S*?(?:\.|://))\S+)
+    | (?P<hash>\b[a-fA-F0-9]{32}(?:[a-fA-F0-9]{8}|[a-fA-F0-9]{32})?\b)
+''', re.VERBOSE)
+
+_IP       = re.compile(r'\d{1,3}\.\d{1,3}\.\d{1,3}\.\d{1,3}')
+_SCHEME   = re.compile(r'https?://')
+_URL      = re.compile(r'https?://\S+')
+_BARE_URL = re.compile(r'[a-zA-Z0-9-\.]+\.[a-zA-Z]{2,}/\S+')
+_HOSTNAME = re.compile(r'[a-zA-Z0-9-\.]+\.[a-zA-Z]{2,}')
+_HASH     = re.compile(r'\b[a-fA-F0-9]{32}(?:[a-fA-F0-9]{8}|[a-fA-F0-9]{32})?\b')
+
+_HASH_TYPES = { 32 : 'md5', 40 : 'sha1', 64 : 'sha256' }
+
+def scan(text):
+    """
+    Refang text and return a list of Match tuples for every candidate IOC in
+    it.  Types are ipv4-addr, url, domain-name, md5, sha1, and sha256.
+    Matches of each type are in the order they appear in the text.
+    """
+    # None of the defanged forms span a line, so refanging the whole buffer
+    # gives the same result as refanging it a line at a time.
+    text = threatstash.util.refang(text)
+    matches = []
+    # Line start offset => True if the line has http:// or https:// in it.
+    # Bare URLs only count on lines without one.
+    schemes = {}
+
+    for m in _CANDIDATE.finditer(text):
+        start = m.start()
+        if m.lastgroup == 'hash':
+            value = m.group()
+            matches.append(Match(_HASH_TYPES[len(value)], value, start, m.end()))
+            continue
+
+        # A token containing a dot or ://
+        token = m.group()
+        for ip in _IP.finditer(token):
+            matches.append(Match('ipv4-addr', ip.group(), start + ip.start(), start + ip.end()))
+
+        for url in _URL.finditer(token):
+            matches.append(Match('url', url.group(), start + url.start(), start + url.end()))
+        for url in _BARE_URL.finditer(token):
+            line_start = text.rfind('\n', 0, start) + 1
+            if line_start not in schemes:
+                line_end = text.find('\n', start)
+                if line_end < 0:
+                    line_end = len(text)
+                schemes[line_start] = bool(_SCHEME.search(text, line_start, line_end))
+            if not schemes[line_start]:
+                matches.append(Match('url', 'http://' + url.group(), start + url.start(), start + url.end()))
+
+        for hostname in _HOSTNAME.finditer(token):
+            matches.append(Match('domain-name', hostname.group(), start + hostname.start(), start + hostname.end()))
+
+        for h in _HASH.finditer(token):
+            matches.append(Match(_HASH_TYPES[len(h.group())], h.group(), start + h.start(), start + h.end()))
+
+    return matches
+
+def extract(text):
+    """
+    Return a list of unique (type, value) tuples for the candidate IOCs in
+    text, in the order they first appear
+    """
+    found = {}
+    for match in scan(text):
+        found[(match.type, match.value)] = True
+    return list(found)
+
+def chunks(text, chunk_size):
+    """
+    Split text into pieces of roughly chunk_size characters.  Pieces only
+    break after a newline, so no line is ever split.
+    """
+    start = 0
+    while start < len(text):
+        end = text.find('\n', start + chunk_size)
+        if end < 0:
+            yield text[start:]
+            return
+        yield text[start:end + 1]
+        start = end + 1
+
+def extract_parallel(text, executor, chunk_size):
+    """
+    Like extract(), but split text into chunks and extract each one using a
+    concurrent.futures executor, e.g. a ProcessPoolExecutor.
+
+    No candidate IOC or defanged form spans a newline, so chunks don't need
+    to overlap.  Merging the chunks in order gives the same result as
+    extract(text).
+    """
+    found = {}
+    for results in executor.map(extract, chunks(text, chunk_size)):
+        for result in results:
+            found[result] = True
+    return list(found)
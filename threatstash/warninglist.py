@@ -0,0 +1,412 @@
+# Compiled MISP warning lists
+#
+# Parsing the warning lists is expensive, so each list is compiled once per
+# process and shared by every plugin instance and every Event.  Compiled
+# lists are also pickled to an on-disk cache so a cold start doesn't have to
+# parse the JSON again.  A cached list is rebuilt when its list.json changes.
+# The cache lives in the user's cache directory rather than next to the
+# lists, which are usually a git checkout.
+#
+# See https://github.com/MISP/misp-warninglists
+
+import hashlib
+import ipaddress
+import json
+import logging
+import os
+import pickle
+import tempfile
+import threading
+
+import numpy
+
+# Bump this when the format of the cached lists changes
+CACHE_VERSION = 2
+
+# Shared indexes, keyed by warning list directory
+_indexes = {}
+_indexes_lock = threading.Lock()
+
+class WarningList():
+    """
+    A compiled warning list
+    """
+    def __init__(self, name, list_type, entries, networks=None):
+        """
+        Parameters
+        ----------
+        name : string
+            Name of the list, e.g. "List of known Amazon AWS IP address ranges"
+        list_type : string
+            Type of the list from list.json, e.g. "cidr" or "hostname"
+        entries : list of strings
+            Lowercased entries from the list
+        networks : list of tuples
+            (IP version, first address, last address) of each CIDR entry, as
+            returned by parse_networks().  Parsed from entries if not given.
+        """
+        self._name = name
+        self._type = list_type
+        self._raw  = entries
+        self._networks = None
+        if list_type == "cidr":
+            if networks is None:
+                networks = parse_networks(entries)
+            self._networks = networks
+            # A Matcher of just this list to test membership with, built
+            # the first time it's needed.  Plugins only use the merged
+            # Matcher, so it usually never is.
+            self._entries = None
+        else:
+            self._entries = frozenset(entries)
+
+    @property
+    def name(self):
+        return self._name
+
+    @property
+    def type(self):
+        return self._type
+
+    @property
+    def entries(self):
+        if self._entries is None:
+            self._entries = Matcher({ None : self })
+        return self._entries
+
+    @property
+    def entries_list(self):
+        return self._raw
+
+    @property
+    def networks(self):
+        return self._networks
+
+    def __contains__(self, value):
+        if self._type == "cidr":
+            return bool(self.entries.match(value, cidr=True))
+        return value in self._entries
+
+    def __len__(self):
+        return len(self._raw)
+
+    # Pickle the raw entries and the parsed CIDR ranges, so loading a cached
+    # list doesn't parse the CIDRs again.  The other lookup structures are
+    # rebuilt on load.
+    def __getstate__(self):
+        return {
+            'name'     : self._name,
+            'type'     : self._type,
+            'entries'  : self._raw,
+            'networks' : self._networks
+        }
+
+    def __setstate__(self, state):
+        # Caches from before the ranges were pickled have no 'networks'
+        self.__init__(state['name'], state['type'], state['entries'], state.get('networks'))
+
+def parse_networks(entries):
+    """
+    Return an (IP version, first address, last address) tuple for each
+    entry in a list of CIDR strings.  Addresses are integers.  Entries that
+    aren't valid networks are skipped.
+    """
+    networks = []
+    for entry in entries:
+        try:
+            network = ipaddress.ip_network(entry, strict=False)
+        except ValueError:
+            continue
+        networks.append((
+                network.version,
+                int(network.network_address),
+                int(network.broadcast_address)
+            ))
+    return networks
+
+class CIDRTable():
+    """
+    The CIDR entries from a set of warning lists for one IP version, kept as
+    sorted arrays of integers so a whole batch of addresses can be checked
+    against every list with one vectorized search.
+
+    The address space is split into segments at every range boundary.
+    _starts holds the first address of each segment, and _keys holds the set
+    of lists covering that segment.
+    """
+    def __init__(self, version):
+        self._version = version
+        # List key => [(first address, last address), ...]
+        self._ranges = {}
+        self._starts = None
+        self._keys = None
+
+    def add(self, key, first, last):
+        self._ranges.setdefault(key, []).append((first, last))
+        # Rebuild the arrays on the next lookup
+        self._starts = None
+
+    def _build(self):
+        # Address => [(+1 or -1, list key), ...] where each range starts and
+        # stops
+        boundaries = {}
+        for key, ranges in self._ranges.items():
+            for first, last in ranges:
+                boundaries.setdefault(first, []).append((1, key))
+                boundaries.setdefault(last + 1, []).append((-1, key))
+
+        # Walk the boundaries in order, keeping count of the ranges from each
+        # list that cover the current segment
+        active = {}
+        starts = []
+        keys = []
+        for address in sorted(boundaries):
+            for delta, key in boundaries[address]:
+                active[key] = active.get(key, 0) + delta
+                if not active[key]:
+                    del active[key]
+            starts.append(address)
+            keys.append(frozenset(active))
+
+        # IPv6 addresses don't fit in a machine integer, so they're kept as
+        # Python ints in an object array.  searchsorted still works on it.
+        if self._version == 4:
+            self._starts = numpy.array(starts, dtype=numpy.uint64)
+        else:
+            self._starts = numpy.array(starts, dtype=object)
+        self._keys = numpy.empty(len(keys) + 1, dtype=object)
+        # The extra segment at the end is for addresses below the first
+        # range, which searchsorted returns as index -1
+        self._keys[-1] = frozenset()
+        for i, segment_keys in enumerate(keys):
+            self._keys[i] = segment_keys
+
+    def lookup(self, addresses):
+        """
+        Return an array holding the set of list keys for each address in
+        addresses, a sequence of integers
+        """
+        if not self._ranges:
+            return [ frozenset() ] * len(addresses)
+        if self._starts is None:
+            self._build()
+        if self._version == 4:
+            addresses = numpy.array(addresses, dtype=numpy.uint64)
+        else:
+            addresses = numpy.array(addresses, dtype=object)
+        segments = numpy.searchsorted(self._starts, addresses, side='right') - 1
+        return self._keys[segments]
+
+class Matcher():
+    """
+    All the entries of a set of warning lists merged into one structure that
+    maps each entry to the lists containing it, so every list can be checked
+    with a single lookup.
+
+    String and hostname entries go into a trie keyed by reversed labels, so
+    "a.b.evil.co.uk" is checked against entries for "uk", "co.uk",
+    "evil.co.uk", and so on in one walk.  CIDR entries from every list go
+    into one CIDRTable per IP version.
+    """
+    def __init__(self, warning_lists={}):
+        # Trie nodes are dicts of label => child node.  The None key holds the
+        # set of lists with an entry ending at that node.
+        self._trie = {}
+        # IP version => CIDRTable
+        self._cidrs = { 4 : CIDRTable(4), 6 : CIDRTable(6) }
+        for key, warning_list in warning_lists.items():
+            self.add(key, warning_list)
+
+    def add(self, key, warning_list):
+        """
+        Add the entries of a WarningList, identified by key
+        """
+        if warning_list.type == "cidr":
+            for version, first, last in warning_list.networks:
+                self._cidrs[version].add(key, first, last)
+        else:
+            for entry in warning_list.entries_list:
+                node = self._trie
+                for label in reversed(entry.split('.')):
+                    node = node.setdefault(label, {})
+                node.setdefault(None, set()).add(key)
+
+    def match(self, value, min_depth=None, cidr=False):
+        """
+        Return the set of list keys with an entry matching value.
+
+        Parameters
+        ----------
+        value : string
+            The value to look up, e.g. a hostname or IP address
+        min_depth : int
+            Also match entries for the parents of value that have at least
+            this many labels.  E.g. with min_depth=2, "www.google.com" matches
+            entries for "google.com" but not "com".  Without min_depth only
+            exact matches count.
+        cidr : bool
+            Also check value against the CIDR entries
+        """
+        hits = set()
+        labels = value.split('.')
+        depth = len(labels)
+        if min_depth is None:
+            min_depth = depth
+        node = self._trie
+        for level, label in enumerate(reversed(labels), 1):
+            node = node.get(label)
+            if node is None:
+                break
+            if level >= min_depth and None in node:
+                hits.update(node[None])
+
+        if cidr:
+            hits.update(self.match_ips([value])[0])
+        return hits
+
+    def match_ips(self, values):
+        """
+        Check a batch of IPv4 and IPv6 addresses against the CIDR entries of
+        every list at once.  Return a list holding the set of list keys
+        matching each value.  Values that aren't IP addresses match nothing.
+        """
+        hits = [ frozenset() ] * len(values)
+        # IP version => ([position in values, ...], [address as int, ...])
+        batches = { 4 : ([], []), 6 : ([], []) }
+        for i, value in enumerate(values):
+            try:
+                address = ipaddress.ip_address(value)
+            except ValueError:
+                continue
+            positions, addresses = batches[address.version]
+            positions.append(i)
+            addresses.append(int(address))
+        for version, (positions, addresses) in batches.items():
+            if not positions:
+                continue
+            for i, keys in zip(positions, self._cidrs[version].lookup(addresses)):
+                hits[i] = keys
+        return hits
+
+class WarningListIndex():
+    """
+    The compiled warning lists from one warning list directory.  Use
+    threatstash.warninglist.index() to get the shared instance.
+    """
+    def __init__(self, warning_list_dir, cache_dir=None):
+        self._warning_list_dir = warning_list_dir
+        if cache_dir is None:
+            cache_dir = default_cache_dir(warning_list_dir)
+        self._cache_dir = cache_dir
+        # List directory name => (list.json mtime, WarningList)
+        self._lists = {}
+        self._lock = threading.Lock()
+        # Merged Matcher for every list we've loaded, rebuilt when a list
+        # changes
+        self._matcher = Matcher()
+
+    def load(self, names):
+        """
+        Return the compiled WarningList for each name in names, e.g.
+        ["alexa", "amazon-aws"].  Lists are compiled or read from the cache
+        the first time they're asked for, and again only if their list.json
+        has changed since.
+        """
+        return [ self.get(name) for name in names ]
+
+    def get(self, name):
+        filename = os.path.join(self._warning_list_dir, "lists", name, "list.json")
+        mtime = os.stat(filename).st_mtime_ns
+        with self._lock:
+            loaded = self._lists.get(name)
+            if loaded and loaded[0] == mtime:
+                return loaded[1]
+            warning_list = self._read_cache(name, mtime)
+            if warning_list is None:
+                warning_list = self._compile(filename)
+                self._write_cache(name, mtime, warning_list)
+            self._lists[name] = (mtime, warning_list)
+            if loaded:
+                # A list changed, so its old entries have to go
+                self._matcher = Matcher({
+                    key : value[1] for key, value in self._lists.items()
+                })
+            else:
+                self._matcher.add(name, warning_list)
+            return warning_list
+
+    @property
+    def matcher(self):
+        """
+        The merged Matcher for every list loaded into this index.  Matches
+        are reported by list directory name, e.g. "alexa".
+        """
+        return self._matcher
+
+    # Parse a list.json
+    def _compile(self, filename):
+        with open(filename) as f:
+            data = json.load(f)
+        logging.debug("[warninglist] Compiled " + data["name"] + " from " + filename)
+        return WarningList(
+                data["name"],
+                data["type"],
+                [ entry.lower() for entry in data["list"] ]
+            )
+
+    def _cache_file(self, name):
+        return os.path.join(self._cache_dir, name + ".pickle")
+
+    # Return a WarningList from the cache, or None if it's missing, stale, or
+    # unreadable.  A truncated file or one from another version of
+    # threatstash can fail to unpickle in all sorts of ways, and any of them
+    # just means the list has to be compiled again.
+    def _read_cache(self, name, mtime):
+        try:
+            with open(self._cache_file(name), "rb") as f:
+                cached = pickle.load(f)
+            if cached.get("version") != CACHE_VERSION or cached.get("mtime") != mtime:
+                return None
+            warning_list = cached["list"]
+        except Exception as e:
+            logging.debug("[warninglist] Unable to read cache for " + name + ": " + repr(e))
+            return None
+        if not isinstance(warning_list, WarningList):
+            return None
+        return warning_list
+
+    def _write_cache(self, name, mtime, warning_list):
+        try:
+            os.makedirs(self._cache_dir, exist_ok=True)
+            # Write to a temporary file and rename it so other processes never
+            # see a partial cache file
+            fd, tmp = tempfile.mkstemp(dir=self._cache_dir)
+            with os.fdopen(fd, "wb") as f:
+                pickle.dump({
+                    "version" : CACHE_VERSION,
+                    "mtime"   : mtime,
+                    "list"    : warning_list
+                }, f, pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp, self._cache_file(name))
+        except OSError as e:
+            logging.debug("[warninglist] Unable to write cache: " + str(e))
+
+def default_cache_dir(warning_list_dir):
+    """
+    Return the cache directory for a warning list directory when none is
+    configured: a directory per warning list directory under
+    $XDG_CACHE_HOME/threatstash/warninglists, or ~/.cache if that isn't set
+    """
+    cache_home = os.environ.get("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"), ".cache")
+    digest = hashlib.sha1(os.path.realpath(warning_list_dir).encode()).hexdigest()[:16]
+    return os.path.join(cache_home, "threatstash", "warninglists", digest)
+
+def index(warning_list_dir, cache_dir=None):
+    """
+    Return the shared WarningListIndex for a warning list directory
+    """
+    key = (os.path.realpath(warning_list_dir), cache_dir)
+    with _indexes_lock:
+        if key not in _indexes:
+            _indexes[key] = WarningListIndex(warning_list_dir, cache_dir)
+        return _indexes[key]